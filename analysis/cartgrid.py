@@ -64,25 +64,51 @@ class RegGrid(object):
 
         return i.astype(int),j.astype(int)
 
-    def griddata(self,x,y,z):
+    def returnindex(self,x,y):
         """
-        Grids data in the vectors x, y and z.
+        Returns the flattened (row-major) grid index of the points in x, y
 
-        Uses sparse matrices and therefore duplicate entries are averaged
+        Out of bound points are set to -1.
         """
-        # Get the coordinates
-        i,j = self.returnij(x,y)
-        ind = np.isfinite(i)
+        x = np.ma.filled(np.asarray(x,dtype=np.float64),np.nan).ravel()
+        y = np.ma.filled(np.asarray(y,dtype=np.float64),np.nan).ravel()
+
+        i = np.floor( (x-self.ox)/self.dx )
+        j = np.floor( (y-self.oy)/self.dy )
+
+        # NaNs fail all of the comparisons and are flagged as out of bounds
+        valid = (i>=0) & (i<self.nx) & (j>=0) & (j<self.ny)
 
-        # Build two sparse matrices - one for the data and one to count 
-        # the number of entries
-        ctr = np.ones(z.shape)
+        ind = -np.ones(x.shape,dtype=np.int64)
+        ind[valid] = j[valid].astype(np.int64)*self.nx + i[valid].astype(np.int64)
 
-        data = sparse.coo_matrix( (z[ind],(j[ind],i[ind])),shape=(self.ny,self.nx) )
-        count = sparse.coo_matrix( (ctr[ind],(j[ind],i[ind])),shape=(self.ny,self.nx) )
+        return ind
 
-        data = data/count
+    def binstats(self,ind,z):
+        """
+        Returns the sum and the number of the values in z falling in each
+        (flattened) grid cell given the indices from returnindex
+        """
+        z = np.ma.filled(np.asarray(z,dtype=np.float64),np.nan).ravel()
+        valid = (ind>=0) & np.isfinite(z)
+        n = self.ny*self.nx
 
-        return np.array(data.todense())
+        zsum = np.bincount(ind[valid],weights=z[valid],minlength=n)
+        count = np.bincount(ind[valid],minlength=n).astype(np.float64)
+
+        return zsum, count
+
+    def griddata(self,x,y,z):
+        """
+        Grids data in the vectors x, y and z.
+
+        Duplicate entries are averaged and empty cells are set to NaN
+        """
+        ind = self.returnindex(x,y)
+        zsum, count = self.binstats(ind,z)
 
+        data = np.nan*np.ones(zsum.shape)
+        nonzero = count>0
+        data[nonzero] = zsum[nonzero]/count[nonzero]
 
+        return data.reshape((self.ny,self.nx))
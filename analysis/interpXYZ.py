@@ -10,7 +10,7 @@
 """
 
 import gzip
-from scipy import spatial
+from scipy import spatial, sparse
 import numpy as np
 from maptools import ll2utm, readShpBathy, readraster
 from kriging import kriging
@@ -93,7 +93,7 @@ class interpXYZ(object):
         
         if self.method in ['nn','idw','kriging']:
             #print 'Building DEM with Nearest Neighbour interpolation...'
-            self.Z = self.Finterp(Zin)
+            self.Z = self.Finterp(self.Zin)
 
         elif self.method=='linear':
             self.Finterp.values[:]=Zin[:,np.newaxis]
@@ -105,6 +105,48 @@ class interpXYZ(object):
         
         
         return self.Z
+
+    def getmatrix(self):
+        """
+        Returns the interpolation weights as a sparse [Nout x Nin] matrix
+
+        Zout = W.dot(Zin) is equivalent to calling the class and a 2D
+        array of inputs [Nin x N] is interpolated with a single product.
+        Points outside of maxdist (nearest neighbour) are returned as NaN.
+
+        Returns None for methods that do not have fixed weights ('linear')
+        """
+        if self.__dict__.has_key('_W'):
+            return self._W
+
+        if self.method=='nn':
+            nout = self.Finterp.ind.shape[0]
+            rows = np.arange(nout)
+            cols = self.Finterp.ind
+            data = np.ones((nout,))
+            data[self.Finterp.mask] = np.nan
+        elif self.method=='idw':
+            nout,nnear = self.Finterp.ind.shape
+            rows = np.repeat(np.arange(nout),nnear)
+            cols = self.Finterp.ind.ravel()
+            data = self.Finterp.W.ravel()
+        elif self.method=='kriging':
+            nout,nnear = self.Finterp.ind.shape
+            rows = np.repeat(np.arange(nout),nnear)
+            cols = self.Finterp.ind.ravel()
+            data = self.Finterp.W.T.ravel()
+        else:
+            return None
+
+        # Weights refer to the clipped points so map them back
+        nin = self.XY.shape[0]
+        if self.clip:
+            cols = np.flatnonzero(self.clipindex)[cols]
+            nin = self.clipindex.shape[0]
+
+        self._W = sparse.csr_matrix((data,(rows,cols)),shape=(nout,nin))
+
+        return self._W
         
     def _nearestNeighbour(self):
         """ Nearest neighbour interpolation algorithm
@@ -233,7 +275,7 @@ class Interp4D(object):
 
         """
         self.is4D=True
-        if zin == None:
+        if zin is None:
             self.is4D=False
             self.nz=1
         else:
@@ -244,7 +286,7 @@ class Interp4D(object):
 
         # Create a 3D mask
         self.szxy = xin.shape
-        if mask==None:
+        if mask is None:
             self.mask = np.zeros((self.nz,)+self.szxy,np.bool)
         else:
             self.mask=mask
@@ -268,6 +310,69 @@ class Interp4D(object):
         self.tout = othertime.SecondsSince(tout)
         self.nt = tin.shape[0]
 
+    def getmatrix(self):
+        """
+        Returns the combined horizontal and vertical interpolation weights
+        as a sparse [Nz_out*Nxy_out x Nz_in*Nxy_in] matrix
+
+        The input columns are ordered as data[tt,...].ravel() so masked points
+        have zero weight. Returns None if the horizontal interpolant does not
+        have fixed weights or the vertical interpolation is not linear.
+        """
+        if self.__dict__.has_key('_S'):
+            return self._S
+
+        if self.is4D and not self.zinterp_method=='linear':
+            return None
+
+        nin = self.szxy[0]
+        blocks = []
+        for kk in range(self.nz):
+            W = self._Fxy[kk].getmatrix()
+            if W is None:
+                return None
+
+            # Map the unmasked input points onto the full layer
+            if self.is4D:
+                mask = self.mask[kk,...]
+            else:
+                mask = self.mask
+            cols = np.flatnonzero(~mask.ravel())
+            W = W.tocoo()
+            W = sparse.csr_matrix((W.data,(W.row,cols[W.col])),shape=(self.nxy,nin))
+
+            if self.is4D:
+                Wz = interp1dmatrix(self.zin,self.zout).tocsc()[:,kk]
+                W = sparse.kron(Wz,W)
+
+            blocks.append(W)
+
+        self._S = sparse.hstack(blocks).tocsr()
+
+        return self._S
+
+    def timematrix(self,tin=None,tout=None):
+        """
+        Returns the sparse [Nt_out x Nt_in] temporal interpolation weights
+
+        tin/tout default to the input and output times of the class. Returns
+        None if the temporal interpolation is not linear.
+        """
+        if not self.tinterp_method=='linear':
+            return None
+
+        if tin is None:
+            tin = self.tin
+        else:
+            tin = othertime.SecondsSince(tin)
+
+        if tout is None:
+            tout = self.tout
+        else:
+            tout = othertime.SecondsSince(tout)
+
+        return interp1dmatrix(tin,tout)
+
     def __call__(self,data):
         """
         Performs the interpolation in this order:
@@ -279,6 +384,17 @@ class Interp4D(object):
                 the time coordinates
         """
 
+        # Apply the combined weights if possible
+        S = self.getmatrix()
+        Wt = self.timematrix()
+        if not S is None and not Wt is None:
+            data = np.ma.filled(data,0.).reshape((self.nt,-1))
+            data_xyz = S.dot(Wt.dot(data).T).T
+            if self.is4D:
+                return data_xyz.reshape((-1,self.zout.shape[0],self.nxy))
+            else:
+                return data_xyz
+
         # Interpolate horizontally for all time steps and depths
         if self.is4D:
             data_xy = np.zeros((self.nt,self.nz,self.nxy))
@@ -473,6 +589,39 @@ class nn(object):
         return Z            
 ## Other functions that don't need to be in a class ##
 
+def interp1dmatrix(xin,xout):
+    """
+    Returns a sparse [Nout x Nin] linear interpolation matrix
+
+    Equivalent to interp1d(xin,...,bounds_error=False,fill_value=0.)(xout)
+    i.e. points outside of the range of xin have zero weight.
+    """
+    xin = np.asarray(xin,dtype=np.float64).ravel()
+    xout = np.asarray(xout,dtype=np.float64).ravel()
+    nin = xin.shape[0]
+    nout = xout.shape[0]
+
+    order = np.argsort(xin)
+    xs = xin[order]
+
+    inside = (xout>=xs[0]) & (xout<=xs[-1])
+    rows = np.arange(nout)[inside]
+    if nin == 1:
+        return sparse.csr_matrix((np.ones(rows.shape),(rows,order[rows*0])),shape=(nout,nin))
+
+    i1 = np.searchsorted(xs,xout[inside],side='right')
+    i1 = np.clip(i1,1,nin-1)
+    i0 = i1-1
+    dx = xs[i1] - xs[i0]
+    dx[dx==0] = 1.
+    w = (xout[inside] - xs[i0])/dx
+
+    rows = np.hstack([rows,rows])
+    cols = np.hstack([order[i0],order[i1]])
+    data = np.hstack([1.-w,w])
+
+    return sparse.csr_matrix((data,(rows,cols)),shape=(nout,nin))
+
     
 def read_xyz_gz(fname):
     # Read the raw data into an array
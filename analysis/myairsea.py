@@ -16,6 +16,11 @@ import numpy as np
 import operator
 import pdb
 
+try:
+    import numexpr as ne
+except:
+    ne = None
+
 # Global Coefficients
 Ce = 1.10e-3 # Dalton number
 Ch = 1.10e-3 # Stanton number
@@ -172,7 +177,121 @@ def heatFluxes(Uwind,Vwind,Ta,Tw,Pa,RH,cloud):
     
     return Hl, Hs, Hlwu, Hlwd, dq, dT, S
     
-    
+# Outputs of airseaFluxes
+fluxvars = {\
+    'Hl':{'long_name':'Latent heat flux','units':'W m-2'},\
+    'Hs':{'long_name':'Sensible heat flux','units':'W m-2'},\
+    'Hlwu':{'long_name':'Upward longwave radiation','units':'W m-2'},\
+    'Hlwd':{'long_name':'Downward longwave radiation','units':'W m-2'},\
+    'dq':{'long_name':'Specific humidity difference (water - air)','units':'kg kg-1'},\
+    'dT':{'long_name':'Temperature difference (water - air)','units':'K'},\
+    'S':{'long_name':'Wind speed','units':'m s-1'},\
+    'tau_x':{'long_name':'Eastward wind stress','units':'N m-2'},\
+    'tau_y':{'long_name':'Northward wind stress','units':'N m-2'},\
+    }
+fluxinputs = ['Uwind','Vwind','Ta','Tw','Pa','RH','cloud']
+
+def airseaFluxes(inputs,tchunk=24,outfile=None,time=None,timeunits=None,\
+        Cd=1.1e-3,usenumexpr=False):
+    """
+    Computes heatFluxes and the wind stress (stressBulk) on [Nt, Npoints]
+    arrays in chunks of tchunk time steps
+
+    Inputs:
+        inputs - dictionary with the heatFluxes inputs (see fluxinputs).
+            Each item can be any array-like object that is sliced along
+            the first axis e.g. numpy arrays, memmaps or netcdf variables.
+        tchunk - number of time steps evaluated at once
+        outfile - netcdf file to write the fluxes to as they are computed.
+            The fluxes are returned in a dictionary if outfile is None.
+        time, timeunits - time variable written to outfile (optional)
+        Cd - drag coefficient for the wind stress
+        usenumexpr - evaluate each flux as one fused expression with numexpr
+            (if installed). The results are not bit-identical to the original
+            functions (compare them with tutorials/benchmark_airsea.py). By
+            default the original functions are used on each chunk and the
+            results are identical.
+    """
+    Nt, Np = inputs['Uwind'].shape
+    fuse = usenumexpr and not ne is None
+
+    if outfile is None:
+        out = dict([(vv,np.zeros((Nt,Np))) for vv in fluxvars.keys()])
+    else:
+        from netCDF4 import Dataset
+        nc = Dataset(outfile,'w',format='NETCDF4')
+        nc.Description = 'Air-sea fluxes from bulk formulae'
+        nc.createDimension('time',Nt)
+        nc.createDimension('Npoints',Np)
+        if not time is None:
+            tmp = nc.createVariable('time','f8',('time',))
+            if not timeunits is None:
+                tmp.units = timeunits
+            tmp[:] = time
+        for vv in fluxvars.keys():
+            tmp = nc.createVariable(vv,'f8',('time','Npoints'))
+            for aa in fluxvars[vv].keys():
+                tmp.setncattr(aa,fluxvars[vv][aa])
+        out = nc.variables
+
+    for t1 in range(0,Nt,tchunk):
+        t2 = min(t1+tchunk,Nt)
+        chunk = dict([(vv,np.asarray(inputs[vv][t1:t2],dtype=np.float64)) for vv in fluxinputs])
+        if fuse:
+            fluxes = _fluxesFused(chunk,Cd)
+        else:
+            fluxes = _fluxes(chunk,Cd)
+
+        for vv in fluxvars.keys():
+            out[vv][t1:t2,...] = fluxes[vv]
+
+    if outfile is None:
+        return out
+
+    nc.close()
+    return outfile
+
+def _fluxes(chunk,Cd):
+    """
+    Fluxes on a chunk using the bulk formulae functions
+    """
+    fluxes = {}
+    fluxes['Hl'], fluxes['Hs'], fluxes['Hlwu'], fluxes['Hlwd'], fluxes['dq'],\
+        fluxes['dT'], fluxes['S'] = heatFluxes(*[chunk[vv] for vv in fluxinputs])
+
+    fluxes['tau_x'] = stressBulk(chunk['Uwind'],fluxes['S'],Cd=Cd)
+    fluxes['tau_y'] = stressBulk(chunk['Vwind'],fluxes['S'],Cd=Cd)
+
+    return fluxes
+
+def _fluxesFused(chunk,Cd):
+    """
+    Fluxes on a chunk with numexpr (same expressions as heatFluxes)
+    """
+    d = dict(chunk)
+    d.update({'rhoa':rhoa,'Le':Le,'Ce':Ce,'Ch':Ch,'cp':cp,'r_LW':r_LW,'Cd':Cd})
+
+    # Vapour pressure at saturation (see qsat)
+    ew = '6.1121*(1.0007+3.46e-6*Pa)*exp((17.502*%s)/(240.97+%s))'
+    d['ewa'] = ne.evaluate(ew%('Ta','Ta'),local_dict=d)
+    d['eww'] = ne.evaluate(ew%('Tw','Tw'),local_dict=d)
+
+    fluxes = {}
+    fluxes['S'] = d['S'] = ne.evaluate('sqrt(Uwind**2+Vwind**2)',local_dict=d)
+    fluxes['dq'] = d['dq'] = ne.evaluate(\
+        '0.98*(0.62197*(eww/(Pa-0.378*eww))) - 0.01*RH*(0.62197*(ewa/(Pa-0.378*ewa)))',\
+        local_dict=d)
+    fluxes['Hl'] = ne.evaluate('-rhoa*Le*Ce*S*dq',local_dict=d)
+    fluxes['dT'] = d['dT'] = ne.evaluate('Tw - Ta',local_dict=d)
+    fluxes['Hs'] = ne.evaluate('-rhoa*cp*Ch*S*dT',local_dict=d)
+    fluxes['Hlwu'] = ne.evaluate('-0.97*5.67e-8*(Tw+273.16)**4',local_dict=d)
+    fluxes['Hlwd'] = ne.evaluate('0.937e-5*(1.0 + 0.17 * cloud**2)*(Ta+273.16)**2'+\
+        '*5.67051e-8*(1.0-r_LW)*(Ta+273.16)**4',local_dict=d)
+    fluxes['tau_x'] = ne.evaluate('rhoa*Cd*S*Uwind',local_dict=d)
+    fluxes['tau_y'] = ne.evaluate('rhoa*Cd*S*Vwind',local_dict=d)
+
+    return fluxes
+
 def latentBulk(qs, q, S, rhoa=1.2, Ce=1.5e-3, Le=2.5e6):
     """
     Latent heat flux from water using the bulk exchange formulation
@@ -165,6 +165,144 @@ def eofsvd(M):
 
     return PC,s*s,E
 
+def eofrsvd(M,k,weights=None,oversample=10,niter=2,seed=None):
+    """
+    Compute the leading k empirical orthogonal functions using a
+    randomized singular value decomposition (Halko et al., 2011)
+
+    Inputs:
+        - M : matrix with time along first axis and observation points along
+          second
+        - k : number of modes
+        - weights : weight of each observation point e.g. cell area
+        - oversample : number of extra random vectors
+        - niter : number of power iterations
+    Returns:
+        - PC : The principal component amplitude [Nt, k]
+        - lam : the eigenvalues [k]
+        - E : the eigenvectors in each column (EOFs) [Nspace, k]
+        - frac : the fraction of the total variance in each mode [k]
+    """
+    sw = _eofweights(weights)
+
+    # Remove the mean from the columns
+    M = M - M.mean(axis=0)
+    if not sw is None:
+        M = M*sw
+
+    def matmul(Q):
+        return M.dot(Q)
+
+    def rmatmul(Q):
+        return M.T.dot(Q)
+
+    U,s,V = _rsvd(matmul,rmatmul,M.shape,k,oversample,niter,seed)
+
+    return _eofout(U,s,V,sw,(M**2).sum())
+
+def eofstream(reader,Nt,k,tchunk=100,weights=None,oversample=10,niter=1,seed=None):
+    """
+    Compute the leading k empirical orthogonal functions of a matrix that
+    is read in chunks of time steps (see eofrsvd)
+
+    The matrix is never held in memory. Each product with it is one pass
+    through the chunks (2*niter + 2 passes in total) so the memory use
+    scales with (tchunk + k + oversample) x Nspace.
+
+    Inputs:
+        - reader : function reader(t1,t2) that returns M[t1:t2,:]
+        - Nt : number of time steps
+        - k, weights, oversample, niter, seed : see eofrsvd
+    Returns:
+        - PC, lam, E, frac : see eofrsvd
+    """
+    chunks = [(t1,min(t1+tchunk,Nt)) for t1 in range(0,Nt,tchunk)]
+
+    # Subtract the first time step to reduce round-off in the mean removal
+    shift = np.asarray(reader(0,1),dtype=np.float64)[0,:]
+    Nspace = shift.shape[0]
+
+    sw = _eofweights(weights)
+    if sw is None:
+        scale = 1.
+    else:
+        scale = sw
+
+    stats = {}
+    def getchunk(t1,t2):
+        return (np.asarray(reader(t1,t2),dtype=np.float64) - shift)*scale
+
+    def matmul(Q):
+        Y = np.zeros((Nt,Q.shape[1]))
+        if not stats.has_key('mean'):
+            # Calculate the mean and variance on the first pass
+            msum = np.zeros((Nspace,))
+            sumsq = 0.
+            for t1,t2 in chunks:
+                A = getchunk(t1,t2)
+                Y[t1:t2,:] = A.dot(Q)
+                msum += A.sum(axis=0)
+                sumsq += (A**2).sum()
+            stats['mean'] = msum/Nt
+            stats['var'] = sumsq - Nt*(stats['mean']**2).sum()
+        else:
+            for t1,t2 in chunks:
+                Y[t1:t2,:] = getchunk(t1,t2).dot(Q)
+
+        return Y - stats['mean'].dot(Q)[np.newaxis,:]
+
+    def rmatmul(Q):
+        Z = np.zeros((Nspace,Q.shape[1]))
+        for t1,t2 in chunks:
+            Z += getchunk(t1,t2).T.dot(Q[t1:t2,:])
+
+        return Z - np.outer(stats['mean'],Q.sum(axis=0))
+
+    U,s,V = _rsvd(matmul,rmatmul,(Nt,Nspace),k,oversample,niter,seed)
+
+    return _eofout(U,s,V,sw,stats['var'])
+
+def _rsvd(matmul,rmatmul,shape,k,oversample,niter,seed):
+    """
+    Randomized svd of a matrix A [shape] given the products
+        matmul(Q) = A.Q and rmatmul(Q) = A^T.Q
+    """
+    l = min(k+oversample,shape[0],shape[1])
+    Omega = np.random.RandomState(seed).randn(shape[1],l)
+
+    # Range finder with power iterations
+    Q,R = np.linalg.qr(matmul(Omega))
+    for ii in range(niter):
+        Z,R = np.linalg.qr(rmatmul(Q))
+        Q,R = np.linalg.qr(matmul(Z))
+
+    # Svd of the small matrix Q^T.A
+    B = rmatmul(Q).T
+    Ub,s,V = np.linalg.svd(B,full_matrices=False)
+
+    return Q.dot(Ub[:,:k]), s[:k], V[:k,:].T
+
+def _eofweights(weights):
+    """
+    Square root of the normalised weights
+    """
+    if weights is None:
+        return None
+
+    weights = np.asarray(weights,dtype=np.float64)
+    return np.sqrt(weights/weights.mean())
+
+def _eofout(U,s,V,sw,var):
+    """
+    Principal components, eigenvalues, EOFs and variance fraction from the
+    (weighted) svd
+    """
+    E = V
+    if not sw is None:
+        E = V/sw[:,np.newaxis]
+
+    return U*s, s*s, E, s*s/var
+
 def window2d(M,N,windowfunc=np.hanning,**kwargs):
     """
     2D window function
@@ -804,6 +804,214 @@ class ModVsObs(object):
         
         return Pyy, frq
 
+class SkillStats(object):
+    """
+    Model vs observation statistics for many stations at once
+
+    The model is linearly interpolated onto the observation times of all
+    stations in one step and the statistics are computed over the valid
+    (finite, unmasked, overlapping) observations of each station.
+
+    Statistics [Nstation]:
+        N, meanMod, meanObs, stdMod, stdObs, bias, rmse, crmse,
+        skill (1 - SSE/SSobs as in ModVsObs), willmott, cc
+    Tidal harmonic statistics [Nstation, Ncon] (if frqnames is set):
+        ampMod, ampObs, phsMod, phsObs, ampErr, phsErr, tidalRMSE
+    """
+    statnames = ['N','meanMod','meanObs','stdMod','stdObs','bias','rmse',\
+        'crmse','skill','willmott','cc']
+    tidenames = ['ampMod','ampObs','phsMod','phsObs','ampErr','phsErr','tidalRMSE']
+
+    basetime = datetime(1900,1,1) # Reference time for the tidal phases
+    units = ''
+    varname = ''
+
+    def __init__(self,tmod,ymod,tobs,yobs,stationids=None,frqnames=None,**kwargs):
+        """
+        Inputs:
+            tmod,tobs - vector of datetime objects (or seconds)
+            ymod - array [Nstation, Ntmod]
+            yobs - array [Nstation, Ntobs] (NaN or masked values are ignored)
+
+        Keywords:
+            stationids - list of station names
+            frqnames - list of tidal constituents to compare e.g. ['M2','K1']
+        """
+        self.__dict__.update(kwargs)
+
+        self.tmod = self._seconds(tmod)
+        self.tobs = self._seconds(tobs)
+
+        ymod = np.ma.filled(ymod,np.nan).astype(np.float64)
+        yobs = np.ma.filled(yobs,np.nan).astype(np.float64)
+        if ymod.ndim==1:
+            ymod = ymod[np.newaxis,:]
+            yobs = yobs[np.newaxis,:]
+        self.Nstation = ymod.shape[0]
+
+        if stationids is None:
+            stationids = ['%d'%ii for ii in range(self.Nstation)]
+        self.stationids = stationids
+
+        self.align(ymod,yobs)
+        self.calcStats()
+
+        self.frqnames = frqnames
+        if not frqnames is None:
+            self.calcTideStats()
+
+    def _seconds(self,t):
+        t = np.asarray(t)
+        if isinstance(t[0],datetime):
+            return othertime.SecondsSince(t,basetime=self.basetime)
+        return t.astype(np.float64)
+
+    def align(self,ymod,yobs):
+        """
+        Interpolates the model onto the observation times and sets the mask
+        of valid points
+        """
+        tm, to = self.tmod, self.tobs
+        inrange = (to>=tm[0]) & (to<=tm[-1])
+
+        i1 = np.clip(np.searchsorted(tm,to),1,tm.size-1)
+        i0 = i1-1
+        w = (to-tm[i0])/(tm[i1]-tm[i0])
+        ymodi = ymod[:,i0]*(1-w) + ymod[:,i1]*w
+
+        self.mask = inrange[np.newaxis,:] & np.isfinite(yobs) & np.isfinite(ymodi)
+        self.ymod = np.where(self.mask,ymodi,0.)
+        self.yobs = np.where(self.mask,yobs,0.)
+
+    def calcStats(self):
+        """
+        Calculates the statistics for all stations
+        """
+        mask = self.mask
+        mod, obs = self.ymod, self.yobs
+
+        self.N = mask.sum(axis=-1)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            N = self.N.astype(np.float64)
+            self.meanMod = mod.sum(axis=-1)/N
+            self.meanObs = obs.sum(axis=-1)/N
+
+            mprime = np.where(mask,mod-self.meanMod[:,np.newaxis],0.)
+            oprime = np.where(mask,obs-self.meanObs[:,np.newaxis],0.)
+            self.stdMod = np.sqrt((mprime**2).sum(axis=-1)/N)
+            self.stdObs = np.sqrt((oprime**2).sum(axis=-1)/N)
+
+            sse = ((mod-obs)**2).sum(axis=-1)
+            self.bias = self.meanMod - self.meanObs
+            self.rmse = np.sqrt(sse/N)
+            self.crmse = np.sqrt(((mprime-oprime)**2).sum(axis=-1)/N)
+
+            self.skill = 1.0 - sse/(oprime**2).sum(axis=-1)
+            self.willmott = 1.0 - sse/((np.abs(np.where(mask,mod-self.meanObs[:,np.newaxis],0.))\
+                + np.abs(oprime))**2).sum(axis=-1)
+
+            self.cc = (mprime*oprime).sum(axis=-1)/N/(self.stdObs*self.stdMod)
+
+    def calcTideStats(self):
+        """
+        Harmonic fit of the model and observations for all stations
+
+        Solves the least-squares normal equations of every station at once
+        using only its valid points.
+        """
+        frq,self.frqnames = getTideFreq(Fin=self.frqnames)
+        self.frq = frq = np.asarray(frq)
+        nf = len(frq)
+        nff = 2*nf+1
+
+        A = np.ones((self.tobs.size,nff))
+        A[:,1::2] = np.cos(self.tobs[:,np.newaxis]*frq[np.newaxis,:])
+        A[:,2::2] = np.sin(self.tobs[:,np.newaxis]*frq[np.newaxis,:])
+
+        # Normal equations [Nstation, nff, nff]
+        AA = (A[:,:,np.newaxis]*A[:,np.newaxis,:]).reshape((-1,nff*nff))
+        M = self.mask.astype(np.float64).dot(AA).reshape((-1,nff,nff))
+
+        # Stations without enough points
+        bad = self.N < nff
+        M[bad,...] = np.eye(nff)
+
+        def fit(y):
+            b = np.linalg.solve(M,y.dot(A)[...,np.newaxis])[...,0]
+            C = b[:,1::2] + 1j*b[:,2::2]
+            C[bad,:] = np.nan
+            return np.abs(C), np.angle(C)
+
+        self.ampMod, self.phsMod = fit(self.ymod)
+        self.ampObs, self.phsObs = fit(self.yobs)
+
+        self.ampErr = self.ampMod - self.ampObs
+        self.phsErr = np.angle(np.exp(1j*(self.phsMod-self.phsObs)))
+        self.tidalRMSE = tidalrmse(self.ampObs,self.ampMod,self.phsObs,self.phsMod)
+
+    def columns(self):
+        """
+        Returns the column names and values of the statistics table
+        """
+        names = self.statnames[:]
+        values = [self[vv] for vv in self.statnames]
+        if not self.frqnames is None:
+            for vv in self.tidenames:
+                for ii,ff in enumerate(self.frqnames):
+                    names.append('%s_%s'%(vv,ff))
+                    values.append(self[vv][:,ii])
+
+        return names, values
+
+    def savetxt(self,csvfile):
+        """
+        Writes the statistics table to a csv file (one row per station)
+        """
+        names, values = self.columns()
+        f = open(csvfile,'w')
+        f.write('StationID,%s\n'%','.join(names))
+        for ii,sta in enumerate(self.stationids):
+            f.write('%s,%s\n'%(sta,','.join(['%g'%vv[ii] for vv in values])))
+        f.close()
+
+    def writeNC(self,ncfile):
+        """
+        Writes the statistics to a station-indexed netcdf file
+        """
+        from netCDF4 import Dataset
+
+        nc = Dataset(ncfile,'w',format='NETCDF4')
+        nc.Description = 'Model vs observation statistics'
+        nc.varname = self.varname
+        nc.units = self.units
+        nc.createDimension('station',self.Nstation)
+
+        tmp = nc.createVariable('StationID',str,('station',))
+        for ii,sta in enumerate(self.stationids):
+            tmp[ii] = sta
+        for vv in self.statnames:
+            tmp = nc.createVariable(vv,'f8',('station',))
+            tmp[:] = self[vv]
+
+        if not self.frqnames is None:
+            nc.createDimension('constituent',len(self.frqnames))
+            tmp = nc.createVariable('constituent',str,('constituent',))
+            for ii,ff in enumerate(self.frqnames):
+                tmp[ii] = ff
+            tmp = nc.createVariable('frequency','f8',('constituent',))
+            tmp.units = 'rad s-1'
+            tmp[:] = self.frq
+            for vv in self.tidenames:
+                tmp = nc.createVariable(vv,'f8',('station','constituent'))
+                if vv[0:3]=='phs':
+                    tmp.units = 'radians'
+                tmp[:] = self[vv]
+
+        nc.close()
+
+    def __getitem__(self,y):
+        return self.__dict__.__getitem__(y)
+
 def harmonic_fit(t,X,frq,mask=None,axis=0,phsbase=None):
     """
     Least-squares harmonic fit on an array, X, with frequencies, frq. 
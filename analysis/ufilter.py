@@ -9,6 +9,7 @@ Created on Tue Dec 18 13:19:39 2012
 
 import numpy as np
 from scipy import spatial, sparse
+import os
 
 import pdb
 
@@ -19,7 +20,8 @@ class ufilter(object):
     
     c = 4. # uses point c x p for filter
     filtertype = 'gaussian' # 'gaussian' or 'lanczos'
-    kmax = 50 # Maximum number of points to use in filter matrix
+    kmax = 50 # Maximum number of points to use in filter matrix (None uses all points within c x p)
+    filterfile = None # .npz file to load the filter matrix from (or save it to)
     
     def __init__(self,X,delta_f,**kwargs):
         
@@ -37,13 +39,32 @@ class ufilter(object):
         
         self.GetP()
         
-        self.BuildFilterMatrix2()
+        # np.savez appends .npz to the file name
+        if not self.filterfile is None and not self.filterfile.endswith('.npz'):
+            self.filterfile += '.npz'
+            
+        if not self.filterfile is None and os.path.exists(self.filterfile):
+            self.loadFilter(self.filterfile)
+        else:
+            self.BuildFilterMatrix2()
+            if not self.filterfile is None:
+                self.saveFilter(self.filterfile)
         
     def __call__(self,y):
         """
         Performs the filtering operation on data in vector y
+
+        y can be a stack of fields e.g. [Nt,Nk,Nc]. The last axis is filtered
+        with a single sparse product.
         """
-        return self.G*y
+        y = np.asarray(y)
+        if y.ndim==1:
+            return self.G.dot(y)
+
+        sz = y.shape
+        out = self.G.dot(y.reshape((-1,sz[-1])).T).T
+
+        return out.reshape(sz)
         
     def BuildFilterMatrix(self):
         """
@@ -84,60 +105,76 @@ class ufilter(object):
         Builds a sparse matrix, G, used to filter data in vector, y, via:
             y_filt = G x y
         
-        Vectorized version of the above
+        Vectorized version of the above. The matrix is assembled directly in
+        CSR format from a single KD-tree query of all points.
         """
         # Compute the spatial tree
         kd = spatial.cKDTree(self.X)
         eps=1e-6
 
-        # Initialise the sparse matrix
-        self.G = sparse.lil_matrix((self.n,self.n))
-        
         # Find all of the points within c * p distance from point
+        if self.kmax is None:
+            # Ball query (no limit on the number of points)
+            kdeps = spatial.cKDTree(self.X+eps)
+            D = kdeps.sparse_distance_matrix(kd,self.c*self.p,output_type='ndarray')
+            order = np.lexsort((D['v'],D['i']))
+            rows = D['i'][order]
+            i = D['j'][order]
+            dx = D['v'][order]
+            count = np.bincount(rows,minlength=self.n)
+        else:
+            dx, i = kd.query(self.X+eps,k=self.kmax,distance_upper_bound=self.c*self.p)
+            if self.kmax==1:
+                dx = dx[:,np.newaxis]
+                i = i[:,np.newaxis]
+
+            # Only keep the values inside of the range
+            ind = ~np.isinf(dx)
+            count = ind.sum(axis=1)
+            rows = np.repeat(np.arange(self.n),count)
+            dx = dx[ind]
+            i = i[ind]
 
-        dx, i = kd.query(self.X+eps,k=self.kmax,distance_upper_bound=self.c*self.p)
-        
-        ind = np.isinf(dx)
         # Calculate the filter weights
         if self.filtertype=='gaussian':
             Gtmp = self.Gaussian(dx)
         elif self.filtertype=='lanczos':
             Gtmp = self.Lanczos(dx)
         
-        # Set the weighting to zero for values outside of the range
-        Gtmp[ind]=0
-        i[ind]=0
-        
         # Normalise the filter weights
-        sumG = np.sum(Gtmp,axis=1)
-        Gout = [Gtmp[ii,:]/G for ii, G in enumerate(sumG)]
+        sumG = np.bincount(rows,weights=Gtmp,minlength=self.n)
+        Gtmp = Gtmp/sumG[rows]
+
+        indptr = np.zeros((self.n+1,),dtype=int)
+        indptr[1:] = np.cumsum(count)
+        self.G = sparse.csr_matrix((Gtmp,i,indptr),shape=(self.n,self.n))
+        self.G.sort_indices()
+
+    def saveFilter(self,filterfile):
+        """
+        Save the filter matrix to a numpy .npz file
+        """
+        print 'Saving filter matrix to: %s'%filterfile
+        np.savez(filterfile,data=self.G.data,indices=self.G.indices,\
+            indptr=self.G.indptr,shape=np.array(self.G.shape),\
+            delta_f=self.delta_f,c=self.c,filtertype=self.filtertype,\
+            kmax=-1 if self.kmax is None else self.kmax)
+
+    def loadFilter(self,filterfile):
+        """
+        Load the filter matrix from a numpy .npz file
+        """
+        print 'Loading filter matrix from: %s'%filterfile
+        op = np.load(filterfile)
+        kmax = None if op['kmax']==-1 else int(op['kmax'])
+        if tuple(op['shape'])!=(self.n,self.n) or op['delta_f']!=self.delta_f \
+            or op['c']!=self.c or str(op['filtertype'])!=self.filtertype \
+            or kmax!=self.kmax:
+            raise Exception, 'filter in %s does not match the points and parameters'%filterfile
+
+        self.G = sparse.csr_matrix((op['data'],op['indices'],op['indptr']),\
+            shape=(self.n,self.n))
 
-        
-        for nn,gg in enumerate(Gout):
-            self.G[nn,i[nn,:]]=gg
-            
-#        ind = [nn*self.n + i[nn,:] for nn,G in enumerate(G)]
-#        ind = np.array(ind)
-#        G=np.array(G)
-#        pdb.set_trace()
-#        self.G[ind.ravel()] = G.ravel()
-
-#        N = [nn + i[nn,:]*0 for nn,G in enumerate(G)]
-#        N = np.array(N)
-#        G=np.array(G)
-#        self.G[N,i]=G
-         
-        #[self.G[nn,i[nn,:]] for nn,G in enumerate(tmp)]
-            
-#        # Calculate the filter weights on these points
-#        ind = dx != np.inf
-#        Gtmp = self.Gaussian(dx[ind])
-#        
-#        # Insert the points into the sparse matrix
-#        I = i[ind]
-#        self.G[nn,I] = Gtmp
-#        #self.G[nn,I] = dx[ind] # testing
- 
     def GetP(self):
         """
         Calculate the 'p' parameter
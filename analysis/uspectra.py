@@ -30,7 +30,7 @@ class uspectra(object):
         Object for performing uneven spectra operations on a dataset
     """
     # Properties
-    method = 'lsq' # 'lsq' - least squares method; 'lomb' - Lomb-Scargle method; 'lsqfast' - faster the lsq but uses more memory
+    method = 'lsq' # 'lsq' - least squares method; 'lomb' - Lomb-Scargle method; 'lsqfast' - faster the lsq but uses more memory; 'lombfast' - O(N log N) Lomb-Scargle
     nfft = None # Number of bands
     frq = None # 2*np.pi*np.array([10.0]) #None # Angular frequency bands (2*pi/f)    
     verbose = False
@@ -80,12 +80,15 @@ class uspectra(object):
                 self.C = lstsqfft(self.t0,self.y.copy()*self.w_n,self.frq)
                 
             self.C= np.ravel(self.C)
-        elif self.method=='lomb':
+        elif self.method in ['lomb','lombfast']:
             # Lomb scargle method
             self.N = len(self.t)    
             self.getWindow()
             
-            self.C, self.frq, wk2,phs = lspr(self.t0,self.y.copy()*self.w_n,ofac=2.0,verbose=self.verbose)
+            if self.method == 'lomb':
+                self.C, self.frq, wk2,phs = lspr(self.t0,self.y.copy()*self.w_n,ofac=2.0,verbose=self.verbose)
+            else:
+                self.C, self.frq, wk2,phs = lsprfast(self.t0,self.y.copy()*self.w_n,ofac=2.0)
             self.frq *= 2.0*np.pi
             
             # Convert the power amplitude to spectral amp
@@ -774,4 +777,91 @@ def lspr(x,y,ofac=4.0,hifac=1,verbose=True):
     #Fxr=flipud(Fx); Fxr(1)=[];  
     #Fyr=flipud(Fy); Fyr(1)=[];
     #complex Fourier spectrum which corresponds to the Lomb-Scargle periodogram: 
-    #F=[complex(ave,0)' complex(Fx,Fy)' complex(Fxr,-Fyr)'];  
\ No newline at end of file
+    #F=[complex(ave,0)' complex(Fx,Fy)' complex(Fxr,-Fyr)'];
+
+def lsprfast(x,y,ofac=4.0,hifac=1,macc=4):
+    """
+    Fast Lomb-Scargle periodogram (Press and Rybicki, ApJ 338, 277-280, 1989)
+
+    Returns the same outputs as lspr. The trigonometric sums at all of the
+    frequencies are computed with FFTs after "extirpolating" the data onto
+    a regular grid with macc-point Lagrange weights, so the cost is
+    O(N log N) instead of O(N x nout).
+    """
+    xstart=x[0]
+    x=x-xstart
+
+    twopi=6.2831853071795865
+    n=len(x)
+    nout=int(0.5*ofac*hifac*n)
+
+    ave=np.mean(y)
+    vari=np.var(y)
+    yy = y-ave
+
+    xmax=np.max(x)
+    xmin=np.min(x)
+    xdif=xmax-xmin
+    xave=0.5*(xmax+xmin)
+
+    # Size of the FFT
+    nfreq = 64
+    while nfreq < ofac*hifac*n*macc:
+        nfreq *= 2
+    ndim = 2*nfreq
+
+    # Extirpolate the data and the weights (the latter at twice the frequency)
+    fac = ndim/(xdif*ofac)
+    ck = np.mod((x-xmin)*fac,ndim)
+    wk1 = extirpolate(yy,ck,ndim,macc)
+    wk2 = extirpolate(np.ones((n,)),np.mod(2.0*ck,ndim),ndim,macc)
+
+    # Sums of yy*exp(i*w*(x-xave)) and exp(2*i*w*(x-xave)) at each frequency
+    k = np.arange(1,nout+1)
+    px = k/(xdif*ofac)
+    shift = np.exp(-1j*np.pi*k/ofac) # exp(-i*w*(xave-xmin))
+    Sy = np.conj(np.fft.rfft(wk1)[1:nout+1])*shift
+    S2 = np.conj(np.fft.rfft(wk2)[1:nout+1])*shift**2
+
+    wtau = 0.5*np.arctan2(S2.imag,S2.real)
+    cwtau = np.cos(wtau)
+    swtau = np.sin(wtau)
+    c2 = np.cos(2*wtau)*S2.real + np.sin(2*wtau)*S2.imag
+    sumc = 0.5*(n + c2)
+    sums = 0.5*(n - c2)
+    sumcy = cwtau*Sy.real + swtau*Sy.imag
+    sumsy = cwtau*Sy.imag - swtau*Sy.real
+
+    iy = sumsy/np.sqrt(sums) # imaginary part of Lomb-Scargle spectral component
+    ry = sumcy/np.sqrt(sumc) # real part
+    py = 0.5*(ry**2+iy**2)/vari # power
+
+    # FFT phase from the Lomb-Scargle phase (see lspr)
+    phLS = np.arctan2(iy,ry)
+    ph = np.mod(phLS + twopi*(xave+xstart)*px + wtau, twopi)
+    ph1 = np.mod(phLS + twopi*xave*px + wtau, twopi)
+
+    dim=2*nout + 1.0
+    fac=np.sqrt(vari*dim/2.0)
+    a=fac*np.sqrt(py)
+
+    return a*np.cos(ph1) + 1j*a*np.sin(ph1), px, py, ph
+
+def extirpolate(y,x,n,macc=4):
+    """
+    Spreads the values y at fractional positions x onto a periodic grid of
+    n points with macc-point Lagrange weights, such that
+        sum(y*f(x)) ~= sum(grid*f(arange(n)))
+    for smooth functions f
+    """
+    nodes = np.floor(x).astype(int)[:,np.newaxis] - (macc-1)//2 + np.arange(macc)
+    d = x[:,np.newaxis] - nodes
+
+    w = np.ones(d.shape)
+    for jj in range(macc):
+        for kk in range(macc):
+            if not kk==jj:
+                w[:,jj] *= d[:,kk]/(jj-kk)
+
+    return np.bincount(np.mod(nodes,n).ravel(),weights=(w*y[:,np.newaxis]).ravel(),\
+        minlength=n)  
\ No newline at end of file
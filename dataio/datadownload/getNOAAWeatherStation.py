@@ -27,13 +27,14 @@ from ftplib import FTP
 import gzip
 from datetime import datetime
 import os
+from multiprocessing import Pool
 import airsea
 import netcdfio
 
 import pdb
 
 
-def noaaish2nc(latlon,yearrange,localdir,ncfile,shpfile):
+def noaaish2nc(latlon,yearrange,localdir,ncfile,shpfile,nprocs=1):
     
     """ Reads in the noaa data and spits it out to a netcdf file"""
     
@@ -42,7 +43,7 @@ def noaaish2nc(latlon,yearrange,localdir,ncfile,shpfile):
     timestart=yearrange[0]
     timeend=yearrange[1]
 
-    data = readall(latlon,[timestart,timeend],localdir) 
+    data = readall(latlon,[timestart,timeend],localdir,nprocs=nprocs) 
     
     data = dataQC(data,varnames)
        
@@ -82,8 +83,11 @@ def noaaish2nc(latlon,yearrange,localdir,ncfile,shpfile):
     return ncdict
     
     
-def readall(latlon,yearrange,localdir):
-    """ Main function for reading in the ISH file data"""
+def readall(latlon,yearrange,localdir,nprocs=1):
+    """ Main function for reading in the ISH file data
+    
+    The files are read on a pool of nprocs processes
+    """
     
     # Connect to the ftp server
     ftpdir = '/pub/data/noaa/'
@@ -101,11 +105,10 @@ def readall(latlon,yearrange,localdir):
 
     
     # Loop through and check if the files are in the local directory, if not download
-    data_all = []
-    for dd in stations:
-        kk=0
+    args = []
+    ista = []
+    for ii,dd in enumerate(stations):
         for yy, ff in zip(dd['years'],dd['filenames']):
-            kk+=1
             # Check if the file exists locally
             if ff in localfiles:
                 print 'File found locally: %s' % ff
@@ -123,32 +126,35 @@ def readall(latlon,yearrange,localdir):
 		    print '!!File not found on the ftp server!!'
 		    continue
             
-           
-            if kk == 1:
-                 # Now read the data
-                 data = ishData2struct(gzfile,dd['station_id'],dd['station_name'])
-            else:
-                # Now read the data
-                datanew = ishData2struct(gzfile,dd['station_id'],dd['station_name'])
-                # Append the time series for each station
-                data['Tair']['Data']=data['Tair']['Data']+datanew['Tair']['Data']
-                data['Tair']['Time']=data['Tair']['Time']+datanew['Tair']['Time']
-                data['Pair']['Data']=data['Pair']['Data']+datanew['Pair']['Data']
-                data['Pair']['Time']=data['Pair']['Time']+datanew['Pair']['Time']
-                data['Uwind']['Data']=data['Uwind']['Data']+datanew['Uwind']['Data']
-                data['Uwind']['Time']=data['Uwind']['Time']+datanew['Uwind']['Time']
-                data['Vwind']['Data']=data['Vwind']['Data']+datanew['Vwind']['Data']
-                data['Vwind']['Time']=data['Vwind']['Time']+datanew['Vwind']['Time']
-                data['RH']['Data']=data['RH']['Data']+datanew['RH']['Data']
-                data['RH']['Time']+=datanew['RH']['Time']
-                data['rain']['Data']+=datanew['rain']['Data']
-                data['rain']['Time']+=datanew['rain']['Time']
-                data['cloud']['Data']+=datanew['cloud']['Data']
-                data['cloud']['Time']+=datanew['cloud']['Time']
+            args.append((gzfile,dd['station_id'],dd['station_name']))
+            ista.append(ii)
+    
+    # Now read the data
+    if nprocs>1:
+        pool = Pool(nprocs)
+        datafiles = pool.map(_ishData2structWorker,args)
+        pool.close()
+        pool.join()
+    else:
+        datafiles = map(_ishData2structWorker,args)
+    
+    # Append the time series for each station
+    varnames = ['Tair','Pair','Uwind','Vwind','RH','rain','cloud']
+    data_all = []
+    for ii,datanew in zip(ista,datafiles):
+        if len(data_all)==0 or not ii==iiold:
+            data_all.append(datanew)
+        else:
+            data = data_all[-1]
+            for vv in varnames:
+                data[vv]['Data']+=datanew[vv]['Data']
+                data[vv]['Time']+=datanew[vv]['Time']
+        iiold = ii
             
-        data_all.append(data)
     return data_all
     
+def _ishData2structWorker(args):
+    return ishData2struct(*args)
              
 def stationMeta(csvfile = "isd-history.csv"):
     """
@@ -457,62 +463,59 @@ def checkMissingVal(data,missingval,tol=1e-3):
         return data
 
 # end of function
-def readRawGZdata(gzfile):
+# Mandatory data section fields: (name, start, end, scale factor, missing value)
+ishfields = [('lat',28,34,1000.,None),\
+    ('lon',34,41,1000.,None),\
+    ('ele',46,51,1.,None),\
+    ('winddir',60,63,1.,999.0),\
+    ('windspd',65,69,10.,999.9),\
+    ('airtemp',87,92,10.,999.9),\
+    ('airdewpoint',93,98,10.,999.9),\
+    ('airpres',99,104,10.,9999.9),\
+    ]
+
+def readISH(gzfile):
+    """
+    Read an ISH gz file into a record array with the time (minutes since
+    1970-01-01) and the mandatory data fields. Missing values are NaN.
+    
+    Also returns a list with the additional data of each line (see parseAddData)
     """
-    Read the GZ raw format here
-    """    
     f = gzip.open(gzfile, 'rb')
-    ishdata=[] # Store all of the raw data as a list of dictionaries
-    for line in f.readlines():
-        
-        data={}
-        # Parse the line here
-        tvc = int(line[0:4]) # total variable character
-        recl = tvc-108 # Record length of the additional data
-        data['yyyymmdd'] = line[15:23]
-        data['hhmm'] = line[23:27]
-        data['lat'] = float(line[28:34])/1000
-        data['lon'] = float(line[34:41])/1000
-        data['ele'] = float(line[46:51])
-        data['winddir'] = float(line[60:63]) # degrees
-        data['windspd'] = float(line[65:69])/10 # m/s
-        data['airtemp'] = float(line[87:92])/10 # degC
-        data['airdewpoint'] = float(line[93:98])/10 # degC
-        data['airpres'] = float(line[99:104])/10 # hPa
-        
+    lines = f.read().splitlines()
+    f.close()
+    
+    N = len(lines)
+    chars = np.array(lines,dtype='S108').view('S1').reshape((N,108))
+    
+    def field(i1,i2,dtype=np.float64):
+        return chars[:,i1:i2].copy().view('S%d'%(i2-i1)).ravel().astype(dtype)
+    
+    ishdata = np.zeros((N,),dtype=[('time',np.float64)]+[(ff[0],np.float64) for ff in ishfields])
+    
+    # Convert the time to minutes since 1970
+    t = (field(15,19,int)-1970).astype('datetime64[Y]').astype('datetime64[M]')\
+        + (field(19,21,int)-1).astype('timedelta64[M]')
+    t = t.astype('datetime64[D]') + (field(21,23,int)-1).astype('timedelta64[D]')
+    ishdata['time'] = t.astype(np.int64)*1440 + field(23,25,int)*60 + field(25,27,int)
+    
+    for name,i1,i2,scale,missingval in ishfields:
+        ishdata[name] = field(i1,i2)/scale
         # Replace missing values with nans
-        data['winddir'] = checkMissingVal(data['winddir'],999.0)
-        data['windspd'] = checkMissingVal(data['windspd'],999.9)
-        data['airtemp'] = checkMissingVal(data['airtemp'],999.9)
-        data['airdewpoint'] = checkMissingVal(data['airdewpoint'],999.9)
-        data['airpres'] = checkMissingVal(data['airpres'],9999.9)
-
-        
-        lineadd =  line[108:] # Additional variable data
-        # Parse the additional data string
-        addldata = parseAddData(lineadd,recl)
-        
-        # Append the additional data to the dictionary
-        data.update(addldata)
-        ishdata.append(data)
+        if not missingval is None:
+            ishdata[name][np.abs(ishdata[name]-missingval)<=1e-3] = np.nan
+    
+    # Parse the additional data strings
+    addldata = []
+    for line in lines:
+        if len(line)>108:
+            addldata.append(parseAddData(line[108:],int(line[0:4])-108))
+        else:
+            addldata.append({})
+    
+    return ishdata, addldata
     
-    f.close()
-    return ishdata
-
  
-def returnHumidity(dd):
-    """ Returns humidity data if it exists in the dictionary"""
-    rh = []
-    if dd.has_key('RH'):
-        rh = dd['RH']
-    elif dd.has_key('RH1'):
-        rh = dd['RH1']
-    else:
-        # Convert the dew point temperature to relative humidity
-        Pmb = dd['airpres']/10 # hPa to mb
-        rh = airsea.relHumFromTdew(dd['airtemp'],dd['airdewpoint'],Pmb)
-    return rh        
-        
 def returnRainfall(dd):
     """Returns rainfall data in units kg/m2/s"""
     rho_fresh = 1000 # freshwater density
@@ -562,7 +565,7 @@ def ishData2struct(gzfile,station_id,station_name):
     
     print 'Reading ISH gz file: %s...' % gzfile
        
-    ishdata = readRawGZdata(gzfile)
+    ishdata, addldata = readISH(gzfile)
     
     # Create the base structure (dictionary)
     station={}
@@ -578,66 +581,57 @@ def ishData2struct(gzfile,station_id,station_name):
     station['cloud'] = {'Data':[],'Time':[],'Units':'dimensionless','Longname':'Cloud cover fraction','TimeUnits':'minutes since 1970-01-01 00:00:00'}
     station['rain'] = {'Data':[],'Time':[],'Units':'kg m2 s-1','Longname':'rain fall rate','TimeUnits':'minutes since 1970-01-01 00:00:00'}
     
-    # Loop through the ishdata
-    ii=0
-    basetime = datetime(1970,1,1)
-    for dd in ishdata:
-        if ii == 0:
-            station['Latitude'] = dd['lat']
-            station['Longitude'] = dd['lon']
-        # Convert the time to a suitable time format
-        t = datetime.strptime(dd['yyyymmdd']+dd['hhmm'],'%Y%m%d%H%M')
-        dt = t-basetime
-        tobs = dt.total_seconds()/60.0
-        #       tobs = (t.toordinal()-basetime.toordinal())*1440.0
-        
-        # Check for missing values here
-        
-        # Append the required data fields
-        station['Tair']['Data'].append(dd['airtemp'])
-        station['Tair']['Time'].append(tobs)
-        if ii == 0:
-            station['Tair']['Height'] = dd['ele']
-            
-        station['Pair']['Data'].append(dd['airpres'])
-        station['Pair']['Time'].append(tobs)
-        if ii == 0:
-            station['Pair']['Height'] = dd['ele']
+    tobs = ishdata['time'].tolist()
+    if ishdata.size > 0:
+        # Coordinates of the last record
+        station['Latitude'] = ishdata['lat'][-1]
+        station['Longitude'] = ishdata['lon'][-1]
+        for vv in ['Tair','Pair','Uwind','Vwind','RH']:
+            station[vv]['Height'] = ishdata['ele'][-1]
+    
+    station['Tair']['Data'] = ishdata['airtemp'].tolist()
+    station['Tair']['Time'] = tobs
+    station['Pair']['Data'] = ishdata['airpres'].tolist()
+    station['Pair']['Time'] = list(tobs)
+    
+    spd = ishdata['windspd'].copy()
+    dirn = ishdata['winddir'].copy()
+    with np.errstate(invalid='ignore'):
+        spd[spd>=999] = np.nan
+        dirn[dirn>=999] = np.nan
+    # Note the flip of direction to go to cartesian vectors
+    theta = np.mod(dirn-180,360)
+    Uwind, Vwind = compass2cart(theta,spd)
+    station['Uwind']['Data'] = Uwind.tolist()
+    station['Uwind']['Time'] = list(tobs)
+    station['Vwind']['Data'] = Vwind.tolist()
+    station['Vwind']['Time'] = list(tobs)
+    
+    # Convert the dew point temperature to relative humidity
+    rh = airsea.relHumFromTdew(ishdata['airtemp'],ishdata['airdewpoint'],ishdata['airpres']/10)
+    
+    # Variables in the additional data section
+    for ii,dd in enumerate(addldata):
+        if len(dd)==0:
+            continue
         
-        if np.size(dd['windspd']) == np.size(dd['winddir']):
-            spd=dd['windspd']
-            if spd >= 999: spd=np.NaN
-            dirn=dd['winddir']
-            if dirn >= 999: dirn=np.NaN
-            # Note the flip of direction to go to cartesian vectors
-            theta = np.mod(dirn-180,360)
-            [Uwind,Vwind] = airsea.convertSpeedDirn(theta,spd)
-            station['Uwind']['Data'].append(Uwind)
-            station['Uwind']['Time'].append(tobs)
-            if ii == 0:
-                station['Uwind']['Height'] = dd['ele']
-            
-            station['Vwind']['Data'].append(Vwind)
-            station['Vwind']['Time'].append(tobs)
-            if ii == 0:
-                station['Vwind']['Height'] = dd['ele']
-            
-        rh = returnHumidity(dd)     
-        if np.size(rh) > 0:
-           station['RH']['Data'].append(rh)
-           station['RH']['Time'].append(tobs)
-        if ii == 0:
-            station['RH']['Height'] = dd['ele']
+        if dd.has_key('RH'):
+            rh[ii] = dd['RH']
+        elif dd.has_key('RH1'):
+            rh[ii] = dd['RH1']
            
         rain = returnRainfall(dd)
         if np.size(rain) > 0:
            station['rain']['Data'].append(rain)
-           station['rain']['Time'].append(tobs)
+           station['rain']['Time'].append(tobs[ii])
                
         cloud = returnCloudCover(dd)
         if np.size(cloud) > 0:
             station['cloud']['Data'].append(cloud)
-            station['cloud']['Time'].append(tobs)
+            station['cloud']['Time'].append(tobs[ii])
+    
+    station['RH']['Data'] = rh.tolist()
+    station['RH']['Time'] = list(tobs)
         
     # Print a summary
     print 'File Summary:'
@@ -652,6 +646,21 @@ def ishData2struct(gzfile,station_id,station_name):
         
     return station
 # End of function    
+def compass2cart(theta,spd):
+    """
+    Convert speed and direction (degrees North) arrays into u and v (see
+    airsea.convertSpeedDirn)
+    """
+    theta = theta.copy()
+    with np.errstate(invalid='ignore'):
+        idx1 = (theta>=0.) & (theta<90.)
+        idx2 = (theta>=90.) & (theta<=360.)
+    theta[idx1] = np.abs(theta[idx1]-90.)
+    theta[idx2] = np.abs(450.-theta[idx2])
+    
+    th = theta*np.pi/180
+    return spd*np.cos(th), spd*np.sin(th)
+    
 def getFileNames(latlon,yearrange,localdir):
     """ 
     Function to retrieve station names to download from the ftp site (see ftplib.retrievefile)
@@ -146,12 +146,14 @@ def get_metocean_dap(xrange,yrange,zrange,trange,outfile,\
 
 
 def get_metocean_local(ncfile,varname,name='HYCOM',TDS=None,\
-        xrange=None,yrange=None,zrange=None,trange=None):
+        xrange=None,yrange=None,zrange=None,trange=None,tindex=None):
     """
     Retrieves variable data from a local file
 
     Use common name for variable i.e. u,v,temp,tair,uwind, etc
 
+    Set tindex=(t1,t2) to read the time steps t1:t2 only (overrides trange)
+
     Returns: data, ncobject (containing coordinates, etc)
 
     This is sort of a long way around but is general
@@ -171,10 +173,41 @@ def get_metocean_local(ncfile,varname,name='HYCOM',TDS=None,\
     ncobj = getattr(TDS,'_%s'%varname)
 
     # Call the object
-    data = ncobj.get_data(ncvar,xrange,yrange,zrange,trange)
+    if tindex is None:
+        data = ncobj.get_data(ncvar,xrange,yrange,zrange,trange)
+    else:
+        ncobj.get_indices(xrange,yrange,zrange)
+        ncobj.get_time_indices(None)
+        ncobj.t1,ncobj.t2 = tindex
+        ncobj.nt = ncobj.t2 - ncobj.t1
+        ncobj.localtime = ncobj.time[ncobj.t1:ncobj.t2]
+        data = ncobj.get_data_singlefile(ncvar,ncobj._nc,ncobj.t1,ncobj.t2)
 
     return data, ncobj
 
+def open_metocean_local(ncfile,varnames,name='HYCOM'):
+    """
+    Opens a local file once to read several variables in time chunks
+
+    Returns the GetDAP object with the indices of each variable set for the
+    full domain/time. Read time steps t1:t2 of a variable with:
+        ncobj = getattr(TDS,'_%s'%varname)
+        data = ncobj.get_data_singlefile(getattr(TDS,varname),TDS._nc,t1,t2)
+
+    and close the file with TDS._nc.close()
+    """
+    oceandict = metoceandict[name].copy()
+    oceandict['ncurl'] = ncfile
+    if oceandict.has_key('multifile'):
+        oceandict['multifile'] = False
+
+    TDS = GetDAP(vars=varnames,**oceandict)
+    for vv in varnames:
+        ncobj = getattr(TDS,'_%s'%vv)
+        ncobj.get_indices(None,None,None)
+        ncobj.get_time_indices(None)
+
+    return TDS
 
 def get_gfs_tds(xrange,yrange,zrange,trange,outfile):
     """
@@ -21,6 +21,14 @@ from datetime import datetime
 import matplotlib.dates as dates
 import matplotlib.pyplot as plt
 
+# Observation database table
+tablename = 'observations'
+tablefields = ['NetCDF_Filename','NetCDF_GroupID','Variable_Name','X','Y'\
+    ,'lon_start','lon_end','lat_start','lat_end','time_start','time_end','height_start',\
+    'height_end','StationName','StationID','GEOMETRY']
+fieldtype = ['text','text','text','real','real','real','real','real','real',\
+    'text','text','real','real','text','text','text']
+
 def writePointData2Netcdf(ncfile,data,globalatts):
     """ 
     Function for writing point/observation data to a grouped netcdf file.
@@ -174,17 +182,23 @@ def createObsDB(dbfile):
 #    'lon_end':'real','lat_start':'real','lat_end':'real',\
 #    'time_start':'text','time_end':'text','height_start':'real',\
 #    'height_end':'real','StationName':'text','StationID':'text'}
-    tablefields = ['NetCDF_Filename','NetCDF_GroupID','Variable_Name','X','Y'\
-    ,'lon_start','lon_end','lat_start','lat_end','time_start','time_end','height_start',\
-    'height_end','StationName','StationID','GEOMETRY']
-    fieldtype = ['text','text','text','real','real','real','real','real','real',\
-    'text','text','real','real','text','text','text']
-
     
-    tablename = 'observations'
+    createObsTable(c)
     
+    createObsIndex(conn)
+    conn.commit()
+    
+    c.close()
+    conn.close()
+    return  
+
+def createObsTable(c):
+    """
+    Create the observations table with an explicit integer primary key, id
+    (unlike the implicit rowid it is not renumbered by VACUUM)
+    """
     # Create a string to create the table
-    tablestr='('
+    tablestr='(id INTEGER PRIMARY KEY,'
     for ff,tt in zip(tablefields,fieldtype):
         tablestr += ff+' '+tt+','
     tablestr = tablestr[:-1] + ')'
@@ -192,23 +206,99 @@ def createObsDB(dbfile):
     print tablestr
     createstr = 'CREATE TABLE %s %s' % (tablename,tablestr)
     c.execute(createstr)
+
+def createObsIndex(conn):
+    """
+    Create the indexes on the observations table (if they don't exist)
+    
+    Indexes are on variable name and time range and an R-tree (table
+    observations_rtree) on the station lon/lat range. The R-tree is keyed
+    on the id column and kept up to date with triggers.
+    
+    Tables from older databases without an id column are rebuilt with one.
+    """
+    c = conn.cursor()
+    rtree = '%s_rtree'%tablename
+    
+    cols = [row[1] for row in c.execute('PRAGMA table_info(%s)'%tablename)]
+    if not 'id' in cols:
+        print 'Adding an id column to the %s table...'%tablename
+        c.execute('DROP TRIGGER IF EXISTS %s_insert'%rtree)
+        c.execute('DROP TRIGGER IF EXISTS %s_delete'%rtree)
+        c.execute('DROP TABLE IF EXISTS %s'%rtree)
+        c.execute('ALTER TABLE %s RENAME TO %s_old'%(tablename,tablename))
+        createObsTable(c)
+        fields = ', '.join(tablefields)
+        c.execute('INSERT INTO %s (%s) SELECT %s FROM %s_old'\
+            %(tablename,fields,fields,tablename))
+        c.execute('DROP TABLE %s_old'%tablename)
+    
+    c.execute('CREATE INDEX IF NOT EXISTS %s_var_time ON %s (Variable_Name, time_start, time_end)'\
+        %(tablename,tablename))
+    c.execute('CREATE INDEX IF NOT EXISTS %s_time ON %s (time_start, time_end)'\
+        %(tablename,tablename))
+    c.execute('CREATE INDEX IF NOT EXISTS %s_file ON %s (NetCDF_Filename)'\
+        %(tablename,tablename))
+    
+    c.execute('SELECT name FROM sqlite_master WHERE name = ?',(rtree,))
+    if c.fetchone() is None:
+        try:
+            c.execute('CREATE VIRTUAL TABLE %s USING rtree(id, minX, maxX, minY, maxY)'%rtree)
+        except sqlite3.OperationalError:
+            print 'Warning: sqlite has no R-tree support. Spatial queries will be slow.'
+            c.close()
+            return
         
+        c.execute('INSERT INTO %s SELECT id, lon_start, lon_end, lat_start, lat_end FROM %s'\
+            %(rtree,tablename))
+        c.execute('''CREATE TRIGGER %s_insert AFTER INSERT ON %s BEGIN
+            INSERT INTO %s VALUES (new.id, new.lon_start, new.lon_end, new.lat_start, new.lat_end);
+            END'''%(rtree,tablename,rtree))
+        c.execute('''CREATE TRIGGER %s_delete AFTER DELETE ON %s BEGIN
+            DELETE FROM %s WHERE id = old.id;
+            END'''%(rtree,tablename,rtree))
     
     c.close()
-    return  
     
 def netcdfObs2DB(ncfile,dbfile):
-    # Write metadata to the sql database
+    """
+    Write the metadata in a netcdf file (or list of files) to the sql database
+    
+    All rows are inserted in a single transaction
+    """
+    if not isinstance(ncfile,list):
+        ncfile = [ncfile]
     
     # Open the database
     conn = sqlite3.connect(dbfile)
-    c = conn.cursor()
-    tablename = 'observations'
+    createObsIndex(conn)
+    
+    for ff in ncfile:
+        insertObsDB(conn,netcdfObsRows(ff))
+    
+    # Save (commit) the changes
+    conn.commit()
+    conn.close()
+    return
+
+def insertObsDB(conn,rows):
+    """
+    Bulk insert rows (tuples ordered as tablefields) into the observations table
+    """
+    insertstr = 'INSERT INTO %s (%s) VALUES (%s)'%(tablename,', '.join(tablefields),\
+        ', '.join(['?']*len(tablefields)))
+    conn.executemany(insertstr,rows)
+
+def netcdfObsRows(ncfile):
+    """
+    Returns a list of database rows for each variable in a grouped netcdf file
+    """
+    rows = []
     
     # open the netcdf file
     nc = Dataset(ncfile,'r', format='NETCDF4')
     
-    # Loop through the groupsind = returnDictInd(ncdict,vv,sta)
+    # Loop through the groups
     for grp in nc.groups:
         # Loop through the variables
         for vv in nc.groups[grp].variables:
@@ -237,26 +327,16 @@ def netcdfObs2DB(ncfile,dbfile):
                     ele=[0.0]
                     
                 times = nc.groups[grp].variables['time']
-                dates = num2date(times[:],units=times.units)
+                dates = num2date(np.hstack((times[0],times[-1])),units=times.units)
                 
                 # Create the tuple to insert into the database
-                dbtuple = (ncfile,grp,vv,np.mean(lon),np.mean(lat),np.min(lon),np.max(lon),\
-                np.min(lat),np.max(lat),dates[0],dates[-1],np.min(ele),np.max(ele),StationName,StationID,'Point')
-                dbstr = '("%s", "%s", "%s", %4.6f, %4.6f, %4.6f, %4.6f, %4.6f, %4.6f, "%s", "%s", %4.6f, %4.6f, "%s", "%s","%s")'%dbtuple
-                # Insert into the db
-                #execstr = 'INSERT INTO %s VALUES %s'%(tablename,dbstr)
-                #print execstr
-                c.execute('INSERT INTO %s VALUES %s'%(tablename,dbstr))
-                # Save (commit) the changes
-                conn.commit()
-                
+                rows.append((ncfile,grp,vv,float(np.mean(lon)),float(np.mean(lat)),\
+                    float(np.min(lon)),float(np.max(lon)),float(np.min(lat)),float(np.max(lat)),\
+                    str(dates[0]),str(dates[-1]),float(np.min(ele)),float(np.max(ele)),\
+                    StationName,StationID,'Point'))
                 
-    # Insert a row of data
-    #c.execute("INSERT INTO stocks VALUES ('2006-01-05','BUY','RHAT',100,35.14)")
-    # Close everything                
     nc.close()
-    c.close()
-    return
+    return rows
 
 def returnGroup(ncfile,grpid):
     """ Return point data from a grouped netcdf file into a dictionary
@@ -301,12 +381,17 @@ def returnGroupFast(ncfile,grpid,nc):
     #nc.close()
     return output
     
-def returnQuery(dbfile,outvar,tablename,condition):
+def returnQuery(dbfile,outvar,tablename,condition,params=(),bbox=None):
     """Returns a dictionary with the fields specified in a query
     
     Example condition:
         'Variable_Name = "RH" and start_time >= "2011-01-01 00:00:00"'
+    or with parameters:
+        condition = 'Variable_Name = ? and time_end >= ?'
+        params = ('RH','2011-01-01 00:00:00')
     
+    Set bbox = [xmin,xmax,ymin,ymax] to only return stations within a box
+    (uses the R-tree, see createObsIndex)
     """    
     
     # Open the database
@@ -314,23 +399,22 @@ def returnQuery(dbfile,outvar,tablename,condition):
     c = conn.cursor()
     
     querystr = 'SELECT %s FROM %s WHERE %s'%(', '.join(outvar),tablename,condition)
+    if not bbox is None:
+        querystr += ' AND id IN (SELECT id FROM %s_rtree WHERE \
+            minX >= ? AND maxX <= ? AND minY >= ? AND maxY <= ?)'%tablename
+        params = tuple(params) + tuple(bbox)
     #print querystr
-    query = c.execute(querystr)
+    rows = c.execute(querystr,params).fetchall()
     
     output = {}
-    for vv in outvar:
-        output.update({vv:[]})
-    
+    for k,vv in enumerate(outvar):
+        output.update({vv:[row[k] for row in rows]})
     
-    for row in query:
-        k=-1
-        for vv in outvar:
-            k+=1
-            output[vv].append(row[k])
     c.close()
+    conn.close()
     return output
 
-def queryNC(dbfile,outvar,tablename,condition,fastmode=False):
+def queryNC(dbfile,outvar,tablename,condition,fastmode=False,params=(),bbox=None):
     """ Main function for extracting queried data for netcdf files
     
     Example inputs:
@@ -338,28 +422,26 @@ def queryNC(dbfile,outvar,tablename,condition,fastmode=False):
     outvar = ['NetCDF_Filename','NetCDF_GroupID']
     tablename = 'observations'
     condition = 'Variable_Name = "RH"'
+    
+    Each netcdf file is opened once. The data is returned in query order.
+    (fastmode is no longer needed and is ignored)
     """    
     # Get the query
-    query = returnQuery(dbfile,outvar,tablename,condition)
-    
-    data=[]
-    ii=-1
-    for ff,gg in zip(query['NetCDF_Filename'],query['NetCDF_GroupID']):
-        ii+=1
-        #print 'Extracting data from: %s, Group: %s...'%(ff,gg) 
-        if fastmode:
-            if ii == 0:
-                nc = Dataset(ff,'r', format='NETCDF4')
-                ffold = ff
-            if ffold != ff:
-                nc.close()
-                nc = Dataset(ff,'r', format='NETCDF4')
-                ffold = ff
-            data.append(returnGroupFast(ff,gg,nc))
-        else:
-            data.append(returnGroup(ff,gg))
-    if fastmode:
+    query = returnQuery(dbfile,outvar,tablename,condition,params=params,bbox=bbox)
+    
+    # Group the matches by file
+    files = {}
+    for ii,ff in enumerate(query['NetCDF_Filename']):
+        files.setdefault(ff,[]).append(ii)
+    
+    data=[None]*len(query['NetCDF_Filename'])
+    for ff in files.keys():
+        #print 'Extracting data from: %s...'%ff
+        nc = Dataset(ff,'r', format='NETCDF4')
+        for ii in files[ff]:
+            data[ii] = returnGroupFast(ff,query['NetCDF_GroupID'][ii],nc)
         nc.close()
+    
     return data, query
 
 def createObsDict(varname,longname,units,data,time,latitude,longitude,height,stationid,stationname,ncdict=[] ):
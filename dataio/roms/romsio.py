@@ -1581,11 +1581,6 @@ class roms_interp(ROMSGrid):
         # Initialise the output arrays @ roms time step
         zetaroms, temproms, saltroms, uroms, vroms = self.initArrays(self.Nt_roms,self.Nx,self.Nz)
         
-        tempold = np.zeros((self.Nz_roms,self.Nx))
-        saltold = np.zeros((self.Nz_roms,self.Nx))
-        uold = np.zeros((self.Nz_roms,self.Nx))
-        vold = np.zeros((self.Nz_roms,self.Nx))
-
         # Interpolate h
         h = self.Frho(self.h[self.mask_rho==1])
         
@@ -1599,20 +1594,12 @@ class roms_interp(ROMSGrid):
             if seth:
                 zetaroms[tstep,:] = self.Frho(self.zeta[self.mask_rho==1])
             
-            # Interpolate other 3D variables
-            for k in range(0,self.Nz_roms):
-                tmp = self.temp[k,:,:]
-                tempold[k,:] = self.Frho(tmp[self.mask_rho==1])
-                
-                tmp = self.salt[k,:,:]
-                saltold[k,:] = self.Frho(tmp[self.mask_rho==1])
-                
-                if setUV:
-                    tmp = self.u[k,:,:]
-                    uold[k,:] = self.Fuv(tmp[self.mask_uv==1])
-                    
-                    tmp = self.v[k,:,:]
-                    vold[k,:] = self.Fuv(tmp[self.mask_uv==1])
+            # Interpolate other 3D variables (all layers at once)
+            tempold = self.interpxy(self.Frho,self.temp,self.mask_rho)
+            saltold = self.interpxy(self.Frho,self.salt,self.mask_rho)
+            if setUV:
+                uold = self.interpxy(self.Fuv,self.u,self.mask_uv)
+                vold = self.interpxy(self.Fuv,self.v,self.mask_uv)
     
             # Calculate depths (zeta dependent)
             #zroms = get_depth(self.s_rho,self.Cs_r,self.hc, h, zetaroms[tstep,:], Vtransform=self.Vtransform)
@@ -1620,24 +1607,14 @@ class roms_interp(ROMSGrid):
 
     
             # Interpolate vertically
-            for ii in range(0,self.Nx):
-                y = tempold[:,ii]
-                Fz = interpolate.interp1d(zroms[:,ii],y,kind=zinterp,bounds_error=False,fill_value=y[0])
-                temproms[tstep,:,ii] = Fz(self.zi)
-                
-                y = saltold[:,ii]
-                Fz = interpolate.interp1d(zroms[:,ii],y,kind=zinterp,bounds_error=False,fill_value=y[0])
-                saltroms[tstep,:,ii] = Fz(self.zi)
-                
-                if setUV:
-                    y = uold[:,ii]
-                    Fz = interpolate.interp1d(zroms[:,ii],y,kind=zinterp,bounds_error=False,fill_value=y[0])
-                    uroms[tstep,:,ii] = Fz(self.zi)
-                    
-                    y = vold[:,ii]
-                    Fz = interpolate.interp1d(zroms[:,ii],y,kind=zinterp,bounds_error=False,fill_value=y[0])
-                    vroms[tstep,:,ii] = Fz(self.zi)
-                    
+            if setUV:
+                phi = np.array([tempold,saltold,uold,vold])
+                temproms[tstep,...],saltroms[tstep,...],uroms[tstep,...],vroms[tstep,...] =\
+                    interp_z(zroms,phi,self.zi,kind=zinterp)
+            else:
+                phi = np.array([tempold,saltold])
+                temproms[tstep,...],saltroms[tstep,...] =\
+                    interp_z(zroms,phi,self.zi,kind=zinterp)
                 
             # End time loop
         
@@ -1678,6 +1655,25 @@ class roms_interp(ROMSGrid):
             vout = vroms
         
         return zetaout, tempout, saltout, uout, vout
+
+    def interpxy(self,F,data,mask):
+        """
+        Horizontally interpolates all layers of a [Nk,Ny,Nx] array
+
+        Uses a single sparse matrix product when the interpolant has fixed
+        weights otherwise loops through the layers
+        """
+        W = F.getmatrix()
+        if W is None:
+            Nk = data.shape[0]
+            out = np.zeros((Nk,self.Nx))
+            for k in range(0,Nk):
+                tmp = data[k,:,:]
+                out[k,:] = F(tmp[mask==1])
+            return out
+
+        tmp = np.asarray(data[:,mask==1],dtype=np.float64)
+        return W.dot(tmp.T).T
         
     def initArrays(self,Nt,Nx,Nz):
         
@@ -1739,7 +1735,7 @@ def get_depth(S,C,hc,h,zeta=None, Vtransform=1):
     """
     Calculates the sigma coordinate depth
     """
-    if zeta == None:
+    if zeta is None:
         zeta = 0.0*h
         
     N = len(S)
@@ -1760,6 +1756,60 @@ def get_depth(S,C,hc,h,zeta=None, Vtransform=1):
     
     return z
         
+def interp_z(zin,phi,zout,kind='linear'):
+    """
+    Vertically interpolates a field from sigma levels onto z-levels
+
+    Inputs:
+        zin - [Nsigma,Np] depths increasing along the first axis
+        phi - [...,Nsigma,Np] values at zin
+        zout - [Nz,Np] or [Nz] output depths
+        kind - 'linear' or 'nearest' (vectorized), any other interp1d kind
+            is done column by column
+
+    Output points above the surface take the surface value and points below
+    the bed take the bottom value.
+
+    Returns phi at zout as a [...,Nz,Np] array
+    """
+    zin = np.asarray(zin)
+    phi = np.asarray(phi)
+    Ns,Np = zin.shape
+    zout = np.asarray(zout)
+    if zout.ndim == 1:
+        zout = zout[:,np.newaxis]*np.ones((1,Np))
+
+    # Clip the output depths to the water column for consistent extrapolation
+    zout = np.maximum(np.minimum(zout,zin[-1,:]),zin[0,:])
+
+    if kind not in ['linear','nearest']:
+        shp = phi.shape[:-2]
+        phi2 = phi.reshape((-1,Ns,Np))
+        out = np.zeros((phi2.shape[0],zout.shape[0],Np))
+        for ii in range(0,Np):
+            Fz = interpolate.interp1d(zin[:,ii],phi2[:,:,ii],axis=1,kind=kind)
+            out[:,:,ii] = Fz(zout[:,ii])
+        return out.reshape(shp+out.shape[1:])
+
+    if Ns == 1:
+        return phi[...,0:1,:]*np.ones(zout.shape)
+
+    # Index of the level below each output point
+    ind = np.zeros(zout.shape,np.int)
+    for k in range(0,Ns):
+        ind += zin[k,:] <= zout
+    ind = np.clip(ind-1,0,Ns-2)
+    col = np.arange(Np)[np.newaxis,:]
+
+    z0 = zin[ind,col]
+    dz = zin[ind+1,col] - z0
+    dz[dz==0] = 1.0
+    w = np.clip((zout-z0)/dz,0.,1.)
+    if kind == 'nearest':
+        w = np.round(w)
+
+    return phi[...,ind,col]*(1.-w) + phi[...,ind+1,col]*w
+        
 def rotateUV(uroms,vroms,ang):
     """
     Rotates ROMS output vectors to cartesian u,v
@@ -89,54 +89,12 @@ def interpWeatherStations(latlon,tstart,tend,dt,utmzone,dbfile, maxgap=40, showp
         data, query = netcdfio.queryNC(dbfile,outvar,tablename,condition)
         #print data[0].keys()
 
-        ii=0   
-        for dd in data:
-            ind = np.isfinite(np.ravel(dd[vv]))
-            timenow = convertTime(dd['time'])
-            timegood = timenow[ind]  
-            if nctime[0] <= timegood[0] or nctime[-1] >= timegood[-1]:
-                data.pop(ii) 
-            else:
-                ii+=1    
-
-        # Remove points that have large gaps
-        ii=0  
-
-        for dd in data:
-            ind = np.isfinite(dd[vv])
-            timenow = convertTime(dd['time'])
-            
-            i=-1
-            for t in timenow:
-                i+=1
-                if t < nctime[0]:
-                    t1=i
-                   
-            i=-1
-            for t in timenow:
-                i+=1
-                if t < nctime[-1]:
-                    t2=i
-                      
-            # Find the maximum gap size between the two time limits
-            gapsize = 0
-            gap=0
-            for gg in ind[t1:t2]:
-                if ~gg:
-                    gap+=1
-                    if gap > gapsize:
-                        gapsize=gap
-                else:
-                    gap = 0   
-            #print t1,t2,len(timenow),gapsize
-            if gapsize > maxgap:
-                print 'Removing data point - gap size %d is > %d'%(gapsize,maxgap)
-                data.pop(ii)
-            else:
-                ii+=1
-                
-            #print gapsize,percgood
-           
+        # Quality control, remove points that have large gaps and
+        # interpolate onto the time array (all stations at once)
+        times = [convertTime(dd['time']) for dd in data]
+        values = [np.ravel(dd[vv]) for dd in data]
+        keep, output[vv] = resampleStations(times,values,nctime,maxgap=maxgap)
+        data = [data[ii] for ii in keep]
 
         # Work out the number of spatial points of each variable based on quality control
         coords['x_'+vv] = []
@@ -153,45 +111,110 @@ def interpWeatherStations(latlon,tstart,tend,dt,utmzone,dbfile, maxgap=40, showp
             #coords['y_'+vv].append(dd['latitude'])
             coords['z_'+vv].append(dd['elevation'])
         
-        varlen = len(data)
-        
-        # Initialize the output arrays
-        output[vv] = {'Data':np.zeros((ntime,varlen))}
-        
-        # Loop trough and interpolate each variables onto the time array
-        ctr=0
-        for dd in data:
-            # Interpolate the data 
-            tmp = np.array(np.ravel(dd[vv]))
-            timenow = convertTime(dd['time'])
-            ind = np.isfinite(tmp)
-            F = interpolate.interp1d(timenow[ind],tmp[ind],kind='linear')
-            varinterp = F(nctime)
-            #F = interpolate.InterpolatedUnivariateSpline(timenow[ind],tmp[ind])
-            #varinterp = F(nctime)
-            #F = interpolate.splrep(timenow[ind],tmp[ind],s=0)
-            #varinterp = interpolate.splev(nctime,F,der=0)
-            #F = interpolate.Rbf(timenow[ind],tmp[ind])
-            #varinterp = F(nctime)
-            output[vv]['Data'][:,ctr]=varinterp
-            ctr+=1
-            
-            # Add the other info
-            #output[vv].update({'long_name':dd[vv]['Longname'],'units':dd[vv]['Units']})
-
-        
-            if showplot:
+        if showplot:
+            for ctr,ii in enumerate(keep):
                 plt.figure()
                 plt.hold('on')
-                plt.plot(timenow,tmp)
-                plt.plot(nctime,varinterp,'r')
-                plt.title(dd['StationName']+' - '+vv)
+                plt.plot(times[ii],values[ii])
+                plt.plot(nctime,output[vv]['Data'][:,ctr],'r')
+                plt.title(data[ctr]['StationName']+' - '+vv)
                 plt.show()
             
     # Return the data
     return coords, output, nctime
         
     
+def resampleStations(times,values,nctime,maxgap=40):
+    """
+    Linearly interpolate a set of station time series onto nctime
+    
+    Stations are removed if:
+        - the good data does not span nctime
+        - the largest run of missing (non-finite) samples within nctime is
+        greater than maxgap
+    
+    Inputs:
+        times, values - lists with the time and data arrays of each station
+        nctime - output time array (same units as times)
+    
+    Returns:
+        keep - indices of the stations that were kept
+        output - {'Data': [ntime x len(keep)] array}
+    """
+    ntime = nctime.shape[0]
+    nstation = len(times)
+    if nstation==0:
+        return np.array([],dtype=int), {'Data':np.zeros((ntime,0))}
+
+    # Concatenate all of the stations
+    n = np.array([np.size(tt) for tt in times])
+    start = np.hstack((0,np.cumsum(n)[:-1]))
+    sid = np.repeat(np.arange(nstation),n)
+    t = np.hstack(times).astype(np.float64)
+    y = np.hstack([np.ma.filled(np.ma.asarray(vv).astype(np.float64),np.nan) for vv in values])
+    good = np.isfinite(y)
+
+    # Index relative to the start of each station
+    ind = np.arange(t.shape[0]) - start[sid]
+
+    # Check the good data spans the time domain
+    ngood = np.bincount(sid[good],minlength=nstation)
+    tfirst = np.zeros((nstation,))+np.inf
+    tlast = np.zeros((nstation,))-np.inf
+    igood = np.flatnonzero(good)
+    # igood is sorted so the first/last good sample is the min/max
+    tlast[sid[igood]] = t[igood]
+    tfirst[sid[igood[::-1]]] = t[igood[::-1]]
+    keep = (ngood>1) & (tfirst<nctime[0]) & (tlast>nctime[-1])
+
+    # Find the maximum gap size between the two time limits: t1 and t2
+    # are the last samples before the start and end of nctime
+    t1 = np.zeros((nstation,),dtype=int)
+    t2 = np.zeros((nstation,),dtype=int)
+    ii = np.flatnonzero(t<nctime[0])
+    t1[sid[ii]] = ind[ii]
+    ii = np.flatnonzero(t<nctime[-1])
+    t2[sid[ii]] = ind[ii]
+
+    bad = ~good & (ind>=t1[sid]) & (ind<t2[sid]) & keep[sid]
+    # Length of the run of bad samples ending at each sample (the sample
+    # after t2 is never bad so runs can't cross stations)
+    c = np.cumsum(bad)
+    gap = c - np.maximum.accumulate(np.where(bad,0,c))
+    gapsize = np.zeros((nstation,),dtype=int)
+    np.maximum.at(gapsize,sid,gap)
+
+    for ii in np.flatnonzero(keep & (gapsize>maxgap)):
+        print 'Removing data point - gap size %d is > %d'%(gapsize[ii],maxgap)
+    keep = keep & (gapsize<=maxgap)
+    keep = np.flatnonzero(keep)
+    nkeep = keep.shape[0]
+
+    # Interpolate the good data of all stations at once. The stations are
+    # offset in time so that one search finds the interval of every output
+    # time at every station.
+    ii = good & np.in1d(sid,keep)
+    tg = t[ii]
+    yg = y[ii]
+    kg = np.searchsorted(keep,sid[ii])
+    ng = np.bincount(kg,minlength=nkeep)
+    startg = np.hstack((0,np.cumsum(ng)[:-1]))
+
+    if nkeep>0:
+        t0 = min(tg.min(),nctime[0])
+        span = 2*(max(tg.max(),nctime[-1]) - t0) + 1.
+        toff = tg - t0 + kg*span
+        tout = (nctime - t0)[np.newaxis,:] + np.arange(nkeep)[:,np.newaxis]*span
+        hi = np.searchsorted(toff,tout)
+        hi = np.clip(hi,startg[:,np.newaxis]+1,(startg+ng)[:,np.newaxis]-1)
+        lo = hi - 1
+        slope = (yg[hi] - yg[lo]) / (tg[hi] - tg[lo])
+        data = (slope*(nctime[np.newaxis,:] - tg[lo]) + yg[lo]).T
+    else:
+        data = np.zeros((ntime,0))
+
+    return keep, {'Data':data}
+    
 def dataQC(data,nctime,varnames):
     """ Perform basic quality control on the raw data pass
      # Checks:
@@ -386,13 +409,16 @@ def convertTime(timein,basetime = datetime(1990,1,1)):
     """
     Converts a list of time object into an array of seconds since "basetime"
     """
-
-    timeout=[]
-    for t in timein:
-        dt = t - basetime
-        timeout.append(dt.total_seconds())
+    try:
+        dt = np.array(timein,dtype='datetime64[us]') - np.datetime64(basetime,'us')
+        return dt.astype(np.int64)/1e6
+    except:
+        timeout=[]
+        for t in timein:
+            dt = t - basetime
+            timeout.append(dt.total_seconds())
         
-    return np.array(timeout)
+        return np.array(timeout)
     
 def narr2suntans(outfile,tstart,tend,bbox,utmzone):
     """
@@ -27,15 +27,17 @@ from sunpy import Grid,Spatial
 from netCDF4 import Dataset, num2date
 import numpy as np
 from scipy.interpolate import interp1d
+from scipy import sparse
 import matplotlib.pyplot as plt
 #import matplotlib.nxutils as nxutils #inpolygon equivalent lives here
 from inpolygon import inpolygon
 from datetime import datetime, timedelta
 import othertime
 import os
+import hashlib
 from maptools import readShpPoly,ll2utm
-from get_metocean_dap import get_metocean_local
-from interpXYZ import Interp4D
+from get_metocean_dap import get_metocean_local, open_metocean_local
+from interpXYZ import Interp4D, interp1dmatrix
 
 import pdb
 
@@ -56,6 +58,12 @@ class Boundary(object):
     isnorth = True
     loadfromnc = False
 
+    # Set to False to not allocate the [Nt,Nk,N] arrays (stream to a file
+    # with oceanmodel2bdy(...,outfile=...) instead)
+    inmemory = True
+    # Number of output time steps to interpolate/write at once
+    tchunk = 100
+
     # Interpolation options dictionary
     interpdict = dict(
         method='idw', # Interpolation method:  'nn', 'idw', 'kriging', 'griddata'
@@ -89,7 +97,8 @@ class Boundary(object):
             self.getTime()
             
             # Initialise the output arrays
-            self.initArrays()
+            if self.inmemory:
+                self.initArrays()
             
         else:
             print 'Loading boundary data from a NetCDF file...'
@@ -259,10 +268,12 @@ class Boundary(object):
         self.boundary_Q = np.zeros((self.Nt,self.Nseg))
         
     
-    def write2NC(self,ncfile):
+    def write2NC(self,ncfile,writedata=True):
         """
         Method for writing to the suntans boundary netcdf format
-        
+
+        Set writedata=False to fill the boundary variables with zeros (in
+        chunks) instead of writing the boundary arrays.
         """
         from netCDF4 import Dataset
         
@@ -349,39 +360,39 @@ class Boundary(object):
         # Type-2 boundaries
         if self.N2>0:    
             tmpvar=nc.createVariable('boundary_h','f8',('Nt','Ntype2'))
-            tmpvar[:] = self.boundary_h
+            self._writevar(nc,tmpvar,'boundary_h',writedata)
             tmpvar.setncattr('long_name','Free-surface elevation at type-2 boundary point')
             tmpvar.setncattr('units','metre')
  
             tmpvar=nc.createVariable('boundary_u','f8',('Nt','Nk','Ntype2'))
-            tmpvar[:] = self.boundary_u
+            self._writevar(nc,tmpvar,'boundary_u',writedata)
             tmpvar.setncattr('long_name','Eastward velocity at type-2 boundary point')
             tmpvar.setncattr('units','metre second-1')
                     
             tmpvar=nc.createVariable('boundary_v','f8',('Nt','Nk','Ntype2'))
-            tmpvar[:] = self.boundary_v
+            self._writevar(nc,tmpvar,'boundary_v',writedata)
             tmpvar.setncattr('long_name','Northward velocity at type-2 boundary point')
             tmpvar.setncattr('units','metre second-1')
                     
             tmpvar=nc.createVariable('boundary_w','f8',('Nt','Nk','Ntype2'))
-            tmpvar[:] = self.boundary_w
+            self._writevar(nc,tmpvar,'boundary_w',writedata)
             tmpvar.setncattr('long_name','Vertical velocity at type-2 boundary point')
             tmpvar.setncattr('units','metre second-1')
     
             tmpvar=nc.createVariable('boundary_T','f8',('Nt','Nk','Ntype2'))
-            tmpvar[:] = self.boundary_T
+            self._writevar(nc,tmpvar,'boundary_T',writedata)
             tmpvar.setncattr('long_name','Water temperature at type-2 boundary point')
             tmpvar.setncattr('units','degrees C')
     
             tmpvar=nc.createVariable('boundary_S','f8',('Nt','Nk','Ntype2'))
-            tmpvar[:] = self.boundary_S
+            self._writevar(nc,tmpvar,'boundary_S',writedata)
             tmpvar.setncattr('long_name','Salinity at type-2 boundary point')
             tmpvar.setncattr('units','psu')
         
         # Type-2 flux boundaries
         if self.Nseg>0:
             tmpvar=nc.createVariable('boundary_Q','f8',('Nt','Nseg'))
-            tmpvar[:] = self.boundary_Q
+            self._writevar(nc,tmpvar,'boundary_Q',writedata)
             tmpvar.setncattr('long_name','Volume flux  at boundary segment')
             tmpvar.setncattr('units','metre^3 second-1')
             
@@ -389,38 +400,51 @@ class Boundary(object):
         # Type-3 boundaries
         if self.N3>0:
             tmpvar=nc.createVariable('uc','f8',('Nt','Nk','Ntype3'))
-            tmpvar[:] = self.uc
+            self._writevar(nc,tmpvar,'uc',writedata)
             tmpvar.setncattr('long_name','Eastward velocity at type-3 boundary point')
             tmpvar.setncattr('units','metre second-1')
                     
             tmpvar=nc.createVariable('vc','f8',('Nt','Nk','Ntype3'))
-            tmpvar[:] = self.vc
+            self._writevar(nc,tmpvar,'vc',writedata)
             tmpvar.setncattr('long_name','Northward velocity at type-3 boundary point')
             tmpvar.setncattr('units','metre second-1')
                     
             tmpvar=nc.createVariable('wc','f8',('Nt','Nk','Ntype3'))
-            tmpvar[:] = self.wc
+            self._writevar(nc,tmpvar,'wc',writedata)
             tmpvar.setncattr('long_name','Vertical velocity at type-3 boundary point')
             tmpvar.setncattr('units','metre second-1')
     
             tmpvar=nc.createVariable('T','f8',('Nt','Nk','Ntype3'))
-            tmpvar[:] = self.T
+            self._writevar(nc,tmpvar,'T',writedata)
             tmpvar.setncattr('long_name','Water temperature at type-3 boundary point')
             tmpvar.setncattr('units','degrees C')
     
             tmpvar=nc.createVariable('S','f8',('Nt','Nk','Ntype3'))
-            tmpvar[:] = self.S
+            self._writevar(nc,tmpvar,'S',writedata)
             tmpvar.setncattr('long_name','Salinity at type-3 boundary point')
             tmpvar.setncattr('units','psu')
             
             tmpvar=nc.createVariable('h','f8',('Nt','Ntype3'))
-            tmpvar[:] = self.h
+            self._writevar(nc,tmpvar,'h',writedata)
             tmpvar.setncattr('long_name','Water surface elevation at type-3 boundary point')
             tmpvar.setncattr('units','metres')
         
         nc.close()
         
         print 'Boundary data sucessfully written to: %s'%ncfile
+
+    def _writevar(self,nc,tmpvar,varname,writedata):
+        """
+        Writes a boundary array to a netcdf variable (or zeros)
+        """
+        if writedata:
+            tmpvar[:] = self[varname]
+            return
+
+        sz = [len(nc.dimensions[dd]) for dd in tmpvar.dimensions[1:]]
+        for t1 in range(0,self.Nt,self.tchunk):
+            t2 = min(t1+self.tchunk,self.Nt)
+            tmpvar[t1:t2,...] = np.zeros([t2-t1]+sz)
         
     def _loadBoundaryNC(self):
         """
@@ -568,19 +592,62 @@ class Boundary(object):
             self.uc+=uc
             self.vc+=vc
 
-    def oceanmodel2bdy(self,ncfile,convert2utm=True,setUV=True,seth=True,name='HYCOM'):
+    def oceanmodel2bdy(self,ncfile,convert2utm=True,setUV=True,seth=True,name='HYCOM',\
+            outfile=None,weightfile=None):
         """
         Interpolate data from a downloaded netcdf file to the open boundaries
 
+        ncfile can be a list of files (e.g. monthly files) in time order. Each
+        file fills the output time steps after the last time of the previous
+        file up to its own last time; the last record of each file is carried
+        over to interpolate across the gap to the next file. The combined
+        horizontal/vertical interpolation weights are computed once (or loaded
+        from "weightfile" if it exists, otherwise saved to it) and applied to
+        "tchunk" output time steps at a time.
+
+        If "outfile" is set the data is written straight into the boundary
+        netcdf file (created with zeros if it does not exist) instead of the
+        boundary arrays.
+        """
+        if isinstance(ncfile,str):
+            ncfile = [ncfile]
+
+        if not outfile is None and not os.path.exists(outfile):
+            self.write2NC(outfile,writedata=False)
+
+        carry = None
+        for ff in ncfile:
+            carry = self._oceanmodel2bdy(ff,convert2utm,setUV,seth,name,\
+                outfile,weightfile,carry)
+
+    def _oceanmodel2bdy(self,ncfile,convert2utm,setUV,seth,name,outfile,weightfile,\
+            carry=None):
+        """
+        Interpolate one ocean model file onto the boundary arrays/file
+
+        carry is the (time, {variable:data}) of the last record of the
+        previous file (or None). Returns the same for this file.
         """
         print 'Loading boundary data from ocean model netcdf file:\n\t%s...'%ncfile
-        # Load the temperature salinity data and coordinate data
-        temp, nc = get_metocean_local(ncfile,'temp',name=name)
-        salt, nc = get_metocean_local(ncfile,'salt')
+        seth = seth and self.N3>0
+        setUV = setUV and self.N2>0
+        varnames = ['temp','salt']
         if setUV:
-            u, nc = get_metocean_local(ncfile,'u')
-            v, nc = get_metocean_local(ncfile,'v')
+            varnames += ['u','v']
+        if seth:
+            varnames += ['ssh']
+
+        # Open the file once and read each variable in time chunks
+        TDS = open_metocean_local(ncfile,varnames,name=name)
 
+        def readvar(vv,t1,t2):
+            ncobj = getattr(TDS,'_%s'%vv)
+            data = ncobj.get_data_singlefile(getattr(TDS,vv),TDS._nc,t1,t2)
+            return np.ma.filled(data,0.).reshape((t2-t1,-1))
+
+        # Read the first time step for the coordinates and the mask
+        nc = TDS._temp
+        temp = nc.get_data_singlefile(TDS.temp,TDS._nc,0,1)
 
         # Convert to utm
         ll = np.vstack([nc.X.ravel(),nc.Y.ravel()]).T
@@ -590,60 +657,216 @@ class Boundary(object):
             xy = ll
 
         # Construct a 3D mask
-        mask3d = temp.mask
-        mask3d = mask3d[0,...]
+        mask3d = np.ma.getmaskarray(temp)[0,...]
         mask3d = mask3d.reshape((nc.nz,xy.shape[0]))
 
-        # Type 3 cells
-        if self.N3>0:
-            # Construct the 4D interp class
-            F4d =\
-                Interp4D(xy[:,0],xy[:,1],nc.Z,nc.time,\
-                    self.xv,self.yv,self.z,self.time,mask=mask3d,**self.interpdict)
+        if seth:
+            ssh = TDS._ssh.get_data_singlefile(TDS.ssh,TDS._nc,0,1)
+            mask2d = np.ma.getmaskarray(ssh)[0,...].ravel()
+        else:
+            mask2d = None
 
-            tempnew = F4d(temp)
-            self.T[:] = tempnew
+        W = self.getWeights(xy,nc,mask3d,mask2d,weightfile)
 
-            saltnew = F4d(salt)
-            self.S[:] = saltnew
+        # List of (input variable, weights, output variable, add to existing)
+        outvars = {'temp':[],'salt':[],'u':[],'v':[],'ssh':[]}
+        if self.N3>0:
+            outvars['temp'].append((W['type3'],'T',False))
+            outvars['salt'].append((W['type3'],'S',False))
+            # Never do u/v for type-3
+            if seth:
+                outvars['ssh'].append((W['ssh'],'h',True))
+        if self.N2>0:
+            # Type 2 cells : no free-surface
+            outvars['temp'].append((W['type2'],'boundary_T',False))
+            outvars['salt'].append((W['type2'],'boundary_S',False))
+            if setUV:
+                outvars['u'].append((W['type2'],'boundary_u',True))
+                outvars['v'].append((W['type2'],'boundary_v',True))
+
+        # Each output time step is written by one file only: this file owns
+        # the steps in (last time of the previous file, last time of this file]
+        tin = othertime.SecondsSince(nc.time)
+        tout = othertime.SecondsSince(self.time)
+        nin = tin.shape[0]
+        if carry is None:
+            ind = np.flatnonzero((tout>=tin[0]) & (tout<=tin[-1]))
+        else:
+            ind = np.flatnonzero((tout>carry[0]) & (tout<=tin[-1]))
 
-            # Never do this for type-3
-            #if setUV:
-            #    unew = F4d(u)
-            #    self.u[:] += unew
-            #    vnew = F4d(v)
-            #    self.v[:] += vnew
+        # Prepend the carried record to bridge the gap between the files
+        off = 0
+        if not carry is None and carry[0] < tin[0]:
+            tin = np.hstack([carry[0],tin])
+            off = 1
 
-            if seth:
-                # Construct the 3D interp class for surface height
-                ssh, nc2d = get_metocean_local(ncfile,'ssh')
-                mask2d = ssh.mask
-                mask2d = mask2d[0,...].ravel()
+        if not outfile is None:
+            ncout = Dataset(outfile,'a')
+        else:
+            ncout = None
+
+        for ii in range(0,ind.shape[0],self.tchunk):
+            t1 = ind[ii]
+            t2 = ind[min(ii+self.tchunk,ind.shape[0])-1]+1
+            print 'Interpolating boundary time steps %d to %d of %d...'%(t1,t2,self.Nt)
+
+            # Temporal weights and the input time steps they need
+            Wt = interp1dmatrix(tin,tout[t1:t2]).tocsc()
+            used = np.flatnonzero(np.diff(Wt.indptr))
+            tin1,tin2 = used[0],used[-1]+1
+            Wt = Wt[:,tin1:tin2]
+
+            for vv in varnames:
+                if len(outvars[vv])==0:
+                    continue
+                data = readvar(vv,max(tin1-off,0),tin2-off)
+                if tin1 < off:
+                    data = np.vstack([carry[1][vv],data])
+                data = Wt.dot(data)
+
+                for S,varname,add in outvars[vv]:
+                    out = S.dot(data.T).T
+                    if not varname=='h':
+                        out = out.reshape((t2-t1,self.Nk,-1))
+                    self._setbdy(ncout,varname,t1,t2,out,add)
+
+        # Last record for the next file
+        carry = (tin[-1],dict([(vv,readvar(vv,nin-1,nin)) for vv in varnames]))
+        TDS._nc.close()
+
+        if not ncout is None:
+            ncout.close()
+            print 'Boundary data sucessfully written to: %s'%outfile
+
+        return carry
+
+    def _setbdy(self,nc,varname,t1,t2,data,add):
+        """
+        Sets (or adds to) the time steps t1:t2 of a boundary variable in the
+        boundary arrays or an open boundary netcdf file
+        """
+        if nc is None:
+            if add:
+                self[varname][t1:t2,...] += data
+            else:
+                self[varname][t1:t2,...] = data
+        else:
+            if add:
+                data = data + nc.variables[varname][t1:t2,...]
+            nc.variables[varname][t1:t2,...] = data
 
-                F3d = Interp4D(xy[:,0],xy[:,1],None,nc2d.time,\
-                    self.xv,self.yv,None,self.time,mask=mask2d,**self.interpdict)
-                sshnew = F3d(ssh)
-                self.h[:] += sshnew
+    def getWeights(self,xy,nc,mask3d,mask2d,weightfile=None):
+        """
+        Returns a dictionary of the combined horizontal/vertical interpolation
+        matrices from the ocean model grid to the type-2/type-3 points
 
-        # Type 2 cells : no free-surface
+        Reuses the weights from a previous call or "weightfile" if they were
+        built from the same source coordinates and masks, target points and
+        interpolation options (compared with an md5 fingerprint of these).
+        """
+        nxy = xy.shape[0]
+        shapes = {}
+        if self.N3>0:
+            shapes['type3'] = (self.Nk*self.N3,nc.nz*nxy)
+            if not mask2d is None:
+                shapes['ssh'] = (self.N3,nxy)
         if self.N2>0:
-            # Construct the 4D interp class
-            F4d =\
-             Interp4D(xy[:,0],xy[:,1],nc.Z,nc.time,\
-                 self.xe,self.ye,self.z,self.time,mask=mask3d,**self.interpdict)
+            shapes['type2'] = (self.Nk*self.N2,nc.nz*nxy)
+
+        # Fingerprint of everything the weights depend on
+        key = hashlib.md5()
+        key.update(repr(sorted(shapes.items())))
+        key.update(repr(sorted(self.interpdict.items())))
+        arrays = [xy,nc.Z,mask3d,mask2d,self.z]
+        if shapes.has_key('type3'):
+            arrays += [self.xv,self.yv]
+        if shapes.has_key('type2'):
+            arrays += [self.xe,self.ye]
+        for aa in arrays:
+            if not aa is None:
+                aa = np.ma.getdata(aa)
+                key.update(repr(aa.shape))
+                key.update(np.ascontiguousarray(aa,dtype=np.float64).tostring())
+        fingerprint = key.hexdigest()
+
+        def _match(W,fp):
+            if W is None or not fp==fingerprint:
+                return False
+            for kk in shapes.keys():
+                if not W.has_key(kk) or not W[kk].shape==shapes[kk]:
+                    return False
+            return True
+
+        if self.__dict__.has_key('_bdyweights') and _match(*self._bdyweights):
+            return self._bdyweights[0]
+
+        # np.savez appends .npz to the file name
+        if not weightfile is None and not weightfile.endswith('.npz'):
+            weightfile += '.npz'
+
+        if not weightfile is None and os.path.exists(weightfile):
+            W, fp = self.loadWeights(weightfile)
+            if _match(W,fp):
+                self._bdyweights = (W,fingerprint)
+                return W
+            print 'Warning: weights in %s do not match the ocean model grid. Rebuilding...'%weightfile
+
+        print 'Building the boundary interpolation weights...'
+        W = {}
+        for kk in shapes.keys():
+            if kk=='type3':
+                F = Interp4D(xy[:,0],xy[:,1],nc.Z,nc.time,\
+                    self.xv,self.yv,self.z,self.time,mask=mask3d,**self.interpdict)
+            elif kk=='type2':
+                F = Interp4D(xy[:,0],xy[:,1],nc.Z,nc.time,\
+                    self.xe,self.ye,self.z,self.time,mask=mask3d,**self.interpdict)
+            elif kk=='ssh':
+                F = Interp4D(xy[:,0],xy[:,1],None,nc.time,\
+                    self.xv,self.yv,None,self.time,mask=mask2d,**self.interpdict)
 
-            tempnew = F4d(temp)
-            self.boundary_T[:] = tempnew
+            W[kk] = F.getmatrix()
+            if W[kk] is None:
+                raise Exception, 'interpolation method "%s" does not have fixed weights. Use "nn", "idw" or "kriging".'%self.interpdict['method']
 
-            saltnew = F4d(salt)
-            self.boundary_S[:] = saltnew
+        self._bdyweights = (W,fingerprint)
+        if not weightfile is None:
+            self.saveWeights(weightfile,W,fingerprint)
 
-            if setUV:
-                unew = F4d(u)
-                self.boundary_u[:] += unew
-                vnew = F4d(v)
-                self.boundary_v[:] += vnew
+        return W
+
+    def saveWeights(self,weightfile,W,fingerprint=''):
+        """
+        Save a dictionary of sparse interpolation weights (and the fingerprint
+        of the inputs they were built from) to a numpy .npz file
+        """
+        print 'Saving boundary interpolation weights to: %s'%weightfile
+        out = {'fingerprint':np.array(fingerprint)}
+        for kk in W.keys():
+            out['%s_data'%kk] = W[kk].data
+            out['%s_indices'%kk] = W[kk].indices
+            out['%s_indptr'%kk] = W[kk].indptr
+            out['%s_shape'%kk] = np.array(W[kk].shape)
+        np.savez(weightfile,**out)
+
+    def loadWeights(self,weightfile):
+        """
+        Load a dictionary of sparse interpolation weights from a numpy .npz file
 
+        Returns: W, fingerprint (None if the file does not have one)
+        """
+        print 'Loading boundary interpolation weights from: %s'%weightfile
+        op = np.load(weightfile)
+        W = {}
+        for kk in ['type2','type3','ssh']:
+            if '%s_shape'%kk in op.files:
+                W[kk] = sparse.csr_matrix((op['%s_data'%kk],op['%s_indices'%kk],\
+                    op['%s_indptr'%kk]),shape=tuple(op['%s_shape'%kk]))
+
+        fingerprint = None
+        if 'fingerprint' in op.files:
+            fingerprint = str(op['fingerprint'])
+
+        return W, fingerprint
         
     def otis2boundary(self,otisfile,conlist=None,setUV=False):
         """
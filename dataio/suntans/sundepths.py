@@ -8,6 +8,7 @@ Created on Fri Oct 05 11:24:10 2012
 """
 from interpXYZ import Inputs, interpXYZ
 import numpy as np
+from scipy import spatial
 import sunpy
 import matplotlib.pyplot as plt
 
@@ -47,6 +48,9 @@ class DepthDriver(object):
     vdatum = 'MSL'
     shapefieldname='contour'
     
+    # Only use depth data within this distance of the grid (None uses all of the data)
+    clipbuffer=1000.0
+    
     # Smoothing options
     smooth=False
     smoothmethod='kriging' # USe kriging or idw for smoothing
@@ -82,21 +86,10 @@ class DepthDriver(object):
             self.xy = np.column_stack((self.grd.xv,self.grd.yv))
 
 
-        # Initialise the Interpolation class
-        print 'Building interpolant class...'
-        self.F = interpXYZ(self.indata.XY,self.xy,method=self.interpmethod,NNear=self.NNear,\
-                p=self.p,varmodel=self.varmodel,nugget=self.nugget,sill=self.sill,vrange=self.vrange)
-
-
-        # Interpolate the data
-        print 'Interpolating data...'
-        dv = self.F(self.indata.Zin)*scalefac
+        dv = self.interpDepths(self.xy)*scalefac
 
         if interpnodes:
-            self.grd.dv = np.zeros_like(self.grd.xv)
-            for nn in range(self.grd.Nc):
-                self.grd.dv[nn] = np.max(dv[self.grd.cells[nn,0:self.grd.nfaces[nn] ] ])
-                #self.grd.dv[nn] = np.mean(dv[self.grd.cells[nn,0:self.grd.nfaces[nn] ] ])
+            self.grd.dv = self.grd.node2cell(dv,method='max')
                 
         else:
             self.grd.dv = dv
@@ -124,13 +117,117 @@ class DepthDriver(object):
             
         print 'Finished depth interpolation.'
         
+    def interpDepths(self,xy):
+        """
+        Interpolates the depth data onto the points xy
+
+        Only the data within clipbuffer of xy is used unless checkClip finds
+        that the result would differ from using all of the data.
+        """
+        # Initialise the Interpolation class
+        print 'Building interpolant class...'
+        XY,Zin = self.clipData(xy)
+        self.F = interpXYZ(XY,xy,method=self.interpmethod,NNear=self.NNear,\
+                p=self.p,varmodel=self.varmodel,nugget=self.nugget,sill=self.sill,vrange=self.vrange)
+
+        if not self.checkClip(XY,xy):
+            print 'Depth data is too sparse near the grid, using all of the data...'
+            XY,Zin = self.indata.XY,self.indata.Zin
+            self.F = interpXYZ(XY,xy,method=self.interpmethod,NNear=self.NNear,\
+                p=self.p,varmodel=self.varmodel,nugget=self.nugget,sill=self.sill,vrange=self.vrange)
+
+        # Interpolate the data
+        print 'Interpolating data...'
+        return self.F(Zin)
+
+    def clipData(self,xy):
+        """
+        Returns the depth data within clipbuffer of the points xy
+        """
+        XY = self.indata.XY
+        Zin = self.indata.Zin
+        if self.clipbuffer is None:
+            return XY,Zin
+        
+        # Bounding box first then the distance to the nearest point
+        b = self.clipbuffer
+        ind = np.flatnonzero((XY[:,0]>=xy[:,0].min()-b) & (XY[:,0]<=xy[:,0].max()+b) &\
+            (XY[:,1]>=xy[:,1].min()-b) & (XY[:,1]<=xy[:,1].max()+b))
+        
+        dist,i = spatial.cKDTree(xy).query(XY[ind,:],distance_upper_bound=b)
+        ind = ind[dist<=b]
+        print 'Using %d of %d depth points within %3.1f m of the grid.'%(ind.shape[0],XY.shape[0],b)
+        
+        return XY[ind,:],Zin[ind]
+        
+    def checkClip(self,XY,xy):
+        """
+        Checks that the clipped data XY gives the same interpolant at xy as
+        the full data
+
+        For 'nn', 'idw' and 'kriging' all of the neighbours used must be
+        within clipbuffer. For 'linear' every triangle of the clipped data
+        containing a point of xy must also be a triangle of the full
+        triangulation i.e. no other depth point lies inside (or on) its
+        circumcircle.
+        """
+        if self.clipbuffer is None:
+            return True
+        
+        if self.F.method=='linear':
+            tri = self.F.Finterp.tri
+            simplex = tri.find_simplex(xy)
+            if np.any(simplex==-1):
+                return False
+            
+            # Circumcircles of the triangles (relative to the first vertex)
+            P = tri.points[tri.simplices[np.unique(simplex)]]
+            b = P[:,1,:] - P[:,0,:]
+            c = P[:,2,:] - P[:,0,:]
+            d = 2*(b[:,0]*c[:,1] - b[:,1]*c[:,0])
+            if np.any(d==0):
+                return False
+            b2 = (b**2).sum(axis=-1)
+            c2 = (c**2).sum(axis=-1)
+            ux = (c[:,1]*b2 - b[:,1]*c2)/d
+            uy = (b[:,0]*c2 - c[:,0]*b2)/d
+            r = np.sqrt(ux**2+uy**2)
+            centre = P[:,0,:] + np.column_stack((ux,uy))
+            
+            # The fourth nearest depth point must be outside the circle
+            dist,i = spatial.cKDTree(self.indata.XY).query(centre,k=4)
+            return np.all(dist[:,3] > r*(1+1e-9))
+        
+        ind = self.F.Finterp.ind.reshape((xy.shape[0],-1))
+        if XY.shape[0]<ind.shape[1]:
+            return False
+        
+        dx = XY[ind,0] - xy[:,0,np.newaxis]
+        dy = XY[ind,1] - xy[:,1,np.newaxis]
+        
+        return np.sqrt(dx**2+dy**2).max() <= self.clipbuffer
+        
     def smoothDepths(self):
         """ 
         Smooth the data by running an interpolant over the model grid points
         """
         print 'Smoothing the data...'
-        Fsmooth =interpXYZ(self.xy,self.xy,method=self.smoothmethod,NNear=self.smoothnear,vrange=self.vrange)
-        self.grd.dv = Fsmooth(self.grd.dv)
+        self.grd.dv = self.smoothop().dot(self.grd.dv)
+        
+    def smoothop(self):
+        """
+        Returns the smoothing operator, a sparse [Nc x Nc] matrix
+        
+        This is built once for the grid and reused
+        """
+        key = (self.suntanspath,self.smoothmethod,self.smoothnear,self.vrange)
+        if not self.__dict__.has_key('_smoothop') or not self._smoothkey==key:
+            xy = np.column_stack((self.grd.xv,self.grd.yv))
+            Fsmooth =interpXYZ(xy,xy,method=self.smoothmethod,NNear=self.smoothnear,vrange=self.vrange)
+            self._smoothop = Fsmooth.getmatrix()
+            self._smoothkey = key
+        
+        return self._smoothop
 
     def plot(self):
         """
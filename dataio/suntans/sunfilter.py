@@ -8,7 +8,9 @@ Created on Tue May 14 09:49:38 2013
 """
 
 import numpy as np
-from netCDF4 import Dataset
+from netCDF4 import Dataset, MFDataset
+from scipy import signal
+from multiprocessing import Pool
 import matplotlib.pyplot as plt
 
 from sunpy import Spatial, unsurf
@@ -25,6 +27,8 @@ class sunfilter(Spatial):
     ftype='low'
     order=3
     cutoff_dt = 34.0*3600.0 # Cutoff time period in hours
+    maxmem = 512. # Memory budget for filtering in MB (shared by all processes)
+    nprocs = 1 # Number of processes used to filter blocks of cells
     
     def __init__(self,ncfile,**kwargs):
         """
@@ -43,10 +47,7 @@ class sunfilter(Spatial):
         """
         Calls the filter class
         """
-        if tstart == -1:
-            self.tstep=np.arange(0,self.Nt,1)
-        else:
-            self.tstep=self.getTstep(tstart,tend)
+        self.setTstep(tstart,tend)
         
         if not varname == None:
             self.variable = varname
@@ -59,18 +60,92 @@ class sunfilter(Spatial):
         dataout = T.filt(self.cutoff_dt,btype=self.ftype,axis=-1,order=self.order)  
         
         return np.swapaxes(dataout,-1,0) # Return with the dimensions in the right order
+
+    def setTstep(self,tstart,tend):
+        """
+        Sets the time steps to filter (tstart=-1 uses all steps)
+        """
+        if tstart == -1:
+            self.tstep=np.arange(0,self.Nt,1)
+        else:
+            self.tstep=self.getTstep(tstart,tend)
+
+    def filtcoeffs(self):
+        """
+        Butterworth filter coefficients (b, a) for the current time steps
+        """
+        T = timeseries(self.time[self.tstep],np.zeros((len(self.tstep),)))
+
+        if not self.ftype == 'band':
+            Wn = T.dt/self.cutoff_dt
+        else:
+            Wn = [T.dt/co for co in self.cutoff_dt]
+
+        return signal.butter(self.order, Wn, btype=self.ftype, analog=0, output='ba')
+
+    def filterblocks(self,varname,substep=1):
+        """
+        Generator that filters a variable in blocks of cells (or edges)
+
+        Each block holds the full time series of a contiguous range of
+        cells so the filter (and its edge padding) is identical to filtering
+        the whole grid at once. The block size is set so that the working
+        arrays fit in maxmem MB on each of the nprocs processes.
+
+        Yields j1, j2 and the filtered data[::substep,...,j1:j2]
+        """
+        b, a = self.filtcoeffs()
+
+        nt = len(self.tstep)
+        padlen = 3*max(len(a),len(b))
+        if nt <= padlen:
+            raise Exception, 'at least %d time steps are needed to filter (have %d)'%(padlen+1,nt)
+
+        # Read contiguous time steps as a slice
+        tstep = np.asarray(self.tstep)
+        if np.all(np.diff(tstep)==1):
+            tstep = slice(tstep[0],tstep[-1]+1)
+
+        # The filter works in double precision on about 6 copies of the data
+        shp = self.nc.variables[varname].shape
+        nbytes = 6*8*nt*np.prod(shp[1:-1])
+        nj = shp[-1]
+        nblock = int(self.maxmem*2**20/(self.nprocs*nbytes))
+        if nblock < 1:
+            print 'Warning: a single cell needs %3.1f MB (maxmem=%3.1f MB)'%(nbytes*self.nprocs/2.**20,self.maxmem)
+            nblock = 1
+        nblock = min(nblock,nj)
+
+        bounds = range(0,nj,nblock)+[nj]
+        blocks = zip(bounds[:-1],bounds[1:])
+
+        if self.nprocs==1:
+            for j1,j2 in blocks:
+                yield j1, j2, filtvar(self.nc,varname,tstep,j1,j2,b,a,substep)
+            return
+
+        # Filter nprocs blocks at a time so that only one batch is in memory
+        pool = Pool(self.nprocs)
+        try:
+            for ii in range(0,len(blocks),self.nprocs):
+                batch = blocks[ii:ii+self.nprocs]
+                args = [(self.ncfile,varname,tstep,j1,j2,b,a,substep) for j1,j2 in batch]
+                for (j1,j2),dataf in zip(batch,pool.map(_filtvarWorker,args)):
+                    yield j1, j2, dataf
+        finally:
+            pool.close()
+            pool.join()
         
     def filter2nc(self,outfile,tstart,tend,substep=12,varlist=None,**kwargs):
         """
         Filters the variables in the list, varlist, and outputs the results to netcdf
-        
+
+        The variables are filtered and written in blocks of cells (see
+        filterblocks) so memory use is set by maxmem, not the run length.
         """
         self.__dict__.update(kwargs)
         
-        if tstart == -1:
-            self.tstep=np.arange(0,self.Nt,1)
-        else:
-            self.tstep=self.getTstep(tstart,tend)
+        self.setTstep(tstart,tend)
         
         if varlist == None:
             varlist = ['eta','uc','vc','w']
@@ -86,35 +161,60 @@ class sunfilter(Spatial):
         
         self.create_nc_var(outfile,'time', ugrid['time']['dimensions'], ugrid['time']['attributes'])
         
-        # Loop through and filter each variable (do layer by layer on 3D variables for sake of memory)        
+        # Loop through and filter each variable in blocks of cells
         nc = Dataset(outfile,'a')
         
         # Create the time variable first
-        nctime = othertime.SecondsSince(self.time[self.tstep[0]:self.tstep[-1]:substep])
+        nctime = othertime.SecondsSince(self.time[self.tstep][::substep])
 
         nc.variables['time'][:] = nctime
         
         for vv in varlist:
             print 'Filtering variable: %s'%vv
             
-            if len(ugrid[vv]['dimensions']) == 2:
-                dataf = self.__call__(tstart,tend,varname=vv)
-                nc.variables[vv][:] = dataf[::substep,:].copy()
-            elif len(ugrid[vv]['dimensions']) == 3:
-                for kk in range(0,self.Nkmax):
-                    print '   layer: %d'%kk
-                    self.klayer = [kk]
-                    dataf = self.__call__(tstart,tend,varname=vv)
-                    nc.variables[vv][:,kk,:] = dataf[::substep,:].copy()
+            for j1,j2,dataf in self.filterblocks(vv,substep=substep):
+                print '   cells: %d - %d'%(j1,j2)
+                nc.variables[vv][...,j1:j2] = dataf
+            nc.sync()
 
 
         nc.close()
         print '#####\nComplete - Filtered data written to: \n%s \n#####'%outfile
 
+def filtvar(nc,varname,tstep,j1,j2,b,a,substep=1):
+    """
+    Reads time steps tstep of a variable for cells j1:j2 and filters along time
+    """
+    data = nc.variables[varname][tstep,...,j1:j2]
+    data = np.ma.filled(data,0.).astype(np.float64)
+    data[data==999999.0] = 0.
+
+    return signal.filtfilt(b,a,data,axis=0)[::substep,...].copy()
+
+def _filtvarWorker(args):
+    """
+    Filters a block of cells (see sunfilter.filterblocks)
+    """
+    ncfile = args[0]
+    try:
+        nc = MFDataset(ncfile,aggdim='time')
+    except:
+        if type(ncfile)==list:
+            ncfile = ncfile[0]
+        nc = Dataset(ncfile,'r')
+
+    try:
+        return filtvar(nc,*args[1:])
+    finally:
+        nc.close()
+
 def usage():
     print "--------------------------------------------------------------"
     print "sunfilter.py   -h                 # show this help message      "
-    print "python sunfilter.py 'ncfilename.nc' 'outputfile.nc' [-v 'var1 var2 ...] [-s 12]"
+    print "python sunfilter.py 'ncfilename.nc' 'outputfile.nc' [-v 'var1 var2 ...] [-s 12] [-m 512] [-n 1]"
+    print "         -s  N                # Output every N time steps (default: 12)"
+    print "         -m  N                # Memory limit in MB (default: 512)"
+    print "         -n  N                # Number of processes (default: 1)"
         
 if __name__ == '__main__':
     """
@@ -127,9 +227,11 @@ if __name__ == '__main__':
     tend = -1
     varnames=['eta','uc','vc','salt','temp','rho']
     substep=12
+    maxmem=512.
+    nprocs=1
     
     try:
-        opts,rest = getopt.getopt(sys.argv[3:],'hv:s:')
+        opts,rest = getopt.getopt(sys.argv[3:],'hv:s:m:n:')
     except getopt.GetoptError,e:
         print e
         print "-"*80
@@ -141,9 +243,13 @@ if __name__ == '__main__':
             usage()
             exit(1)
         elif opt == '-s':
-            frqnames=int(val)
+            substep=int(val)
         elif opt == '-v':
             varnames = val.split()
+        elif opt == '-m':
+            maxmem=float(val)
+        elif opt == '-n':
+            nprocs=int(val)
     
     try:
 	ncfile = sys.argv[1]
@@ -154,5 +260,5 @@ if __name__ == '__main__':
     
     print ncfile, outfile, varnames, substep
     # Call the object
-    sun=sunfilter(ncfile)
+    sun=sunfilter(ncfile,maxmem=maxmem,nprocs=nprocs)
     sun.filter2nc(outfile,tstart,tend,substep=substep,varlist=varnames)
\ No newline at end of file
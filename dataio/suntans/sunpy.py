@@ -19,13 +19,19 @@ import othertime
 from suntans_ugrid import ugrid
 from timeseries import timeseries
 from ufilter import ufilter
+from mysignal import eofstream
 import operator
 from hybridgrid import HybridGrid, circumcenter
-from gridsearch import GridSearch
+from gridsearch import GridSearch, Point, intersectvec
+from inpolygon import inpolygon
+from sunrechunk import findrechunk
 
 import matplotlib.pyplot as plt
 from matplotlib.collections import PolyCollection, LineCollection
 import matplotlib.animation as animation
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from multiprocessing import Pool
 
 
 import pdb
@@ -576,7 +582,7 @@ class Grid(object):
         Uses the scipy KDTree routine
         """
         
-        if not self.__dict__.has_key('kd'):
+        if not self.__dict__.has_key('_kd'):
             self._kd = spatial.cKDTree(np.vstack((self.xv,self.yv)).T)
     
         # Perform query on all of the points in the grid
@@ -613,6 +619,119 @@ class Grid(object):
         
         return self._tsearch(x,y)
 
+    def inpolygon_cells(self,xypoly):
+        """
+        Rasterizes a polygon onto the grid cells
+
+        Returns an array [Nc] that is 1 for cells inside the polygon, 0 for
+        cells outside and -1 for cells that straddle the polygon boundary
+        """
+        xypoly = np.asarray(xypoly,dtype=np.double)
+        npoly = xypoly.shape[0]
+
+        # Cells that are not cut by the boundary are inside or outside
+        xy = np.vstack((self.xv,self.yv)).T
+        flag = np.array(inpolygon(xy,xypoly),dtype=np.int8)
+
+        # Find the grid edges crossed by each polygon segment
+        xe1 = self.xp[self.edges[:,0]]
+        ye1 = self.yp[self.edges[:,0]]
+        xe2 = self.xp[self.edges[:,1]]
+        ye2 = self.yp[self.edges[:,1]]
+        xemin, xemax = np.minimum(xe1,xe2), np.maximum(xe1,xe2)
+        yemin, yemax = np.minimum(ye1,ye2), np.maximum(ye1,ye2)
+
+        straddle = np.zeros((self.Nc,),dtype=np.bool)
+        for ii in range(npoly):
+            x1,y1 = xypoly[ii,:]
+            x2,y2 = xypoly[(ii+1)%npoly,:]
+
+            # Bounding box check first
+            ind = np.where( (xemax>=min(x1,x2)) & (xemin<=max(x1,x2)) &\
+                (yemax>=min(y1,y2)) & (yemin<=max(y1,y2)) )[0]
+            if ind.size==0:
+                continue
+
+            cross = intersectvec(Point(x1,y1),Point(x2,y2),\
+                Point(xe1[ind],ye1[ind]),Point(xe2[ind],ye2[ind]))
+
+            # Cells either side of a crossed edge straddle the boundary
+            nc = self.grad[ind[cross],:].ravel()
+            straddle[nc[nc>=0]] = True
+
+        # Cells containing a polygon vertex
+        cellind = self.find_cell(xypoly[:,0],xypoly[:,1])
+        straddle[cellind[cellind>=0]] = True
+
+        flag[straddle] = -1
+
+        return flag
+
+    def rasterindex(self,xlims=None,ylims=None,nx=1000,ny=800):
+        """
+        Returns the cell index [ny x nx] under the centre of each pixel of a
+        raster covering xlims and ylims (-1 outside of the grid)
+
+        Row 0 is at ylims[0] i.e. use imshow(...,origin='lower'). The lookup
+        is cached for each extent and resolution.
+        """
+        if xlims==None or ylims==None:
+            xlims=self.xlims 
+            ylims=self.ylims
+
+        if not self.__dict__.has_key('_rasterindex'):
+            self._rasterindex = {}
+
+        key = (tuple(xlims),tuple(ylims),nx,ny)
+        if not self._rasterindex.has_key(key):
+            x,y = self.rastercoords(xlims,ylims,nx,ny)
+            X,Y = np.meshgrid(x,y)
+            X = X.ravel()
+            Y = Y.ravel()
+            cellind = np.asarray(self.find_cell(X,Y),dtype=np.int32)
+
+            # Pixels missed by the nearest node search are checked against
+            # the cells of the next closest nodes
+            miss = np.where(cellind==-1)[0]
+            if miss.size>0:
+                dist,node = self._tsearch.kd.query(np.vstack((X[miss],Y[miss])).T,\
+                    k=min(4,self.Np))
+                near = self._tsearch.pnt2cellsarray()[node.reshape((miss.size,-1)),:]
+                near = near.reshape((miss.size,-1))
+                for ii in range(near.shape[1]):
+                    inside = self._tsearch.inCellVec(near[:,ii],X[miss],Y[miss])
+                    inside[near[:,ii]==-1] = False
+                    cellind[miss[inside]] = near[inside,ii]
+                    miss = miss[inside==False]
+                    near = near[inside==False,:]
+                    if miss.size==0:
+                        break
+
+            self._rasterindex[key] = cellind.reshape((ny,nx))
+
+        return self._rasterindex[key]
+
+    def rastercoords(self,xlims,ylims,nx,ny):
+        """
+        Returns the x and y coordinates of the pixel centres of a raster
+        """
+        dx = (xlims[1]-xlims[0])/float(nx)
+        dy = (ylims[1]-ylims[0])/float(ny)
+        x = xlims[0] + dx*(np.arange(nx)+0.5)
+        y = ylims[0] + dy*(np.arange(ny)+0.5)
+
+        return x,y
+
+    def rasterize(self,phi,xlims=None,ylims=None,nx=1000,ny=800):
+        """
+        Returns a masked image [ny x nx] of the cell-centred scalar phi [Nc]
+
+        Pixels outside of the grid are masked (see rasterindex)
+        """
+        cellind = self.rasterindex(xlims=xlims,ylims=ylims,nx=nx,ny=ny)
+
+        return np.ma.masked_where(cellind==-1,np.ma.asarray(phi)[cellind])
+
         
     def calc_dg(self):
         """
@@ -645,7 +764,77 @@ class Grid(object):
         Count the total number of 3-D cells
         """
         return np.sum(self.Nk+1)
-        
+
+    def get_index3d(self):
+        """
+        Returns the compact (ragged-column) layout of the active 3-D cells
+
+        The active layers (k = 0...Nk) of each cell are stored contiguously
+        so a packed 3-D field only holds count_cells() values instead of
+        Nkmax*Nc.
+
+        Returns:
+            offset - start of each cell's column in the packed array [Nc+1]
+            k3d - layer index of each packed value
+            j3d - cell index of each packed value
+        """
+        if not self.__dict__.has_key('_offset3d'):
+            nk = np.clip(np.array(self.Nk)+1,0,self.Nkmax)
+
+            self._offset3d = np.zeros((self.Nc+1,),dtype=np.int)
+            self._offset3d[1:] = np.cumsum(nk)
+
+            self._j3d = np.repeat(np.arange(self.Nc),nk)
+            self._k3d = np.arange(self._offset3d[-1]) - self._offset3d[self._j3d]
+
+        return self._offset3d, self._k3d, self._j3d
+
+    def get_mask3d(self):
+        """
+        Returns the 3-D mask [Nkmax x Nc]: True = Active, False = Ghost
+        """
+        offset,k3d,j3d = self.get_index3d()
+        nk = np.diff(offset)
+
+        return np.arange(self.Nkmax)[:,np.newaxis] < nk[np.newaxis,:]
+
+    def index3d(self,k,j):
+        """
+        Returns the packed index of layer(s) 'k' in cell(s) 'j'
+
+        Inactive (k,j) pairs return -1
+        """
+        offset,k3d,j3d = self.get_index3d()
+        k = np.asarray(k)
+        j = np.asarray(j)
+
+        nk = offset[j+1] - offset[j]
+        active = operator.and_(k>=0, k<nk)
+
+        return np.where(active, offset[j]+k, -1)
+
+    def pack3d(self,phi):
+        """
+        Packs a 3-D array [..., Nkmax, Nc] into the compact layout [..., N3d]
+        """
+        offset,k3d,j3d = self.get_index3d()
+
+        return phi[...,k3d,j3d]
+
+    def unpack3d(self,phi,fill_value=0.):
+        """
+        Unpacks a compact array [..., N3d] back onto the full grid
+        [..., Nkmax, Nc]. Inactive cells are set to 'fill_value'.
+        """
+        offset,k3d,j3d = self.get_index3d()
+
+        sz = phi.shape[:-1] + (self.Nkmax,self.Nc)
+        data = np.empty(sz,dtype=phi.dtype)
+        data[:] = fill_value
+        data[...,k3d,j3d] = phi
+
+        return data
+
     def calc_tangent(self):
         """
         Calculate the tangential vector for the edges of each cell
@@ -751,13 +940,236 @@ class Grid(object):
         
         This is calculated via a mean of the cells connected to a node(point)
         """
-        # Simple mean
-        #node_scalar = [np.mean(cell_scalar[self.pnt2cells(ii)]) for ii in range(self.Np)]
-        
         # Area weighted interpolation
-        node_scalar = [np.sum(cell_scalar[self.pnt2cells(ii)]*self.Ac[self.pnt2cells(ii)])\
-            / np.sum( self.Ac[self.pnt2cells(ii)]) for ii in range(self.Np)]
-        return np.array(node_scalar)
+        return self.applyop(self.cell2node_op(),cell_scalar)
+
+    def node2cell(self,node_scalar,method='mean'):
+        """
+        Map a node-based scalar onto the cells
+
+        method is the 'mean', 'max' or 'min' of the nodes of each cell
+        """
+        mask = np.arange(self.cells.shape[1])[np.newaxis,:] >= self.nfaces[:,np.newaxis]
+        phi = node_scalar[np.where(mask,0,np.asarray(self.cells))]
+
+        if method=='mean':
+            return np.where(mask,0.,phi).sum(axis=1)/self.nfaces
+        elif method=='max':
+            return np.where(mask,-np.inf,phi).max(axis=1)
+        elif method=='min':
+            return np.where(mask,np.inf,phi).min(axis=1)
+        else:
+            raise Exception, 'unknown method: %s'%method
+
+    def cell2node_op(self,k=None):
+        """
+        Returns a sparse (CSR) operator [Np x Nc] that maps a cell-based
+        scalar onto the nodes via an area-weighted mean of the connected cells
+
+        If 'k' is set only the cells that are active in layer k (k <= Nk) are
+        included in the average. Operators are cached and only built once
+        per layer.
+        """
+        if not self.__dict__.has_key('_cell2node_op'):
+            self._cell2node_op = {}
+
+        if not self._cell2node_op.has_key(k):
+            cells = np.array(self.cells)
+            mask = np.ma.getmaskarray(self.cells)==False
+            if not k==None:
+                mask = operator.and_(mask, (k<=self.Nk)[:,np.newaxis])
+
+            colindex = np.repeat(np.arange(self.Nc)[:,np.newaxis],\
+                cells.shape[1],axis=1)
+            area = self.Ac[colindex]
+
+            A = sparse.coo_matrix((area[mask],(cells[mask],colindex[mask])),\
+                shape=(self.Np,self.Nc),dtype=np.double).tocsr()
+
+            # Normalise each row by the area of the connected cells
+            Asum = np.array(A.sum(axis=1)).ravel()
+            Asum[Asum==0] = 1.
+            A.data /= np.repeat(Asum,np.diff(A.indptr))
+
+            self._cell2node_op[k] = A
+
+        return self._cell2node_op[k]
+
+    def applyop(self,A,phi):
+        """
+        Applies a sparse operator [M x N] to the last axis of phi [...,N]
+
+        Masked values are set to zero. Returns an array [...,M]
+        """
+        phi = np.ma.filled(phi,0.)
+        sz = phi.shape
+        out = A.dot(phi.reshape((-1,sz[-1])).T).T
+
+        return out.reshape(sz[:-1]+(A.shape[0],))
+
+    def _facecells(self,j,k):
+        """
+        Returns the cells either side of edges 'j' used for face values in
+        layer k. Boundary edges and edges next to walls use the deeper cell.
+        """
+        nc1 = self.grad[j,0]
+        nc2 = self.grad[j,1]
+                
+        # check for edges (use logical indexing)
+        ind1 = nc1==-1
+        nc1[ind1]=nc2[ind1]
+        ind2 = nc2==-1
+        nc2[ind2]=nc1[ind2]
+        
+        # check depths (walls)
+        indk = operator.or_(k>=self.Nk[nc1], k>=self.Nk[nc2])
+        ind3 = operator.and_(indk, self.Nk[nc2]>self.Nk[nc1])
+        nc1[ind3]=nc2[ind3]
+        ind4 = operator.and_(indk, self.Nk[nc1]>self.Nk[nc2])
+        nc2[ind4]=nc1[ind4]
+
+        return nc1, nc2
+
+    def _faceindex(self):
+        """
+        Returns the cell index, edge index and valid (unmasked) flag of each
+        cell face as [Nc x maxfaces] arrays
+        """
+        mask = np.ma.getmaskarray(self.cells)
+        ne = np.array(self.face)
+        ne[mask] = 0
+        i = np.repeat(np.arange(self.Nc)[:,np.newaxis],ne.shape[1],axis=1)
+
+        return i, ne, mask==False
+
+    def gradHplane_op(self,k=0):
+        """
+        Returns sparse operators [Nc x Nc] for d/dx and d/dy of a cell-centred
+        quantity in layer k using the plane through the nodal values (see
+        gradHplane). Triangular grids only. Operators are cached.
+        """
+        if not self.__dict__.has_key('_gradHplane_op'):
+            self._gradHplane_op = {}
+
+        if not self._gradHplane_op.has_key(k):
+            cells = np.asarray(self.cells)[:,0:3]
+            xA = self.xp[cells[:,0]]
+            yA = self.yp[cells[:,0]]
+            ABx = self.xp[cells[:,1]] - xA
+            ABy = self.yp[cells[:,1]] - yA
+            ACx = self.xp[cells[:,2]] - xA
+            ACy = self.yp[cells[:,2]] - yA
+            mz = ABx*ACy - ACx*ABy
+
+            # Weights of the three nodal values (-mx/mz and -my/mz)
+            rows = np.tile(np.arange(self.Nc),3)
+            cols = cells.T.ravel()
+            wx = np.hstack(((ABy-ACy)/mz, ACy/mz, -ABy/mz))
+            wy = np.hstack(((ACx-ABx)/mz, -ACx/mz, ABx/mz))
+            Px = sparse.csr_matrix((wx,(rows,cols)),shape=(self.Nc,self.Np))
+            Py = sparse.csr_matrix((wy,(rows,cols)),shape=(self.Nc,self.Np))
+
+            N = self.cell2node_op(k)
+            self._gradHplane_op[k] = (Px*N, Py*N)
+
+        return self._gradHplane_op[k]
+
+    def gradHdiv_op(self,k=0):
+        """
+        Returns sparse operators [Nc x Nc] for d/dx and d/dy of a cell-centred
+        quantity in layer k using the divergence theorem (see gradHdiv).
+        Operators are cached.
+        """
+        if not self.__dict__.has_key('_gradHdiv_op'):
+            self._gradHdiv_op = {}
+
+        if not self._gradHdiv_op.has_key(k):
+            i, ne, valid = self._faceindex()
+            nc1, nc2 = self._facecells(ne,k)
+
+            w = np.array(self.DEF)*self.df[ne]/self.dg[ne]/self.Ac[:,np.newaxis]
+            rows = np.hstack((i[valid],i[valid]))
+            cols = np.hstack((nc1[valid],nc2[valid]))
+
+            G = []
+            for n in [self.n1,self.n2]:
+                c = (n[ne]*w)[valid]
+                G.append(sparse.csr_matrix((np.hstack((c,-c)),(rows,cols)),\
+                    shape=(self.Nc,self.Nc)))
+
+            self._gradHdiv_op[k] = tuple(G)
+
+        return self._gradHdiv_op[k]
+
+    def gradH_op(self,k=0):
+        """
+        Returns the sparse horizontal gradient operators used by gradH
+        """
+        if self.maxfaces==3:
+            return self.gradHplane_op(k=k)
+        else:
+            return self.gradHdiv_op(k=k)
+
+    def edge2cell_op(self):
+        """
+        Returns sparse operators [Nc x Ne] that map an edge-normal velocity
+        onto the cell-centred u and v components (Perot's method)
+        """
+        if not self.__dict__.has_key('_edge2cell_op'):
+            i, ne, valid = self._faceindex()
+
+            w = np.array(self.DEF)*self.df[ne]/self.Ac[:,np.newaxis]
+            E = []
+            for n in [self.n1,self.n2]:
+                E.append(sparse.csr_matrix(((n[ne]*w)[valid],(i[valid],ne[valid])),\
+                    shape=(self.Nc,self.Ne)))
+
+            self._edge2cell_op = tuple(E)
+
+        return self._edge2cell_op
+
+    def divergence_op(self):
+        """
+        Returns a sparse operator [Nc x Ne] for the divergence of an
+        edge-normal velocity i.e. the net outward flux per unit area
+        """
+        if not self.__dict__.has_key('_divergence_op'):
+            i, ne, valid = self._faceindex()
+
+            w = np.array(self.normal)*self.df[ne]/self.Ac[:,np.newaxis]
+            self._divergence_op = sparse.csr_matrix((w[valid],(i[valid],ne[valid])),\
+                shape=(self.Nc,self.Ne))
+
+        return self._divergence_op
+
+    def curl_op(self,k=0):
+        """
+        Returns sparse operators [Nc x Nc] (Cx,Cy) for the vertical vorticity
+        of cell-centred velocity in layer k using the circulation method, i.e.
+        Cx*u + Cy*v (see Spatial.vorticity_circ). Operators are cached.
+        """
+        if not self.__dict__.has_key('_curl_op'):
+            self._curl_op = {}
+
+        if not self._curl_op.has_key(k):
+            i, ne, valid = self._faceindex()
+            nc1, nc2 = self._facecells(ne,k)
+            tx,ty,mag = self.calc_tangent()
+
+            # Face values are the average of the two cells
+            w = 0.5*mag/self.Ac[:,np.newaxis]
+            rows = np.hstack((i[valid],i[valid]))
+            cols = np.hstack((nc1[valid],nc2[valid]))
+
+            C = []
+            for t in [tx,ty]:
+                c = (t*w)[valid]
+                C.append(sparse.csr_matrix((np.hstack((c,c)),(rows,cols)),\
+                    shape=(self.Nc,self.Nc)))
+
+            self._curl_op[k] = tuple(C)
+
+        return self._curl_op[k]
 
 
     def interpLinear(self,cell_scalar,xpt,ypt,cellind,k=0):
@@ -829,8 +1241,9 @@ class Grid(object):
           duv_over_dxj[0] = -mx/mz;
           duv_over_dxj[1] = -my/mz;
         """
-        if cellind == None:
-            cellind = np.arange(self.Nc,dtype=np.int)
+        if cellind is None:
+            Gx,Gy = self.gradHplane_op(k=k)
+            return self.applyop(Gx,cell_scalar), self.applyop(Gy,cell_scalar)
             
         node_scalar = self.cell2nodekind(cell_scalar,cellind,k=k)
         #self.nc.variables[varname].dimensions
@@ -869,39 +1282,23 @@ class Grid(object):
         The node_scalar array still has size(Np) although nodes that aren't connected
         to cells in 'cellind' are simply zero.
         
-        Uses sparse matrices to do the heavy lifting
+        Uses the cached cell to node operator (cell2node_op) with the cells
+        that are not in 'cellind' removed
         """
-        
+        A = self.cell2node_op(k)
 
-        Nc = cellind.shape[0]
-        ii = np.arange(0,Nc)
-        i = cellind[ii]
+        # Only the cells in cellind contribute
+        sel = np.zeros((self.Nc,))
+        sel[cellind] = 1.
+        phi = np.zeros((self.Nc,))
+        phi[cellind] = cell_scalar[cellind]
 
-        # Find the row and column indices of the sparse matrix
-        rowindex = self.cells[i,:] 
-        colindex = np.repeat(i.reshape((Nc,1)),3,axis=1)
-
-        mask = k <= self.Nk[colindex]
-        
-        cell_scalar3d = np.repeat(cell_scalar[i].reshape((Nc,1)),3,axis=1)
-        area = np.repeat(self.Ac[i].reshape((Nc,1)),3,axis=1)
-        
-        #Build the sparse matrices
-        Asparse = sparse.coo_matrix((area[mask],(rowindex[mask],colindex[mask])),shape=(self.Np,self.Nc),dtype=np.double)
-        datasparse = sparse.coo_matrix((cell_scalar3d[mask],(rowindex[mask],colindex[mask])),shape=(self.Np,self.Nc),dtype=np.double)
-
-        # This step is necessary to avoid summing duplicate elements
-        datasparse=sparse.csr_matrix(datasparse).tocoo()
-        Asparse=sparse.csr_matrix(Asparse).tocoo()
-        
-        node_scalar = datasparse.multiply(Asparse).sum(axis=1) / Asparse.sum(axis=1)
-         
-        # Return a masked array
-        
-        #node_scalar=np.ma.array(node_scalar,mask=mask).squeeze()
-        node_scalar=np.array(node_scalar).squeeze()
-        mask = np.isnan(node_scalar)
-        node_scalar[mask]=0.
+        # Renormalise by the area of the selected cells
+        Asum = A.dot(sel)
+        node_scalar = A.dot(phi)
+        ind = Asum>0
+        node_scalar[ind] /= Asum[ind]
+        node_scalar[ind==False] = 0.
         
         return node_scalar
  
@@ -956,59 +1353,33 @@ class Grid(object):
         
         Based on MATLAB code sungradient.m
         """
-        def _GradientAtFace(phi,jj,k):
-            
-            grad1 = self.grad[:,0]
-            grad2 = self.grad[:,1]
-            nc1 = grad1[jj]
-            nc2 = grad2[jj]
-                    
-            # check for edges (use logical indexing)
-            ind1 = nc1==-1
-            nc1[ind1]=nc2[ind1]
-            ind2 = nc2==-1
-            nc2[ind2]=nc1[ind2]
-            
-            # check depths (walls)
-            indk = operator.or_(k>=self.Nk[nc1], k>=self.Nk[nc2])
-            ind3 = operator.and_(indk, self.Nk[nc2]>self.Nk[nc1])
-            nc1[ind3]=nc2[ind3]
-            ind4 = operator.and_(indk, self.Nk[nc1]>self.Nk[nc2])
-            nc2[ind4]=nc1[ind4]
-            
-            # Calculate gradient across face            
-            return (phi[nc1]-phi[nc2]) / self.dg[jj]
-            
-        ne = self.face #edge-indices
-        mask = ne.mask.copy()
-        ne[mask]=0
-        
-        Gn_phi = _GradientAtFace(phi,ne,k)
-        Gn_phi[mask]=0
-        
-        Gx_phi = Gn_phi * self.n1[ne] * self.DEF * self.df[ne]
-        Gy_phi = Gn_phi * self.n2[ne] * self.DEF * self.df[ne]
-        dX = np.sum(Gx_phi,axis=1)/self.Ac;
-        dY = np.sum(Gy_phi,axis=1)/self.Ac;
+        Gx,Gy = self.gradHdiv_op(k=k)
 
-        return dX, dY
+        return self.applyop(Gx,phi), self.applyop(Gy,phi)
 
-    def spatialfilter(self,phi,dx, ftype='low'):
+    def spatialfilter(self,phi,dx, ftype='low', filterfile=None):
         """
         Perform a gaussian spatial lowpass filter on the
-        variable, phi. 
+        variable, phi [...,Nc]. 
         dx is the filter length (gaussian simga parameter).
+
+        The filter matrix is cached for each dx (and loaded from/saved to
+        filterfile if set).
         """
 
         if not self.__dict__.has_key('_spatialfilter'):
+            self._spatialfilter = {}
+
+        if not self._spatialfilter.has_key(dx):
             print 'Building the filter matrix...'
             xy = np.vstack((self.xv,self.yv)).T
-            self._spatialfilter = ufilter(xy,dx)
+            self._spatialfilter[dx] = ufilter(xy,dx,filterfile=filterfile)
 
+        F = self._spatialfilter[dx]
         if ftype=='low':
-            return self._spatialfilter(phi)
+            return F(phi)
         elif ftype=='high':
-            return phi - self._spatialfilter(phi)
+            return phi - F(phi)
         else:
             raise Exception, 'unknown filter type %s. Must be "low" or "high".'%ftype
 
@@ -1133,15 +1504,23 @@ class Spatial(Grid):
         self.loadGlobals()
 
 
-    def loadData(self, variable=None):
+    def loadData(self, variable=None, packed=False):
         """
         High-level wrapper to load different variables into the 'data' attribute
-        
+
+        Set packed=True to return full-depth 3-D variables (klayer=[-99]) in
+        the compact layout (see Grid.get_index3d)
         """
-        
+
         if variable==None:
             variable=self.variable
-            
+
+        if packed:
+            data = self.loadData(variable=variable)
+            if data is None:
+                data = self.data
+            return self.pack3d(data)
+
         if variable=='speed':
             return self.loadSpeed()
         elif variable=='vorticity':
@@ -1168,14 +1547,14 @@ class Spatial(Grid):
             else:
                 # Calculate dzz internally
                 eta = self.loadDataRaw(variable='eta',setunits=False)
-                return self.getdzz(eta)
+                return self.getdzz(eta).filled(0.)
 
         elif variable=='dzf':
             if self.hasVar('dzf'):
                 return self.loadDataRaw(variable=variable)
             else:
                 eta = self.loadDataRaw(variable='eta',setunits=False)
-                return self.getdzf(eta)
+                return self.getdzf(eta).filled(0.)
 
         elif variable=='ctop':
             eta = self.loadDataRaw(variable='eta',setunits=False)
@@ -1294,6 +1673,40 @@ class Spatial(Grid):
         
         return self.data
     
+    def eof(self,k,variable=None,tchunk=100,areaweight=True,**kwargs):
+        """
+        Leading k empirical orthogonal functions of a variable over all
+        time steps (see mysignal.eofstream)
+
+        The output is read tchunk steps at a time so the [Nt,Nc] matrix is
+        never loaded. 3D variables use layer klayer[0]. Cell variables are
+        weighted by the cell area if areaweight=True.
+
+        Returns PC [Nt,k], eigenvalues [k], EOFs [Nc,k], variance fraction [k]
+        """
+        if variable==None:
+            variable=self.variable
+
+        V = self.nc.variables[variable]
+        kk = self.klayer[0]
+        if V.ndim==3 and not kk in range(V.shape[1]):
+            raise Exception, 'klayer[0] must be a layer index for 3D variables (not %s)'%kk
+
+        def reader(t1,t2):
+            if V.ndim==3:
+                data = V[t1:t2,kk,:]
+            else:
+                data = V[t1:t2,:]
+            data = np.ma.filled(data,0.)
+            data[data==999999.0] = 0.
+            return data
+
+        weights = None
+        if areaweight and self.hasDim(variable,self.griddims['Nc']):
+            weights = self.Ac
+
+        return eofstream(reader,V.shape[0],k,tchunk=tchunk,weights=weights,**kwargs)
+
     def loadDataBar(self,variable=None):
         """
         Load a 3D variable and depth-average i.e. u
@@ -1483,6 +1896,46 @@ class Spatial(Grid):
              plt.quiver(self.xv[1::subsample],self.yv[1::subsample],u[0,1::subsample],v[0,1::subsample],scale=scale,scale_units='xy')
             #print 'Elapsed time: %f seconds'%(time.clock()-tic)
             
+    def imshow(self,z=None,xlims=None,ylims=None,nx=1000,ny=800,titlestr=None,**kwargs):
+        """
+          Plot the unstructured grid data as an image
+
+          The cell under each pixel is cached (see Grid.rasterize) so this is
+          much faster than plot() for large grids
+        """
+        if z==None:
+            # Load the data if it's needed
+            if not self.__dict__.has_key('data'):
+                self.loadData() 
+            z=self.data.ravel()
+        
+        # Find the colorbar limits if unspecified
+        if self.clim==None:
+            self.clim=[]
+            self.clim.append(np.min(z))
+            self.clim.append(np.max(z))
+        # Set the xy limits
+        if xlims==None or ylims==None:
+            xlims=self.xlims 
+            ylims=self.ylims
+
+        img = self.rasterize(z,xlims=xlims,ylims=ylims,nx=nx,ny=ny)
+
+        self.fig = plt.gcf()
+        self.ax = self.fig.gca()
+        self.im = self.ax.imshow(img,origin='lower',interpolation='nearest',\
+            extent=[xlims[0],xlims[1],ylims[0],ylims[1]],\
+            vmin=self.clim[0],vmax=self.clim[1],**kwargs)
+        self.ax.set_aspect('equal')
+        self.cb = self.fig.colorbar(self.im)
+
+        if titlestr==None:
+            plt.title(self.genTitle())
+        else:
+            plt.title(titlestr)
+
+        return self.im
+            
     def plotedgedata(self,z=None,xlims=None,ylims=None,titlestr=None,**kwargs):
         """
           Plot the unstructured grid edge data
@@ -1722,6 +2175,155 @@ class Spatial(Grid):
   
         self.anim = animation.FuncAnimation(fig, updateScalar, frames=len(self.tstep), interval=50, blit=True)
 
+    def animatePNG(self,outdir,tsteps=None,nprocs=1,prefix='frame',xlims=None,ylims=None,\
+        figsize=(8,6),dpi=150,tchunk=50,climstride=10,**kwargs):
+        """
+        Renders a spatial plot of each time step to a numbered PNG file
+
+        Frames are drawn off-screen (Agg) so no display is needed. The time
+        steps are split into contiguous slabs across nprocs worker processes.
+        Each worker reuses one PolyCollection and loads 'tchunk' time steps
+        at a time.
+
+        If clim is unset the colour limits are the min/max of every
+        'climstride'-th time step (read 'tchunk' steps at a time) so all
+        frames share the same limits. Fill values (dry or below-bed cells)
+        are masked and left blank.
+
+        Set raster=True to draw the frames as images (see Grid.rasterize)
+        rather than polygons.
+
+        Frames are named <outdir>/<prefix>_%05d.png and can be stitched with
+        e.g. ffmpeg -i frame_%05d.png movie.mp4
+
+        Returns the list of frame file names
+        """
+        if tsteps is None:
+            tsteps = range(len(self.time))
+        tsteps = list(tsteps)
+        nt = len(tsteps)
+
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+        # Cheap pre-pass for the colour limits
+        if self.clim==None:
+            tstep = self.tstep
+            csteps = tsteps[::climstride]
+            clim = [np.inf,-np.inf]
+            for t1 in range(0,len(csteps),tchunk):
+                self.tstep = csteps[t1:t1+tchunk]
+                data = self._loadmasked()
+                if data.count()>0:
+                    clim = [min(clim[0],float(data.min())),max(clim[1],float(data.max()))]
+            self.tstep = tstep
+        else:
+            clim = self.clim
+
+        # Set the xy limits
+        if xlims==None or ylims==None:
+            xlims=self.xlims 
+            ylims=self.ylims
+
+        frames = range(nt)
+        opts = {'outdir':outdir,'prefix':prefix,'clim':clim,'xlims':xlims,\
+            'ylims':ylims,'figsize':figsize,'dpi':dpi,'tchunk':tchunk}
+        opts.update(kwargs)
+
+        nprocs = max(min(nprocs,nt),1)
+        if nprocs==1:
+            return self.renderPNG(tsteps,frames,**opts)
+
+        # Contiguous slabs of time steps for each process
+        bounds = np.linspace(0,nt,nprocs+1).astype(int)
+        spatialargs = {'klayer':self.klayer,'variable':self.variable}
+        args = [(self.ncfile,spatialargs,tsteps[t1:t2],frames[t1:t2],opts)\
+            for t1,t2 in zip(bounds[:-1],bounds[1:])]
+
+        print 'Rendering %d frames on %d processes...'%(nt,nprocs)
+        pool = Pool(nprocs)
+        try:
+            outfiles = pool.map(_renderPNGWorker,args)
+        finally:
+            pool.close()
+            pool.join()
+
+        return [ff for files in outfiles for ff in files]
+
+    def renderPNG(self,tsteps,frames,outdir='.',prefix='frame',clim=None,xlims=None,\
+        ylims=None,figsize=(8,6),dpi=150,tchunk=50,raster=False,**kwargs):
+        """
+        Renders time steps 'tsteps' to PNG files numbered by 'frames' using
+        the Agg backend (see animatePNG)
+        """
+        if clim==None:
+            clim = self.clim
+        if xlims==None or ylims==None:
+            xlims=self.xlims 
+            ylims=self.ylims
+
+        fig = Figure(figsize=figsize)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+
+        if raster:
+            nx = int(figsize[0]*dpi)
+            ny = int(figsize[1]*dpi)
+            h = ax.imshow(self.rasterize(np.zeros((self.Nc,)),xlims,ylims,nx,ny),\
+                origin='lower',interpolation='nearest',\
+                extent=[xlims[0],xlims[1],ylims[0],ylims[1]],\
+                vmin=clim[0],vmax=clim[1],**kwargs)
+        else:
+            h = PolyCollection(self.xy,**kwargs)
+            h.set_array(np.zeros((self.Nc,)))
+            h.set_clim(vmin=clim[0],vmax=clim[1])
+            ax.add_collection(h)
+        ax.set_aspect('equal')
+        ax.set_xlim(xlims)
+        ax.set_ylim(ylims)
+        title=ax.set_title("")
+        fig.colorbar(h,ax=ax)
+
+        tstep = self.tstep
+        outfiles = []
+        for t1 in range(0,len(tsteps),tchunk):
+            t2 = min(t1+tchunk,len(tsteps))
+            self.tstep = tsteps[t1:t2]
+            data = self._loadmasked().reshape((t2-t1,self.Nc))
+
+            for ii in range(t2-t1):
+                if raster:
+                    h.set_data(self.rasterize(data[ii,:],xlims,ylims,nx,ny))
+                else:
+                    h.set_array(data[ii,:])
+                    h.set_edgecolors(h.to_rgba(data[ii,:]))
+                title.set_text(self.genTitle(tsteps[t1+ii]))
+
+                outfile = '%s/%s_%05d.png'%(outdir,prefix,frames[t1+ii])
+                fig.savefig(outfile,dpi=dpi)
+                outfiles.append(outfile)
+
+            print 'Rendered frames %d to %d...'%(frames[t1],frames[t2-1])
+
+        self.tstep = tstep
+
+        return outfiles
+
+    def _loadmasked(self):
+        """
+        loadData with the fill values (999999) masked
+        """
+        self.mask = None
+        data = self.loadData()
+        if data is None:
+            data = self.data
+
+        mask = np.ma.getmaskarray(data)
+        if not self.mask is None:
+            mask = mask | np.ma.filled(self.mask,True).reshape(mask.shape)
+
+        return np.ma.masked_array(data,mask=mask)
+
     def saveanim(self,outfile,fps=15):
         """
         Save the animation object to an mp4 movie
@@ -1968,47 +2570,11 @@ class Spatial(Grid):
         """
         # Load the velocity
         u,v,w = self.getVector()
-                             
-        def _AverageAtFace(phi,jj,k):
-            
-            grad1 = self.grad[:,0]
-            grad2 = self.grad[:,1]
-            #Apply mask to jj
-            jj[self.cellmask]=0
-            nc1 = grad1[jj]
-            nc2 = grad2[jj]
-                    
-            # check for edges (use logical indexing)
-            ind1 = nc1==-1
-            nc1[ind1]=nc2[ind1]
-            ind2 = nc2==-1
-            nc2[ind2]=nc1[ind2]
-            
-            # check depths (walls)
-            indk = operator.or_(k>=self.Nk[nc1], k>=self.Nk[nc2])
-            ind3 = operator.and_(indk, self.Nk[nc2]>self.Nk[nc1])
-            nc1[ind3]=nc2[ind3]
-            ind4 = operator.and_(indk, self.Nk[nc1]>self.Nk[nc2])
-            nc2[ind4]=nc1[ind4]
-            
-            # Average the values at the face          
-            return 0.5*(phi[nc1]+phi[nc2]) 
-            
-        # Calculate the edge u and v
-        ne = self.face #edge-indices
-        
-        ue = _AverageAtFace(u,ne,k)
-        ve = _AverageAtFace(v,ne,k)
-        ue[self.cellmask]=0
-        ve[self.cellmask]=0
-        
-        tx,ty,mag = self.calc_tangent()
-        
-        tx[self.cellmask]=0
-        ty[self.cellmask]=0
-        
+
+        Cx,Cy = self.curl_op(k=k)
+
         # Now calculate the vorticity
-        return np.sum( (ue*tx + ve*ty )*mag,axis=-1)/self.Ac
+        return self.applyop(Cx,u) + self.applyop(Cy,v)
         
     
         # Plot the result
@@ -2312,56 +2878,78 @@ class Spatial(Grid):
         
         return phiA, area
         
-    def getdzz(self,eta):
+    def getdzz(self,eta,dtype=np.float64):
         """
         Calculate the cell-centred vertical grid spacing based
         on the free surface height only
+
+        eta can be [Nc] or [Nt,Nc]. Returns a [Nkmax,Nc] (or [Nt,Nkmax,Nc])
+        masked array that is masked above ctop and below Nk.
         """
+        eta = np.ma.filled(eta,0.).astype(dtype)
+        ctop = self.getctop(eta)
 
-        z = np.cumsum(self.dz)
-        dzz = np.repeat(self.dz[:,np.newaxis],self.Nc,axis=1)
+        dz = self.dz.astype(dtype)
+        dv = self.dv.astype(dtype)
+        z = np.cumsum(dz)
+        j = np.arange(self.Nc)
 
-        # Find dzz of the top cell
-        ctop = self.getctop(eta)
-        #dztop = self.dz[ctop]+eta
-        dztop = z[ctop]+eta
-        dzz[ctop,range(self.Nc)]=dztop
+        dzz = np.empty(eta.shape[:-1]+(self.Nkmax,self.Nc),dtype=dtype)
+        dzz[...] = dz[:,np.newaxis]
 
         # Find dzz at the bottom
-        dzbot = self.dv - z[self.Nk-1] 
-        dzz[self.Nk,range(self.Nc)]=dzbot
+        dzz[...,self.Nk,j] = dv - (z-dz)[self.Nk]
+
+        # Find dzz of the top cell (this may also be the bottom cell)
+        ctop2 = ctop.reshape((-1,self.Nc))
+        ktop = np.minimum(ctop2,self.Nkmax-1)
+        dztop = np.where(ctop2==self.Nk,dv,z[ktop]) + eta.reshape((-1,self.Nc))
+        t = np.arange(ctop2.shape[0])[:,np.newaxis]
+        dzz.reshape((-1,self.Nkmax,self.Nc))[t,ktop,j] = dztop
 
         # Mask the cells
-        Nk=self.Nk+1
-        for ii in range(self.Nc):
-            dzz[0:ctop[ii],ii]=0.0
-            dzz[Nk[ii]::,ii]=0.0
+        k = np.arange(self.Nkmax)[:,np.newaxis]
+        mask = (k<ctop[...,np.newaxis,:]) | (k>self.Nk)
+        np.putmask(dzz,mask,0.0)
 
-        return dzz
+        return np.ma.MaskedArray(dzz,mask=mask,fill_value=0.)
 
-    def getdzf(self,eta,U=None,method='max',j=None):
+    def getdzf(self,eta,U=None,method='max',j=None,dtype=np.float64):
         """
         Calculate the edge-centred vertical grid spacing based
         on the free surface height only
-        """
 
+        eta can be [Nc] or [Nt,Nc] (edge values [Ne] or [Nt,Ne] if j is set).
+        Returns a [Nkmax,Ne] (or [Nt,Nkmax,Ne]) masked array that is masked
+        above etop and below Nke.
+        """
+        eta = np.ma.filled(eta,0.).astype(dtype)
         etop,etaedge = self.getetop(eta,U=U,method=method,j=j)
-        Ne = etop.shape[0]
+        if j is None:
+            Nke = self.Nke
+        else:
+            Nke = self.Nke[j]
+        Ne = etop.shape[-1]
 
-        # Find dzz of the top cell
-        dztop = self.dz[etop]+etaedge
+        dz = self.dz.astype(dtype)
+        z = np.cumsum(dz)
 
-        dzf = np.repeat(self.dz[:,np.newaxis],Ne,axis=1)
+        dzf = np.empty(etop.shape[:-1]+(self.Nkmax,Ne),dtype=dtype)
+        dzf[...] = dz[:,np.newaxis]
 
-        dzf[etop,range(Ne)]=dztop
+        # Find dzf of the top cell
+        etop2 = etop.reshape((-1,Ne))
+        ktop = np.minimum(etop2,self.Nkmax-1)
+        t = np.arange(etop2.shape[0])[:,np.newaxis]
+        dzf.reshape((-1,self.Nkmax,Ne))[t,ktop,np.arange(Ne)] =\
+            z[ktop] + etaedge.reshape((-1,Ne))
 
         # Mask the cells
-        #mask = self.get_zmask(etop,self.Nke)
-        for ii in range(Ne):
-            dzf[0:etop[ii],ii]=0.0
-            dzf[self.Nke[ii]::,ii]=0.0
+        k = np.arange(self.Nkmax)[:,np.newaxis]
+        mask = (k<etop[...,np.newaxis,:]) | (k>=Nke)
+        np.putmask(dzf,mask,0.0)
 
-        return dzf
+        return np.ma.MaskedArray(dzf,mask=mask,fill_value=0.)
 
 
     def getctop(self,eta):
@@ -2378,7 +2966,7 @@ class Spatial(Grid):
         """
         Return the layer of the top edge
         """
-        if j==None:
+        if j is None:
             eta_edge = self.get_edgevar(eta,U=U,method=method)
         else:
             eta_edge = eta
@@ -2431,6 +3019,8 @@ class Spatial(Grid):
         """
         Return the edge value of a cell-based variable
 
+        phi can be [Nc] or [...,Nc]
+
         Method can be one of:
             'max' - maximum value either side
             'min' - minimum value either side
@@ -2459,28 +3049,22 @@ class Spatial(Grid):
 
         
         if method=='max':
-            tmp = np.zeros((Ne,2),dtype=phi.dtype)
-            tmp[:,0]=phi[nc1]
-            tmp[:,1]=phi[nc2]
-            return tmp.max(axis=-1)
+            phi = np.asarray(phi)
+            return np.maximum(phi[...,nc1],phi[...,nc2])
 
         elif method=='min':
-            tmp = np.zeros((Ne,2),dtype=phi.dtype)
-            tmp[:,0]=phi[nc1]
-            tmp[:,1]=phi[nc2]
-            return tmp.min(axis=-1)
+            phi = np.asarray(phi)
+            return np.minimum(phi[...,nc1],phi[...,nc2])
 
         elif method=='mean':
             # Average the values at the face          
-            return 0.5*(phi[nc1]+phi[nc2]) 
+            return 0.5*(phi[...,nc1]+phi[...,nc2]) 
 
         elif method=='upwind':
-            if U==None:
+            if U is None:
                 raise Exception, 'U must be set to use upwind method'
 
-            ind = U>0
-            nc1[ind]=nc2[ind]
-            return phi[nc1]
+            return np.where(U>0,phi[...,nc2],phi[...,nc1])
 
         else:
             raise Exception, 'Method: %s not implemented.'%method
@@ -2515,10 +3099,19 @@ class Spatial(Grid):
 class TimeSeries(timeseries, Spatial):
     """
     Time series class for suntans output
+
+    Reads from the time series chunked copy of ncfile (see sunrechunk.py)
+    if it exists. Set tsfile to use a different copy.
     """    
+    tsfile = None
     
     def __init__(self,ncfile,XY,Z=None,klayer=None,**kwargs):
         
+        tsfile = findrechunk(ncfile,kwargs.get('tsfile',self.tsfile))
+        if not tsfile is None:
+            print 'Reading time series from: %s'%tsfile
+            ncfile = tsfile
+
         Spatial.__init__(self,ncfile,**kwargs)
         
         self.XY = XY
@@ -2589,8 +3182,187 @@ class TimeSeries(timeseries, Spatial):
         else:
             self.__dict__[key]=value
         
-        
-                  
+class StationTimeSeries(Spatial):
+    """
+    Time series of suntans output at many stations
+
+    The nearest cells to all of the stations are found with one KD-tree
+    query and each chunk of time steps of a variable is read once for all
+    stations. Reads from the time series chunked copy of ncfile (see
+    sunrechunk.py) if it exists.
+
+    Inputs:
+        ncfile - suntans output file(s)
+        XY - [Nstation x 2] array of station coordinates
+        Z - [Nstation] station depths (optional). 3D variables are
+            interpolated to these depths, otherwise all layers are returned.
+        stationnames - list of station names (optional)
+    """
+    tsfile = None
+    tchunk = 500 # Number of time steps to read at once
+    zinterp = 'linear' # Vertical interpolation to Z: 'linear' or 'nearest'
+
+    def __init__(self,ncfile,XY,Z=None,stationnames=None,**kwargs):
+
+        tsfile = findrechunk(ncfile,kwargs.get('tsfile',self.tsfile))
+        if not tsfile is None:
+            print 'Reading time series from: %s'%tsfile
+            ncfile = tsfile
+
+        Spatial.__init__(self,ncfile,**kwargs)
+
+        self.XY = np.asarray(XY,dtype=np.float64).reshape((-1,2))
+        self.Nstation = self.XY.shape[0]
+
+        if Z is None:
+            self.Z = None
+        else:
+            self.Z = np.abs(np.asarray(Z,dtype=np.float64)).ravel()
+            if self.Z.size==1:
+                self.Z = self.Z*np.ones((self.Nstation,))
+
+        if stationnames is None:
+            stationnames = ['Station %d'%ii for ii in range(self.Nstation)]
+        self.stationnames = stationnames
+
+        self.tstep = range(0,len(self.time)) # Load all time steps
+
+        # Nearest cells to all stations
+        self.dist, self.j = self.find_nearest(self.XY)
+
+        if not self.Z is None:
+            self.zweights()
+
+    def __call__(self,varname):
+        """
+        Returns the time series of varname at the stations
+        """
+        return self.extract(varname)
+
+    def zweights(self):
+        """
+        Layers and weights used to interpolate 3D variables to the station
+        depths. Depths outside of the wet layers of a cell use the top or
+        bottom layer.
+        """
+        nk = self.Nk[self.j]
+        z = np.clip(self.Z,self.z_r[0],self.z_r[nk])
+
+        k1 = np.searchsorted(self.z_r,z)
+        k1 = np.minimum(np.maximum(k1,1),nk)
+        k0 = np.maximum(k1-1,0)
+
+        dz = self.z_r[k1]-self.z_r[k0]
+        w = np.zeros_like(z)
+        ind = dz>0
+        w[ind] = (z[ind]-self.z_r[k0[ind]])/dz[ind]
+
+        if self.zinterp == 'nearest':
+            w = np.round(w)
+
+        self._k0, self._k1, self._w = k0, k1, w
+
+    def readchunk(self,varname,t1,t2):
+        """
+        Reads time steps t1:t2 of varname at all stations
+
+        Returns an array [nt,Nstation], or [nt,Nk,Nstation] for 3D variables
+        when there are no station depths
+        """
+        if not self.hasDim(varname,self.griddims['Nc']):
+            raise Exception, 'variable %s is not defined on the cells'%varname
+
+        # Read each cell once (netcdf needs increasing indices)
+        jj, inv = np.unique(self.j,return_inverse=True)
+
+        V = self.nc.variables[varname]
+        data = np.ma.filled(V[t1:t2,...,jj.tolist()],0.)
+        data = data[...,inv]
+        data[data==999999.0] = 0.
+
+        if data.ndim==3 and not self.Z is None:
+            ss = np.arange(self.Nstation)
+            data = data[:,self._k0,ss]*(1-self._w) + data[:,self._k1,ss]*self._w
+
+        return data
+
+    def extract(self,varname):
+        """
+        Returns the time series of varname at the stations (see readchunk)
+        """
+        tstep = np.asarray(self.tstep)
+        t1, t2 = tstep[0], tstep[-1]+1
+
+        return np.concatenate([self.readchunk(varname,tt,min(tt+self.tchunk,t2))\
+            for tt in range(t1,t2,self.tchunk)],axis=0)
+
+    def extract2nc(self,outfile,varnames):
+        """
+        Extracts the variables in varnames at the stations and writes them
+        to a station-indexed netcdf file
+        """
+        tstep = np.asarray(self.tstep)
+        t1, t2 = tstep[0], tstep[-1]+1
+
+        print 'Generating file: %s...'%outfile
+        nc = Dataset(outfile, 'w', format='NETCDF4')
+        nc.Description = 'SUNTANS station time series'
+        nc.Created = datetime.now().isoformat()
+        nc.source = str(self.ncfile)
+
+        nc.createDimension('station', self.Nstation)
+        nc.createDimension('Nk', self.Nkmax)
+        nc.createDimension('time', t2-t1)
+
+        def create_var(name, dimensions, attdict, dtype='f8'):
+            tmp = nc.createVariable(name, dtype, dimensions)
+            for aa in attdict.keys():
+                tmp.setncattr(aa,attdict[aa])
+            return tmp
+
+        tin = self.nc.variables[self.gridvars['time']]
+        create_var('time',('time',),{'long_name':'time','units':tin.units})
+        nc.variables['time'][:] = tin[t1:t2]
+
+        create_var('station_name',('station',),{'long_name':'station name'},dtype=str)
+        for ii,name in enumerate(self.stationnames):
+            nc.variables['station_name'][ii] = name
+        create_var('X',('station',),{'long_name':'station x coordinate','units':'m'})
+        nc.variables['X'][:] = self.XY[:,0]
+        create_var('Y',('station',),{'long_name':'station y coordinate','units':'m'})
+        nc.variables['Y'][:] = self.XY[:,1]
+        if not self.Z is None:
+            create_var('Z',('station',),{'long_name':'station depth','units':'m','positive':'down'})
+            nc.variables['Z'][:] = self.Z
+        create_var('cell',('station',),{'long_name':'nearest grid cell'},dtype='i4')
+        nc.variables['cell'][:] = self.j
+        create_var('dist',('station',),{'long_name':'distance to the nearest cell centre','units':'m'})
+        nc.variables['dist'][:] = self.dist
+        create_var('z_r',('Nk',),{'long_name':'depth at layer mid points','units':'m','positive':'down'})
+        nc.variables['z_r'][:] = self.z_r
+
+        for vv in varnames:
+            V = self.nc.variables[vv]
+            if V.ndim==3 and self.Z is None:
+                dims = ('time','Nk','station')
+            else:
+                dims = ('time','station')
+            atts = {'units':getattr(V,'units','')}
+            if hasattr(V,'long_name'):
+                atts['long_name'] = V.long_name
+            create_var(vv,dims,atts)
+
+        # Read each chunk of time steps once for all stations
+        for tt in range(t1,t2,self.tchunk):
+            tend = min(tt+self.tchunk,t2)
+            print 'Extracting time steps %d - %d...'%(tt,tend)
+            for vv in varnames:
+                nc.variables[vv][tt-t1:tend-t1,...] = self.readchunk(vv,tt,tend)
+            nc.sync()
+
+        nc.close()
+        print 'Done.'
+
 class Profile(object):
     """
         Class for handling SUNTANS profile netcdf files
@@ -2971,6 +3743,14 @@ class Profile(object):
 # General functions to be used by all classes
 #
 ####################################################################        
+def _renderPNGWorker(args):
+    """
+    Renders a slab of time steps to PNG files (see Spatial.animatePNG)
+    """
+    ncfile, spatialargs, tsteps, frames, opts = args
+    sun = Spatial(ncfile,**spatialargs)
+    return sun.renderPNG(tsteps,frames,**opts)
+
 def closePoly(x,y):
 
     """ 
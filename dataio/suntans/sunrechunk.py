@@ -0,0 +1,282 @@
+#!/usr/bin/python
+
+"""
+Script for rechunking suntans netcdf output for time series extraction
+
+SUNTANS writes one time step at a time so every read of a point time series
+touches every chunk in the output. This tool writes a copy of the (possibly
+multi-file) output with long time chunks over small blocks of cells/edges.
+The copy is read transparently by sunpy.TimeSeries when it exists.
+
+Created October 2016
+
+@author: mrayson
+"""
+
+from netCDF4 import Dataset
+import numpy as np
+import getopt, sys, os, glob, time
+
+# Suffix of the default rechunked file name
+SUFFIX = '_tschunk.nc'
+
+def rechunk(ncfile,outfile=None,varnames=None,chunkmb=4.,maxmem=512.,\
+        zlib=False,complevel=1):
+    """
+    Write a time series chunked copy of suntans output file(s)
+
+    Inputs:
+        ncfile - output file name, list of file names or glob pattern
+        outfile - [default: rechunkname(ncfile)]
+        varnames - list of time-varying variables to copy [default: all]
+        chunkmb - target chunk size in MB. Each chunk spans the whole record
+            (or as much as fits) over as many cells/edges as fit.
+        maxmem - memory limit in MB for the copy buffer. Each variable is
+            read from the model output once (see copyvar).
+    """
+    tic = time.time()
+    ncfiles = ncfilelist(ncfile)
+    if len(ncfiles)==0:
+        raise Exception, 'no files match %s'%ncfile
+    if outfile is None:
+        outfile = rechunkname(ncfiles)
+
+    ncin = [Dataset(ff,'r') for ff in ncfiles]
+    nt = [len(nc.dimensions['time']) for nc in ncin]
+    Nt = sum(nt)
+    toff = np.cumsum([0]+nt)
+
+    print 'Generating file: %s...'%outfile
+    nc = Dataset(outfile,'w',format='NETCDF4')
+    for aa in ncin[0].ncattrs():
+        nc.setncattr(aa,ncin[0].getncattr(aa))
+    nc.setncattr('rechunked_from',' '.join([os.path.abspath(ff) for ff in ncfiles]))
+
+    for dd in ncin[0].dimensions.keys():
+        if dd=='time':
+            nc.createDimension(dd,Nt)
+        else:
+            nc.createDimension(dd,len(ncin[0].dimensions[dd]))
+
+    for vv in ncin[0].variables.keys():
+        V = ncin[0].variables[vv]
+        V.set_auto_maskandscale(False)
+        istime = len(V.dimensions)>0 and V.dimensions[0]=='time'
+        if istime and V.ndim>1 and not varnames is None and not vv in varnames:
+            continue
+
+        atts = dict([(aa,V.getncattr(aa)) for aa in V.ncattrs()])
+        fill_value = atts.pop('_FillValue',None)
+
+        if istime and V.ndim>1:
+            chunks = chunkshape(V.shape[1:],Nt,V.dtype.itemsize,chunkmb)
+            tmp = nc.createVariable(vv,V.dtype,V.dimensions,zlib=zlib,\
+                complevel=complevel,fill_value=fill_value,chunksizes=chunks)
+        else:
+            tmp = nc.createVariable(vv,V.dtype,V.dimensions,fill_value=fill_value)
+        tmp.setncatts(atts)
+        tmp.set_auto_maskandscale(False)
+
+        if not istime:
+            # Grid variables
+            if V.ndim==0:
+                tmp.assignValue(V.getValue())
+            else:
+                tmp[:] = V[:]
+        elif V.ndim==1:
+            tmp[:] = np.hstack([ff.variables[vv][:] for ff in ncin])
+        else:
+            print '\t%s...'%vv
+            copyvar(ncin,toff,vv,tmp,maxmem,outfile+'.tmp')
+        nc.sync()
+
+    nc.close()
+    for ff in ncin:
+        ff.close()
+
+    print 'Elapsed time %10.3f seconds.'%(time.time()-tic)
+
+    return outfile
+
+def copyvar(ncin,toff,varname,outvar,maxmem,tmpfile):
+    """
+    Copy a time-varying variable reading each time step of the model output
+    once. All writes are aligned to the output chunks so each chunk is
+    written once.
+
+    If a time chunk of the output (all cells/edges) fits in maxmem it is
+    copied directly. Otherwise the variable is first copied in time slabs
+    into a scratch file, tmpfile, with chunks [slab, ..., output chunk] that
+    are then read in blocks of whole output chunks.
+    """
+    Nt = toff[-1]
+    tc = outvar.chunking()[0]
+    cc = outvar.chunking()[-1]
+    shp = outvar.shape
+    nj = shp[-1]
+    rowbytes = outvar.dtype.itemsize*np.prod(shp[1:])
+    membytes = maxmem*2**20
+
+    if tc*rowbytes <= membytes:
+        for t1 in range(0,Nt,tc):
+            t2 = min(t1+tc,Nt)
+            outvar[t1:t2,...] = readblock(ncin,toff,varname,t1,t2,0,nj)
+        return
+
+    # Time steps per slab (tc is usually Nt, otherwise the scratch chunks
+    # that straddle two output time chunks are read twice)
+    nslab = min(max(1,int(membytes/rowbytes)),tc)
+
+    nc = Dataset(tmpfile,'w',format='NETCDF4')
+    for dd,nn in zip(outvar.dimensions,shp):
+        nc.createDimension(dd,nn)
+    tmp = nc.createVariable(varname,outvar.dtype,outvar.dimensions,\
+        chunksizes=(nslab,)+tuple(shp[1:-1])+(cc,))
+    tmp.set_auto_maskandscale(False)
+
+    for t1 in range(0,Nt,nslab):
+        t2 = min(t1+nslab,Nt)
+        tmp[t1:t2,...] = readblock(ncin,toff,varname,t1,t2,0,nj)
+    nc.sync()
+
+    # Number of cells/edges per block (a multiple of the chunk size)
+    nblock = max(1,int(membytes/(rowbytes/nj*tc*cc)))*cc
+    nblock = min(nblock,nj)
+
+    for j1 in range(0,nj,nblock):
+        j2 = min(j1+nblock,nj)
+        for t1 in range(0,Nt,tc):
+            t2 = min(t1+tc,Nt)
+            outvar[t1:t2,...,j1:j2] = tmp[t1:t2,...,j1:j2]
+
+    nc.close()
+    os.remove(tmpfile)
+
+def readblock(ncin,toff,varname,t1,t2,j1,j2):
+    """
+    Read steps t1:t2 of a variable that is split across files
+    """
+    data = []
+    for nc,ta,tb in zip(ncin,toff[:-1],toff[1:]):
+        if tb<=t1 or ta>=t2:
+            continue
+        V = nc.variables[varname]
+        V.set_auto_maskandscale(False)
+        data.append(V[max(t1,ta)-ta:min(t2,tb)-ta,...,j1:j2])
+
+    return np.concatenate(data,axis=0)
+
+def chunkshape(shape,Nt,itemsize,chunkmb):
+    """
+    Chunk sizes [time, ..., j] for a variable with non-time dimensions shape
+    """
+    nbytes = itemsize*np.prod(shape[:-1])
+    target = chunkmb*2**20
+
+    nj = int(target/(nbytes*Nt))
+    if nj>=1:
+        tc = Nt
+    else:
+        nj = 1
+        tc = max(1,int(target/nbytes))
+
+    return (tc,)+tuple(shape[:-1])+(min(nj,shape[-1]),)
+
+def ncfilelist(ncfile):
+    """
+    Returns a sorted list of files from a file name, list or glob pattern
+    """
+    if isinstance(ncfile,list):
+        return ncfile
+    elif '*' in ncfile or '?' in ncfile:
+        return sorted(glob.glob(ncfile))
+    else:
+        return [ncfile]
+
+def rechunkname(ncfile):
+    """
+    Default name of the rechunked copy of ncfile (None if there are no files)
+    """
+    ncfiles = ncfilelist(ncfile)
+    if len(ncfiles)==0:
+        return None
+    basename = os.path.splitext(ncfiles[0])[0]
+    if len(ncfiles)>1:
+        # Strip the file number e.g. suntans_0001.nc
+        basename = basename.rstrip('0123456789').rstrip('_')
+
+    return basename+SUFFIX
+
+def findrechunk(ncfile,tsfile=None):
+    """
+    Returns the rechunked copy of ncfile if it exists and is newer than the
+    output file(s), otherwise None
+    """
+    ncfiles = ncfilelist(ncfile)
+    if len(ncfiles)==0:
+        return None
+
+    if tsfile is None:
+        tsfile = rechunkname(ncfiles)
+
+    if not os.path.isfile(tsfile):
+        return None
+
+    mtime = max([os.path.getmtime(ff) for ff in ncfiles])
+    if os.path.getmtime(tsfile) < mtime:
+        print 'Warning: %s is older than the model output. Ignoring.'%tsfile
+        return None
+
+    return tsfile
+
+def usage():
+    print "--------------------------------------------------------------"
+    print "sunrechunk.py   -h               # show this help message      "
+    print "         -f 'suntans*.nc'     # SUNTANS output netcdf file(s)  "
+    print "         -o outfile.nc        # Output file (default: <ncfile>%s)"%SUFFIX
+    print " 	    -v  'var1 var2 ...'  # List of variables to write (default: all)"
+    print "         -c  N                # Chunk size in MB (default: 4)"
+    print "         -m  N                # Memory limit in MB (default: 512)"
+    print "\n\n Example Usage:"
+    print "-----------"
+    print " python sunrechunk.py -f 'rundata/suntans_*.nc' -v 'eta temp'"
+    print ""
+
+if __name__ == '__main__':
+    """
+        Command line call to the rechunk function
+    """
+    ncfile = None
+    outfile = None
+    varnames = None
+    chunkmb = 4.
+    maxmem = 512.
+
+    try:
+        opts,rest = getopt.getopt(sys.argv[1:],'hf:o:v:c:m:')
+    except getopt.GetoptError,e:
+        print e
+        print "-"*80
+        usage()
+        exit(1)
+
+    for opt,val in opts:
+        if opt == '-h':
+            usage()
+            exit(1)
+        elif opt == '-f':
+            ncfile = val
+        elif opt == '-o':
+            outfile = val
+        elif opt == '-v':
+            varnames = val.split()
+        elif opt == '-c':
+            chunkmb = float(val)
+        elif opt == '-m':
+            maxmem = float(val)
+
+    if ncfile is None:
+        usage()
+        exit(1)
+
+    rechunk(ncfile,outfile=outfile,varnames=varnames,chunkmb=chunkmb,maxmem=maxmem)
@@ -10,6 +10,10 @@ Created on Wed Jul 03 12:29:14 2013
 from sunpy import Spatial
 from trisearch import TriSearch
 import numpy as np
+from scipy import sparse
+import os
+import hashlib
+from netCDF4 import Dataset
 from datetime import datetime
 import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
@@ -28,10 +32,15 @@ class Slice(Spatial):
     """
     Suntans vertical slice class
     """
+
+    # Number of time steps interpolated with each sparse product
+    tchunk = 100
+    # Save/load the slice operator to/from disk next to the grid file
+    opcache = False
     
-    def __init__(self,ncfile,xpt=None,ypt=None,Npt=100):
+    def __init__(self,ncfile,xpt=None,ypt=None,Npt=100,**kwargs):
         
-        Spatial.__init__(self,ncfile,klayer=[-99])
+        Spatial.__init__(self,ncfile,klayer=[-99],**kwargs)
         
         # Calculate the horizontal coordinates of the slice
         self.Npt = Npt
@@ -49,12 +58,12 @@ class Slice(Spatial):
         """
         Load the data and interpolate on the slice
         """
-        self.tstep=tstep
         try:
             self.Ntslice = len(tstep)
         except:
             tstep=[tstep]
             self.Ntslice = 1
+        self.tstep=tstep
             
         
         self.data = self.interpSlice(variable,method=method)
@@ -239,6 +248,188 @@ class Slice(Spatial):
     def interpSlice(self,variable,method='linear'):
         """
         Interpolates the data in raw data onto the slice array
+
+        Blocks of 'tchunk' time steps are interpolated with a single product
+        with the sparse slice operator (see sliceOperator)
+        """
+        if method=='linear' and self.maxfaces>3:
+            return self.interpSliceLoop(variable,method=method)
+
+        A = self.sliceOperator(method=method)
+
+        # Only the columns (cells) used by the slice need to be multiplied
+        cols = np.unique(A.indices)
+        A = A[:,cols]
+
+        tstep = self.tstep
+        slicedata = np.zeros((self.Ntslice,self.Nkmax,self.Npt))
+
+        for t1 in range(0,self.Ntslice,self.tchunk):
+            t2 = min(t1+self.tchunk,self.Ntslice)
+            if self.Ntslice>1:
+                print 'Slicing data at time-steps: %d to %d of %d...'%(t1,t2,self.Ntslice)
+
+            self.tstep=tstep[t1:t2]
+            rawdata = self.loadData(variable=variable)
+            rawdata = np.asarray(rawdata).reshape((t2-t1,self.Nkmax*self.Nc))
+
+            slicedata[t1:t2,...] = A.dot(rawdata[:,cols].T).T.reshape((t2-t1,self.Nkmax,self.Npt))
+
+        slicedata[:,self._opmask==False] = np.nan
+        
+        self.tstep=tstep
+        
+        return slicedata
+
+    def sliceOperator(self,method='linear'):
+        """
+        Returns the sparse (CSR) operator [Nkmax*Npt x Nkmax*Nc] that maps a
+        cell-centred variable (flattened from [Nkmax,Nc]) onto the slice points
+
+        The rows of masked slice points are empty. Operators are cached and,
+        if 'opcache' is set, saved to and loaded from disk next to the grid.
+        """
+        if not self.__dict__.has_key('_sliceop'):
+            self._sliceop = {}
+
+        if not self._sliceop.has_key(method):
+            opfile = self.sliceOperatorFile(method=method)
+            A = None
+            if self.opcache and os.path.exists(opfile):
+                A = self.loadSliceOperator(opfile)
+
+            if A is None:
+                A = self.buildSliceOperator(method=method)
+                if self.opcache:
+                    self.saveSliceOperator(A,opfile)
+
+            self._sliceop[method] = A
+
+        return self._sliceop[method]
+
+    def buildSliceOperator(self,method='linear'):
+        """
+        Construct the sparse slice operator (see sliceOperator)
+
+        'nearest' takes the value of the cell containing each point. 'linear'
+        adds the gradient of the plane through the area-weighted nodal values
+        as in Grid.interpLinear i.e. phi[i] + dphi_dx*dx + dphi_dy*dy.
+        """
+        if not method in ['nearest','linear']:
+            raise Exception, ' unknown interpolation method: %s. Must be "nearest" or "linear"'%method
+
+        pts = np.arange(self.Npt)
+        cellind = np.array(self.cellind).copy()
+        cellind[cellind<0] = 0
+
+        I = sparse.csr_matrix((np.ones((self.Npt,)),(pts,cellind)),\
+            shape=(self.Npt,self.Nc))
+
+        if method=='linear':
+            # Weights of the three nodal values in the planar gradient
+            # (see Grid.gradHplane)
+            cells = np.asarray(self.cells)[cellind,0:3]
+            xA = self.xp[cells[:,0]]
+            yA = self.yp[cells[:,0]]
+            ABx = self.xp[cells[:,1]] - xA
+            ABy = self.yp[cells[:,1]] - yA
+            ACx = self.xp[cells[:,2]] - xA
+            ACy = self.yp[cells[:,2]] - yA
+            mz = ABx*ACy - ACx*ABy
+
+            dx = self.xslice[0,:] - self.xv[cellind]
+            dy = self.yslice[0,:] - self.yv[cellind]
+
+            wB = (ACy*dx - ACx*dy)/mz
+            wC = (ABx*dy - ABy*dx)/mz
+            wA = -wB - wC
+
+            N = sparse.csr_matrix((np.hstack((wA,wB,wC)),(np.tile(pts,3),cells.T.ravel())),\
+                shape=(self.Npt,self.Np))
+
+            usecells = np.unique(self.cellind[self.cellind>=0])
+
+        blocks = []
+        for kk in range(self.Nkmax):
+            L = I
+            if method=='linear':
+                L = L + N*self._sliceNodeOp(usecells,kk)
+
+            # Empty the rows of the masked points
+            L = sparse.spdiags(self._opmask[kk,:].astype(np.double),0,self.Npt,self.Npt)*L
+            blocks.append(L)
+
+        A = sparse.block_diag(blocks,format='csr')
+        A.eliminate_zeros()
+
+        return A
+
+    def _sliceNodeOp(self,cellind,k):
+        """
+        Area-weighted cell to node operator [Np x Nc] using only the cells in
+        'cellind' that are active in layer k (as in Grid.cell2nodekind)
+        """
+        i = cellind[k<=self.Nk[cellind]]
+        cells = np.asarray(self.cells)[i,0:3]
+
+        W = sparse.coo_matrix((np.repeat(self.Ac[i],3),(cells.ravel(),np.repeat(i,3))),\
+            shape=(self.Np,self.Nc),dtype=np.double).tocsr()
+
+        Wsum = np.array(W.sum(axis=1)).ravel()
+        Wsum[Wsum==0] = 1.
+        W.data /= np.repeat(Wsum,np.diff(W.indptr))
+
+        return W
+
+    def sliceOperatorFile(self,method='linear'):
+        """
+        Default file name of the cached slice operator
+
+        The name is a hash of the slice coordinates and the vertical grid so
+        different transects of the same grid can be cached side by side
+        """
+        if isinstance(self.infile,list):
+            gridfile = self.infile[0]
+        else:
+            gridfile = self.infile
+
+        key = hashlib.md5()
+        key.update(method)
+        key.update(np.asarray(self.xslice[0,:],dtype=np.double).tostring())
+        key.update(np.asarray(self.yslice[0,:],dtype=np.double).tostring())
+        key.update(np.asarray(self.Nk,dtype=np.int64).tostring())
+
+        return '%s_slice_%s.npz'%(os.path.splitext(gridfile.rstrip('/'))[0],key.hexdigest()[0:12])
+
+    def saveSliceOperator(self,A,opfile):
+        """
+        Save a sparse slice operator to a numpy .npz file
+        """
+        print 'Saving slice operator to: %s'%opfile
+        np.savez(opfile,data=A.data,indices=A.indices,indptr=A.indptr,\
+            shape=np.array(A.shape))
+
+    def loadSliceOperator(self,opfile):
+        """
+        Load a sparse slice operator from a numpy .npz file
+
+        Returns None if the operator does not match the grid and slice size
+        """
+        print 'Loading slice operator from: %s'%opfile
+        op = np.load(opfile)
+        shape = tuple(op['shape'])
+        if not shape == (self.Nkmax*self.Npt,self.Nkmax*self.Nc):
+            print 'Warning: slice operator in %s has the wrong size. Rebuilding...'%opfile
+            return None
+
+        return sparse.csr_matrix((op['data'],op['indices'],op['indptr']),shape=shape)
+
+    def interpSliceLoop(self,variable,method='linear'):
+        """
+        Interpolates the data in raw data onto the slice array
+
+        Layer by layer and time step by time step version of interpSlice. Used
+        for linear interpolation on non-triangular grids.
         """
         tstep = self.tstep
         slicedata = np.zeros((self.Ntslice,self.Nkmax,self.Npt))
@@ -311,12 +502,10 @@ class Slice(Spatial):
 
     def calc_mask(self):
         """ Construct the mask array"""
-        self.maskslice = np.zeros((self.Nkmax,self.Npt),dtype=np.bool)
-        
-        for kk in range(self.Nkmax):
-            for ii in range(self.Npt):
-                if kk <= self.Nk[self.cellind[ii]]:
-                    self.maskslice[kk,ii]=True
+        self.maskslice = self.get_mask3d()[:,self.cellind]
+
+        # Points outside of the grid are also masked by the slice operator
+        self._opmask = self.maskslice & (self.cellind>=0)[np.newaxis,:]
     
     def _getSliceCoords(self,kind=3):
         """
@@ -408,6 +597,13 @@ class SliceEdge(Slice):
     """
 
     edgemethod=1
+
+    # Number of time steps read at once by calc_flux
+    tchunk = 100
+    # Reference density [kg m-3] and heat capacity [J kg-1 K-1] for heat fluxes
+    rho0 = 1000.
+    cp = 3990.
+
     def __init__(self,ncfile,xpt=None,ypt=None,Npt=100,klayer=[-99],**kwargs):
         
         self.Npt=Npt
@@ -525,7 +721,7 @@ class SliceEdge(Slice):
             if variable=='area':
                 eta = nc.variables['eta'][tt,:]
                 dzf = self.getdzf(eta)
-                dzf = Spatial.getdzf(self,eta)
+                dzf = Spatial.getdzf(self,eta).filled(0.)
 
                 return self.df*dzf
 
@@ -665,7 +861,7 @@ class SliceEdge(Slice):
 
     def getdzf(self,eta):
         """ Get the cell thickness along each edge of the slice"""
-        dzf = Spatial.getdzf(self,eta,j=self.j)
+        dzf = Spatial.getdzf(self,eta,j=self.j).filled(0.)
         dzf[self.maskslice]=0
         return dzf
 
@@ -680,6 +876,229 @@ class SliceEdge(Slice):
         width[self.maskslice]=0
         return width
 
+    def transects(self):
+        """
+        Returns a list with a dictionary for each transect containing the
+        edge normals, 'normal', and the index of the edges in self.j, 'subind'
+        """
+        return [{'j':self.j,'normal':self.enormal,'subind':np.arange(len(self.j))}]
+
+    def flux_matrix(self):
+        """
+        Sparse matrix [Ntransect x len(self.j)] that sums the (signed) edge
+        fluxes onto each transect
+        """
+        rows,cols,vals = [],[],[]
+        for ii,ss in enumerate(self.transects()):
+            rows.append(ii*np.ones((len(ss['subind']),),dtype=np.int))
+            cols.append(ss['subind'])
+            vals.append(ss['normal'])
+
+        return sparse.csr_matrix((np.hstack(vals),(np.hstack(rows),np.hstack(cols))),\
+            shape=(len(rows),len(self.j)))
+
+    def calc_flux(self,tstep=None,tracers=[],outfile=None):
+        """
+        Calculate the volume and tracer fluxes through each transect
+
+        U, eta and the tracers are read once for the edges of all of the
+        transects in chunks of 'tchunk' time steps (only the edges/cells that
+        are needed, see readruns). The edge fluxes are summed
+        onto each transect with flux_matrix so memory is bounded by the chunk
+        size. The flux through a transect is the same as
+
+            sum_k sum_j normal_j * U * area * phi
+
+        where U, area and phi are from SliceEdge.loadData (cell-centred
+        tracers are the mean of the two cells either side of the edge).
+
+        Returns a dictionary with the time series [Nt x Ntransect] of:
+            'Q' - volume flux [m3 s-1]
+            'F_<tracer>' - tracer flux [tracer units * m3 s-1]
+            'heat' - heat flux [W] (if 'temp' is in tracers)
+
+        If outfile is set the time series are also written to a netcdf file
+        as each chunk is calculated. See check_flux to compare the result with
+        the per-transect calculation.
+        """
+        if tstep is None:
+            tstep = range(self.Nt)
+        tstep = list(tstep)
+        nt = len(tstep)
+
+        nc = self.nc
+        j = np.array(self.j)
+        ne = j.shape[0]
+        M = self.flux_matrix()
+        ntransect = M.shape[0]
+
+        # Unique (sorted) edges and cells that are read from the file
+        jj, jinv = np.unique(j,return_inverse=True)
+
+        nc1 = self.grad[j,0].copy()
+        nc2 = self.grad[j,1].copy()
+        ind1 = nc1==-1
+        nc1[ind1]=nc2[ind1]
+        ind2 = nc2==-1
+        nc2[ind2]=nc1[ind2]
+        cc, cinv = np.unique(np.hstack([nc1,nc2]),return_inverse=True)
+        i1, i2 = cinv[:ne], cinv[ne:]
+
+        df = self.df[j]
+
+        def ncload(variable,tt):
+            if self.hasDim(variable,self.griddims['Ne']):
+                data = readruns(nc.variables[variable],tt,jj)[...,jinv]
+            else:
+                data = readruns(nc.variables[variable],tt,cc)
+                data = 0.5*(data[...,i1]+data[...,i2])
+
+            data = np.ma.filled(data,0.)
+            data[data==self._FillValue]=0.
+            return data
+
+        names = ['Q'] + ['F_%s'%vv for vv in tracers]
+        if 'temp' in tracers:
+            names.append('heat')
+
+        flux = {}
+        for name in names:
+            flux.update({name:np.zeros((nt,ntransect))})
+
+        if not outfile==None:
+            ncout = self._init_flux_nc(outfile,names,tracers)
+
+        for t1 in range(0,nt,self.tchunk):
+            t2 = min(t1+self.tchunk,nt)
+            tt = tstep[t1:t2]
+            print 'Calculating fluxes for time-steps: %d to %d of %d...'%(t1,t2,nt)
+
+            # Face thickness from the edge free-surface
+            eta = self._maxedge(nc,tt,cc,i1,i2)
+            dzf = Spatial.getdzf(self,eta,j=j).filled(0.)
+
+            U = ncload('U',tt).reshape((t2-t1,self.Nkmax,ne))
+            q = U*dzf*df
+
+            flux['Q'][t1:t2,:] = M.dot(q.sum(axis=1).T).T
+
+            for vv in tracers:
+                phi = ncload(vv,tt).reshape((t2-t1,self.Nkmax,ne))
+                flux['F_%s'%vv][t1:t2,:] = M.dot((q*phi).sum(axis=1).T).T
+
+            if 'temp' in tracers:
+                flux['heat'][t1:t2,:] = self.rho0*self.cp*flux['F_temp'][t1:t2,:]
+
+            if not outfile==None:
+                ncout.variables['time'][t1:t2] = self.timeraw[tt]
+                for name in names:
+                    ncout.variables[name][t1:t2,:] = flux[name][t1:t2,:]
+                ncout.sync()
+
+        if not outfile==None:
+            ncout.close()
+
+        return flux
+
+    def check_flux(self,tstep=None,tracers=[]):
+        """
+        Compares calc_flux with the fluxes through each transect calculated
+        separately, one time step at a time, with SliceEdge.loadData and the
+        face areas from Spatial.getdzf
+
+        Returns a dictionary with the maximum absolute difference of each
+        flux time series
+        """
+        if tstep is None:
+            tstep = range(self.Nt)
+        tstep = list(tstep)
+        nt = len(tstep)
+
+        flux = self.calc_flux(tstep=tstep,tracers=tracers)
+
+        # Per-transect reference
+        j, tstepold = self.j, self.tstep
+        ref = dict([(name,np.zeros_like(flux[name])) for name in flux.keys()])
+        for ii,ss in enumerate([dict(ss) for ss in self.transects()]):
+            self.j = list(ss['j'])
+            self.calc_mask()
+            self.tstep = tstep
+            ne = len(self.j)
+
+            area = np.zeros((nt,self.Nkmax,ne))
+            for tt,t in enumerate(tstep):
+                eta = self.nc.variables['eta'][t,:]
+                dzf = Spatial.getdzf(self,eta).filled(0.)[:,self.j]
+                area[tt,...] = dzf*self.df[self.j]
+            area[:,self.maskslice] = 0.
+
+            U = SliceEdge.loadData(self,variable='U',setunits=False)
+            q = U.reshape((nt,self.Nkmax,ne))*area*ss['normal']
+            ref['Q'][:,ii] = q.sum(axis=-1).sum(axis=-1)
+            for vv in tracers:
+                phi = SliceEdge.loadData(self,variable=vv,setunits=False)
+                ref['F_%s'%vv][:,ii] = (q*phi.reshape((nt,self.Nkmax,ne))).sum(axis=-1).sum(axis=-1)
+
+        if 'temp' in tracers:
+            ref['heat'] = self.rho0*self.cp*ref['F_temp']
+
+        self.j, self.tstep = j, tstepold
+        self.calc_mask()
+
+        err = {}
+        for name in flux.keys():
+            err[name] = np.abs(flux[name]-ref[name]).max()
+            print '%s: maximum difference %e (maximum flux %e)'%\
+                (name,err[name],np.abs(ref[name]).max())
+
+        return err
+
+    def _maxedge(self,nc,tt,cc,i1,i2):
+        """
+        Edge value of eta as in get_edgevar(method='max')
+        """
+        eta = np.ma.filled(readruns(nc.variables['eta'],tt,cc),0.)
+        eta = eta.reshape((len(tt),-1))
+        return np.maximum(eta[:,i1],eta[:,i2])
+
+    def _init_flux_nc(self,outfile,names,tracers):
+        """
+        Create the netcdf file for the transect flux time series
+        """
+        attrs = {'Q':{'long_name':'Volume flux','units':'m3 s-1'},\
+            'heat':{'long_name':'Heat flux','units':'W'}}
+        for vv in tracers:
+            try:
+                units = '%s m3 s-1'%self.nc.variables[vv].units
+            except:
+                units = ''
+            attrs.update({'F_%s'%vv:{'long_name':'%s flux'%vv,'units':units}})
+
+        print 'Writing transect fluxes to: %s'%outfile
+        nc = Dataset(outfile, 'w', format='NETCDF4_CLASSIC')
+        nc.Description = 'SUNTANS transect flux file'
+        nc.Author = os.getenv('USER')
+        nc.Created = datetime.now().isoformat()
+        nc.dataset_location = '%s'%self.ncfile
+
+        ntransect = len(self.transects())
+        nc.createDimension('Ntransect', ntransect)
+        nc.createDimension('time', 0) # Unlimited
+
+        tmp = nc.createVariable('time','f8',('time',))
+        tmp.setncattr('units',self.nc.variables['time'].units)
+
+        tmp = nc.createVariable('Nedges','i4',('Ntransect',))
+        tmp.setncattr('long_name','Number of edges along each transect')
+        tmp[:] = [len(ss['subind']) for ss in self.transects()]
+
+        for name in names:
+            tmp = nc.createVariable(name,'f8',('time','Ntransect'))
+            for aa in attrs[name].keys():
+                tmp.setncattr(aa,attrs[name][aa])
+
+        return nc
+
     def calc_mask(self):
         """ Construct the mask array"""
         klayer,Nkmax=self.get_klayer()
@@ -896,6 +1315,15 @@ class MultiSliceEdge(SliceEdge):
 
         self.j = self.j.tolist()
 
+        # Mask of the union of the edges
+        self.calc_mask()
+
+    def transects(self):
+        """
+        Returns the list of transect dictionaries (see SliceEdge.transects)
+        """
+        return self.slices
+
     def loadData(self,**kwargs):
         """
         Overloaded method of MultiEdgeSlice
@@ -945,6 +1373,18 @@ class MultiSliceEdge(SliceEdge):
 
         return data
 
+def readruns(V,tt,ind,maxgap=100):
+    """
+    Reads V[tt,...,ind] for sorted, unique indices "ind" as a few contiguous
+    blocks instead of the full range of ind (runs of indices less than
+    "maxgap" apart are read as one block)
+    """
+    ind = np.asarray(ind)
+    runs = np.split(ind,np.flatnonzero(np.diff(ind)>maxgap)+1)
+
+    return np.ma.concatenate([V[tt,...,rr[0]:rr[-1]+1][...,rr-rr[0]] for rr in runs],\
+        axis=-1)
+
            
         
 #####
@@ -14,7 +14,8 @@ from gridsearch import GridSearch
 from cartgrid import RegGrid
 
 from datetime import datetime,timedelta
-from scipy import spatial 
+from scipy import spatial, sparse
+from multiprocessing import Pool
 import numpy as np
 import matplotlib.pyplot as plt
 from netCDF4 import Dataset, num2date
@@ -135,7 +136,8 @@ class SunTrack(Spatial):
 
 
     def __call__(self,x,y,z, timeinfo,outfile=None,dtout=3600.0,\
-    	tstart=None,agepoly=None,age=None,agemax=None,runmodel=True, **kwargs):
+    	tstart=None,agepoly=None,age=None,agemax=None,runmodel=True,\
+        statsfile=None,agethresh=None, **kwargs):
         """
         Run the particle model 
         
@@ -146,9 +148,13 @@ class SunTrack(Spatial):
 	    (optional)
 	    tstart - start time of each particle (format seconds since 1990-01-01)
 	    	if None defaults to starting all particles from starttime.
-	    agepoly - x/y coordinates of a polygon which ages particles
+	    agepoly - x/y coordinates of a polygon which ages particles, or a
+	    	dictionary of named polygons {name:xypoly} each with its own age clock
 	    age, agemax - vectors of length n_parts containing the initial age and agemax. (leave
 	    	as None to set to zero)
+	    statsfile - netcdf file to save the online connectivity, residence time
+	    	and age exceedance statistics to (leave as None to skip)
+	    agethresh - list of age thresholds [seconds] for the exceedance counts
         """
 
         self.__dict__.update(kwargs)
@@ -160,9 +166,10 @@ class SunTrack(Spatial):
 	
         # Initialise the age calculation
         self._calcage = False
+        self.agenames = []
         if not agepoly == None:
             self._calcage = True
-            self.agepoly = agepoly
+            self.initAgePoly(agepoly)
             if age==None:
                 age=np.zeros_like(x)
             if agemax==None:
@@ -170,6 +177,12 @@ class SunTrack(Spatial):
             
         self.particles.update({'age':age,'agemax':agemax})
 
+        # Each age region has its own clock
+        for name in self.agenames:
+            agekey, agemaxkey = self._agekeys(name)
+            self.particles[agekey] = np.array(age,dtype=np.double)
+            self.particles[agemaxkey] = np.array(agemax,dtype=np.double)
+
         # Set the particle time start and activate if necessary
         self.initParticleTime(tstart)
 
@@ -184,6 +197,11 @@ class SunTrack(Spatial):
             print '######################################################'
             
         
+        # Initialise the online statistics
+        self._accumulate = not statsfile==None
+        if self._accumulate:
+            self.initAccumulators(agethresh=agethresh)
+
         # Initialise the currents
         self.initCurrents()
         
@@ -200,11 +218,13 @@ class SunTrack(Spatial):
                 if not outfile==None and tctr>=dtout:
                     self.writeParticleNC(outfile,self.particles['X'],\
                         self.particles['Y'],self.particles['Z'],\
-                        self.time_track_sec[ii],ctr,age=self.particles['age'],\
-                        agemax=self.particles['agemax'])
+                        self.time_track_sec[ii],ctr,ages=self.getAgeVars())
 
                     tctr=tctr//dtout
                     ctr+=1
+
+            if self._accumulate:
+                self.writeAccumulatorsNC(statsfile)
     
    
     def advectParticles(self,timenow,tsec):
@@ -234,6 +254,10 @@ class SunTrack(Spatial):
         # Call the age calculation
         if self._calcage:
            self.CalcAge()
+
+        # Update the online statistics
+        if self._accumulate:
+            self.updateAccumulators()
             
         
         t1 = clock()
@@ -497,7 +521,7 @@ class SunTrack(Spatial):
         if self.is3D:
             w = self.loadData(variable='w')
             eta = self.loadData(variable='eta')
-            return u[self.mask3D], v[self.mask3D], w[self.mask3D], eta    
+            return self.pack3d(u), self.pack3d(v), self.pack3d(w), eta    
         else:
             return u, v, u, u   
         
@@ -555,43 +579,28 @@ class SunTrack(Spatial):
         Includes only active vertical grid layers
         
         """
-        nc = self.Nc
         nz = self.Nkmax+1
         nv = len(self.xp)
         
         self.returnMask3D()
-        self.nActive = np.sum(self.mask3D) # Total number of active cells
+
+        # Active cells are stored in the compact layout (see Grid.get_index3d)
+        offset,k3d,j3d = self.get_index3d()
+        self.nActive = k3d.shape[0] # Total number of active cells
         
+        cells = np.array(self.cells[:,0:3])
         self.cells3d = np.zeros((self.nActive,6))
-        self.xv3d = np.zeros((self.nActive,))
-        self.yv3d = np.zeros((self.nActive,))
-        self.zv3d = np.zeros((self.nActive,))
-        pt1=0
-        for k in range(1,nz):
-            masklayer = self.mask3D[k-1,:]
-            nc = np.sum(masklayer)
-            pt2 = pt1+nc            
-            self.cells3d[pt1:pt2,0] = self.cells[masklayer,0]+(k-1)*nv
-            self.cells3d[pt1:pt2,1] = self.cells[masklayer,1]+(k-1)*nv
-            self.cells3d[pt1:pt2,2] = self.cells[masklayer,2]+(k-1)*nv
-            self.cells3d[pt1:pt2,3] = self.cells[masklayer,0]+k*nv
-            self.cells3d[pt1:pt2,4] = self.cells[masklayer,1]+k*nv
-            self.cells3d[pt1:pt2,5] = self.cells[masklayer,2]+k*nv
-            
-            self.xv3d[pt1:pt2] = self.xv[masklayer]
-            self.yv3d[pt1:pt2] = self.yv[masklayer]
-            self.zv3d[pt1:pt2] = -self.z_r[k-1]
-            
-            pt1=pt2
-            #print k, nc
+        self.cells3d[:,0:3] = cells[j3d,:] + (k3d*nv)[:,np.newaxis]
+        self.cells3d[:,3:6] = cells[j3d,:] + ((k3d+1)*nv)[:,np.newaxis]
+
+        self.xv3d = self.xv[j3d]
+        self.yv3d = self.yv[j3d]
+        self.zv3d = -self.z_r[k3d]
             
         self.verts = np.zeros((nv*nz,3))
-        pv1 = 0
-        for k in range(0,nz):
-            self.verts[pv1:pv1+nv,0] = self.xp
-            self.verts[pv1:pv1+nv,1] = self.yp
-            self.verts[pv1:pv1+nv,2] = -self.z_w[k]
-            pv1 += nv
+        self.verts[:,0] = np.tile(self.xp,nz)
+        self.verts[:,1] = np.tile(self.yp,nz)
+        self.verts[:,2] = np.repeat(-self.z_w[0:nz],nv)
 
     
     def returnMask3D(self):
@@ -599,30 +608,244 @@ class SunTrack(Spatial):
         Returns the 3D mask [Nk x Nc] True = Active, False = Ghost
         
         """
-        self.mask3D = np.ones((self.Nkmax,self.Nc),dtype=bool)
-        
-        for i in range(self.Nc):
-            if self.Nk[i] == self.Nkmax:
-                Nk = self.Nk[i]
-            else:
-                Nk = self.Nk[i]+1
-            self.mask3D[Nk:self.Nkmax,i]=False
-            #self.mask3D[self.Nk[i]::,i]=False
+        self.mask3D = self.get_mask3d()
+
+    def initAgePoly(self,agepoly):
+        """
+        Initialise the age regions
+
+        'agepoly' is either the x/y coordinates of a single polygon [N x 2]
+        or a dictionary of named polygons. Each polygon is rasterized onto
+        the grid cells once (see Grid.inpolygon_cells).
+        """
+        if isinstance(agepoly,dict):
+            self.agepoly = agepoly
+        else:
+            self.agepoly = {None:agepoly}
+
+        self.agenames = sorted(self.agepoly.keys())
+
+        self._agecells = {}
+        for name in self.agenames:
+            if self.verbose:
+                print 'Rasterizing age polygon: %s...'%name
+            self._agecells[name] = self.inpolygon_cells(self.agepoly[name])
+
+    def getCellIndex(self,x,y):
+        """
+        Returns the cell index of the particles at x, y
+
+        Reuses the mesh search of the interpolation object when available
+        """
+        if isinstance(self.UVWinterp,GridSearch):
+            # Pass copies so the search object never aliases the particle arrays
+            if not self.UVWinterp.__dict__.has_key('cellind'):
+                GridSearch.__call__(self.UVWinterp,x.copy(),y.copy())
+            elif np.sum(np.abs(x-self.UVWinterp.xpt))>0+1e-8:
+                self.UVWinterp.updatexy(x.copy(),y.copy())
+
+            return self.UVWinterp.cellind
+        else:
+            return self.find_cell(x,y)
+
+    def inAgePoly(self,name,cellind):
+        """
+        Returns True for particles inside of age region 'name'
+
+        Uses the cell lookup and only tests particles in cells that straddle
+        the polygon boundary (or are outside the grid) exactly
+        """
+        flag = self._agecells[name][cellind]
+        inpoly = flag==1
+
+        edge = operator.or_(flag==-1, cellind==-1)
+        if edge.any():
+            xy = np.vstack((self.particles['X'][edge],self.particles['Y'][edge])).T
+            inpoly[edge] = inpolygon(xy,self.agepoly[name])
+
+        return inpoly
 
     def CalcAge(self):
         """     
-        Calculate the age of a particle inside of the age polygon
+        Calculate the age of a particle inside of each age polygon
         """
         #print '\t\tCalculating the particle age...'
-        #inpoly = nxutils.points_inside_poly(np.vstack((self.particles['X'],self.particles['Y'])).T,self.agepoly)
-        inpoly = inpolygon(np.vstack((self.particles['X'],self.particles['Y'])).T,self.agepoly)
+        cellind = self.getCellIndex(self.particles['X'],self.particles['Y'])
 
-        self.particles['age'][inpoly] = self.particles['age'][inpoly] + self.dt
-        self.particles['age'][inpoly==False]=0.0
+        for name in self.agenames:
+            inpoly = self.inAgePoly(name,cellind)
+            agekey, agemaxkey = self._agekeys(name)
 
-        # Update the agemax attribute
-        self.particles['agemax'] = np.max([self.particles['age'],self.particles['agemax']],axis=0)
+            age = self.particles[agekey]
+            age[inpoly] = age[inpoly] + self.dt
+            age[inpoly==False]=0.0
 
+            # Update the agemax attribute
+            self.particles[agemaxkey] = np.max([age,self.particles[agemaxkey]],axis=0)
+
+    def _agekeys(self,name):
+        """
+        Particle dictionary keys of the age and maximum age for region 'name'
+        """
+        if name==None:
+            return 'age','agemax'
+        else:
+            return 'age_%s'%name, 'agemax_%s'%name
+
+    def getAgeVars(self):
+        """
+        Returns a dictionary with the age and maximum age of every region
+        """
+        ages = {}
+        for name in self.agenames:
+            for key in self._agekeys(name):
+                ages.update({key:self.particles[key]})
+
+        return ages
+
+
+    def initAccumulators(self,agethresh=None):
+        """
+        Initialise the online statistics accumulated during a run:
+            connectivity - particle time spent in each (source, destination)
+                cell pair [Nc x Nc sparse]
+            residence - particle time spent in each cell [Nc]
+            visits - number of times a particle enters each cell [Nc]
+            age_exceed - particle steps in each cell with age >= each
+                threshold, per age region [Nthresh x Nc]
+        """
+        if agethresh==None:
+            agethresh=[]
+        self.agethresh = np.array(agethresh,dtype=np.double).ravel()
+
+        # Source cell of each particle
+        self._cell0 = self.getCellIndex(self.particles['X0'],\
+            self.particles['Y0']).copy()
+        self._lastcell = -1*np.ones_like(self._cell0)
+
+        self.connectivity = sparse.csr_matrix((self.Nc,self.Nc),dtype=np.double)
+        self.residence = np.zeros((self.Nc,))
+        self.visits = np.zeros((self.Nc,),dtype=np.int)
+
+        self.age_exceed = {}
+        for name in self.agenames:
+            self.age_exceed[name] = np.zeros((self.agethresh.size,self.Nc),dtype=np.int)
+
+    def updateAccumulators(self):
+        """
+        Add the current particle step to the online statistics
+        """
+        cellind = self.getCellIndex(self.particles['X'],self.particles['Y'])
+
+        active = operator.and_(self.particles['isActive']==True,\
+            operator.and_(cellind!=-1,self._cell0!=-1))
+        cell = cellind[active]
+        cell0 = self._cell0[active]
+
+        self.residence += self.dt*np.bincount(cell,minlength=self.Nc)
+
+        entered = cell!=self._lastcell[active]
+        self.visits += np.bincount(cell[entered],minlength=self.Nc)
+        self._lastcell[active] = cell
+
+        self.connectivity = self.connectivity + \
+            sparse.coo_matrix((self.dt*np.ones(cell.shape),(cell0,cell)),\
+            shape=(self.Nc,self.Nc)).tocsr()
+
+        for name in self.agenames:
+            agekey, agemaxkey = self._agekeys(name)
+            age = self.particles[agekey][active]
+            for ii,thresh in enumerate(self.agethresh):
+                self.age_exceed[name][ii,:] += \
+                    np.bincount(cell[age>=thresh],minlength=self.Nc)
+
+    def writeAccumulatorsNC(self,outfile):
+        """
+        Writes the online statistics to a netcdf file
+
+        The connectivity matrix is stored in coordinate format. Per source
+        cell counts of the released particles, and of the particles whose
+        maximum age exceeds each threshold, are also written.
+        """
+        import os
+
+        if self.verbose:
+            print 'Writing particle statistics to: %s...'%outfile
+
+        conn = self.connectivity.tocoo()
+        valid = self._cell0!=-1
+        cell0 = self._cell0[valid]
+
+        nc = Dataset(outfile, 'w', format='NETCDF4_CLASSIC')
+        nc.Description = 'Particle tracking statistics file'
+        nc.Author = os.getenv('USER')
+        nc.Created = datetime.now().isoformat()
+        nc.dataset_location = '%s'%self.ncfile
+
+        nc.createDimension('Nc', self.Nc)
+        nc.createDimension('nconn', conn.nnz)
+        if self.agethresh.size>0:
+            nc.createDimension('nthresh', self.agethresh.size)
+
+        def create_nc_var( name, dimensions, attdict, data, dtype='f8'):
+            tmp=nc.createVariable(name, dtype, dimensions)
+            for aa in attdict.keys():
+                tmp.setncattr(aa,attdict[aa])
+            tmp[:] = data
+
+        create_nc_var('xv',('Nc',),{'units':'m','long_name':'Easting of cell centre'},self.xv)
+        create_nc_var('yv',('Nc',),{'units':'m','long_name':'Northing of cell centre'},self.yv)
+        create_nc_var('residence',('Nc',),{'units':'seconds','long_name':'Particle residence time'},self.residence)
+        create_nc_var('visits',('Nc',),{'units':'','long_name':'Number of particle visits'},self.visits,dtype='i4')
+        create_nc_var('source_count',('Nc',),{'units':'','long_name':'Number of particles released'},\
+            np.bincount(cell0,minlength=self.Nc),dtype='i4')
+        create_nc_var('conn_source',('nconn',),{'units':'','long_name':'Source cell index'},conn.row,dtype='i4')
+        create_nc_var('conn_dest',('nconn',),{'units':'','long_name':'Destination cell index'},conn.col,dtype='i4')
+        create_nc_var('connectivity',('nconn',),{'units':'seconds','long_name':'Particle time spent in destination cell'},conn.data)
+        if self.agethresh.size==0:
+            nc.close()
+            return
+
+        create_nc_var('agethresh',('nthresh',),{'units':'seconds','long_name':'Age exceedance thresholds'},self.agethresh)
+
+        for name in self.agenames:
+            agekey, agemaxkey = self._agekeys(name)
+            agemax = self.particles[agemaxkey][valid]
+            sourceexceed = np.zeros((self.agethresh.size,self.Nc),dtype=np.int)
+            for ii,thresh in enumerate(self.agethresh):
+                sourceexceed[ii,:] = np.bincount(cell0[agemax>=thresh],minlength=self.Nc)
+
+            create_nc_var('%s_exceed'%agekey,('nthresh','Nc'),\
+                {'units':'','long_name':'Number of particle steps with age exceeding threshold'},\
+                self.age_exceed[name],dtype='i4')
+            create_nc_var('%s_exceed'%agemaxkey,('nthresh','Nc'),\
+                {'units':'','long_name':'Number of released particles with maximum age exceeding threshold'},\
+                sourceexceed,dtype='i4')
+
+        nc.close()
+
+    def readAccumulatorsNC(self,ncfile):
+        """
+        Reads the online statistics from a netcdf file
+
+        Returns a dictionary with the connectivity as a sparse [Nc x Nc]
+        matrix
+        """
+        nc = Dataset(ncfile,'r')
+
+        stats = {}
+        for vv in nc.variables.keys():
+            if vv not in ['conn_source','conn_dest','connectivity']:
+                stats[vv] = nc.variables[vv][:]
+
+        Nc = len(nc.dimensions['Nc'])
+        stats['connectivity'] = sparse.coo_matrix((nc.variables['connectivity'][:],\
+            (nc.variables['conn_source'][:],nc.variables['conn_dest'][:])),\
+            shape=(Nc,Nc)).tocsr()
+
+        nc.close()
+
+        return stats
 
     def initParticleNC(self,outfile,Np,age=False):
         """
@@ -661,14 +884,22 @@ class SunTrack(Spatial):
         create_nc_var('yp',('ntrac','nt'),{'units':'m','long_name':"Northing coordinate of drifter",'time':'tp'},dtype='f8')
         create_nc_var('zp',('ntrac','nt'),{'units':'m','long_name':"vertical position of drifter (negative is downward from surface)",'time':'tp'},dtype='f8')
 	if age:
-	    create_nc_var('age',('ntrac','nt'),{'units':'seconds','long_name':"Particle age",'time':'tp'},dtype='f8')
-	    create_nc_var('agemax',('ntrac','nt'),{'units':'seconds','long_name':"Maximum particle age",'time':'tp'},dtype='f8')
+	    for name in self.agenames:
+		agekey, agemaxkey = self._agekeys(name)
+		if name==None:
+		    region = ''
+		else:
+		    region = ' in region: %s'%name
+		create_nc_var(agekey,('ntrac','nt'),{'units':'seconds','long_name':"Particle age"+region,'time':'tp'},dtype='f8')
+		create_nc_var(agemaxkey,('ntrac','nt'),{'units':'seconds','long_name':"Maximum particle age"+region,'time':'tp'},dtype='f8')
 
         nc.close()
     
-    def writeParticleNC(self,outfile,x,y,z,t,tstep,age=None,agemax=None):
+    def writeParticleNC(self,outfile,x,y,z,t,tstep,age=None,agemax=None,ages={}):
         """
         Writes the particle locations at the output time step, 'tstep'
+
+        'ages' is a dictionary of additional age variables {varname:array}
         """
         if self.verbose:
             print 'Writing netcdf output at tstep: %d...\n'%tstep
@@ -684,6 +915,8 @@ class SunTrack(Spatial):
 	    nc.variables['age'][:,tstep]=age
 	if not agemax==None:
 	    nc.variables['agemax'][:,tstep]=agemax
+	for vv in ages.keys():
+	    nc.variables[vv][:,tstep]=ages[vv]
 
         nc.close()
 #################
@@ -1053,29 +1286,20 @@ class SunTrack(Spatial):
         plt.colorbar()
         plt.title('Particle Age [days]\n(file name: %s)'%ncfile)
 
-    def readAgeMax(self,ncfile):
+    def readAgeMax(self,ncfile,agevar='agemax'):
         """
         Reads the maximum age from the last time step in a netcdf file
         """
-
-        # Load all of the data
-        nc = Dataset(ncfile,'r')
-        xp = nc.variables['xp'][:,0]
-        yp = nc.variables['yp'][:,0]
-        try:
-            # Load the age from the last time step
-            agemax = nc.variables['agemax'][:,-1]
-        except:
-            raise Exception, ' "agemax" variable not present in file: %s'%ncfile
-        nc.close()
-        
-        return xp, yp, agemax
+        return readAgeMax(ncfile,agevar=agevar)
 
 
-    def calcAgeMaxProb(self,ncfiles,dx,dy,exceedance_thresh,plot=True,xlims=None,ylims=None,**kwargs):
+    def calcAgeMaxProb(self,ncfiles,dx,dy,exceedance_thresh,plot=True,xlims=None,ylims=None,\
+        nprocs=1,agevar='agemax',**kwargs):
     	"""
         Calculate the probability of the age exceeding a threshold time from
         a series of particle tracking runs. 
+
+        The member files are aggregated on nprocs processes (see aggregateAgeMax)
         """
         scalefac = 1/86400.
         # Set the xy limits
@@ -1085,23 +1309,12 @@ class SunTrack(Spatial):
 
         # Create the probability grid
         grd = RegGrid(xlims,ylims,dx,dy)
-        nruns = len(ncfiles)
-        prob = np.zeros((grd.ny,grd.nx))
-
-        # Loop through the files and add one to the probability matrix
-        # where the age exceeds the threshold
-        for ncfile in ncfiles:
-            print 'Reading file: %s'%ncfile
-            xp,yp,agemax = self.readAgeMax(ncfile)
-        
-            agegrid = grd.griddata(xp,yp,agemax)
 
-            ind = agegrid >= exceedance_thresh
-
-            prob[ind] = prob[ind]+1
+        ens = aggregateAgeMax(ncfiles,grd,exceedance_thresh=exceedance_thresh,\
+            agevar=agevar,nprocs=nprocs)
 
         # Return the probability as a percentage
-        prob = prob/nruns*100.0
+        prob = ens.prob()[0,...]
 
         if plot:
             fig=plt.gcf()
@@ -1111,6 +1324,7 @@ class SunTrack(Spatial):
             plt.colorbar()
             plt.title('Probability (%%) of particle age exceeding %3.1f days'%(exceedance_thresh*scalefac))
 
+        return grd.X,grd.Y,prob
 
 class interp3Dmesh(GridSearch,Grid):
     """
@@ -1129,7 +1343,7 @@ class interp3Dmesh(GridSearch,Grid):
 
         if self.method == 'linear':
             Grid.__init__(self,grdfile)
-	    self.datatmp = np.zeros(mask.shape,dtype=np.double)
+            self.datatmp = np.zeros(mask.shape,dtype=np.double)
         
         self.z = np.sort(z)
         self.z[-1]=10.0 # Set the surface layer to large
@@ -1137,13 +1351,13 @@ class interp3Dmesh(GridSearch,Grid):
         
         self.mask3d = mask
         
+        # Index of each active cell in the packed data array. Cells are
+        # packed column by column (see Grid.get_index3d)
         self.maskindex = -1*np.ones(self.mask3d.shape,dtype=np.int32)
-        rr=0
-        for ii in range(self.mask3d.shape[0]):
-            for jj in range(self.mask3d.shape[1]):
-                if self.mask3d[ii,jj]:
-                    self.maskindex[ii,jj]=rr
-                    rr+=1
+        self.maskindex.T[self.mask3d.T] = np.arange(np.sum(self.mask3d))
+
+        if self.method == 'linear':
+            self.initLinear()
                   
     def __call__(self,X,Y,Z,data,update=True):
         
@@ -1183,21 +1397,72 @@ class interp3Dmesh(GridSearch,Grid):
                 
         return dataout
 
+    def initLinear(self):
+        """
+        Precompute the operators used by the linear interpolation
+
+        The per-layer cell-to-node operators are stacked into a single sparse
+        matrix [Nkmax*Np x nActive] that acts directly on the active cell
+        data, and the geometric part of the plane gradient is stored for
+        each cell.
+        """
+        Np = self.xp.shape[0]
+
+        # Stack the cell-to-node operators for each layer
+        rows,cols,vals = [],[],[]
+        for kk in range(self.Nkmax):
+            A = self.cell2node_op(k=kk).tocoo()
+            active = self.mask3d[kk,A.col]
+            rows.append(A.row[active]+kk*Np)
+            cols.append(self.maskindex[kk,A.col[active]])
+            vals.append(A.data[active])
+
+        nActive = np.sum(self.mask3d)
+        self._node_op = sparse.coo_matrix((np.hstack(vals),\
+            (np.hstack(rows),np.hstack(cols))),\
+            shape=(self.Nkmax*Np,nActive),dtype=np.double).tocsr()
+
+        # Plane gradient coefficients (see Grid.gradHplane)
+        self._cells3 = np.array(self.cells[:,0:3])
+        xA = self.xp[self._cells3[:,0]]
+        yA = self.yp[self._cells3[:,0]]
+        ABx = self.xp[self._cells3[:,1]] - xA
+        ABy = self.yp[self._cells3[:,1]] - yA
+        ACx = self.xp[self._cells3[:,2]] - xA
+        ACy = self.yp[self._cells3[:,2]] - yA
+        mz = ABx*ACy - ACx*ABy
+
+        self._gradcoef = np.vstack((ABx/mz, ABy/mz, ACx/mz, ACy/mz))
+
     def lininterp(self,X,Y,Z,data,k):
-    	"""
-        Wrapper for linear interpolation
+        """
+        Linear interpolation of the active cell data, 'data', onto the
+        particle locations
 
-        interpLinear method in sunpy needs to be called layer by layer
+        The nodal values of all layers are found with one sparse product and
+        the plane gradient is evaluated in the cell containing each particle
         """
         # Put the input data back into a 2D array (Nz,Nc)
-        self.datatmp[self.mask3d]=data
+        self.datatmp.T[self.mask3d.T]=data
+
+        # Nodal values for every layer (Nz,Np)
+        node_scalar = self._node_op.dot(data).reshape((self.Nkmax,-1))
+
+        valid = operator.and_(k>=0, self.cellind!=-1)
+        kk = np.where(valid,k,0)
+        cellind = np.where(valid,self.cellind,0)
+
+        zA = node_scalar[kk,self._cells3[cellind,0]]
+        ABz = node_scalar[kk,self._cells3[cellind,1]] - zA
+        ACz = node_scalar[kk,self._cells3[cellind,2]] - zA
 
-        # Loop through layer by layer
-        dataout = np.zeros_like(X)
-        for kk in range(0,self.Nkmax):
-            ind = operator.and_(k == kk,self.cellind!=-1)
-            if any(ind):
-                dataout[ind] = self.interpLinear(self.datatmp[kk,:],X[ind],Y[ind],self.cellind[ind],k=kk)
+        coef = self._gradcoef[:,cellind]
+        dphi_dx = ABz*coef[3,:] - ACz*coef[1,:]
+        dphi_dy = ACz*coef[0,:] - ABz*coef[2,:]
+
+        dataout = self.datatmp[kk,cellind] \
+            + dphi_dx*(X-self.xv[cellind]) + dphi_dy*(Y-self.yv[cellind])
+        dataout[valid==False] = 0.0
 
         return dataout
 
@@ -1349,6 +1614,230 @@ class nearest(object):
         
         return Z            
 
+class AgeMaxEnsemble(object):
+    """
+    Single-pass statistics of the gridded maximum particle age over an
+    ensemble of particle tracking runs
+
+    Each member is gridded onto the RegGrid by averaging the maximum age of
+    the particles released in each grid cell (see RegGrid.griddata).
+    Accumulators from different processes are combined with reduce().
+
+    Inputs:
+        grd - RegGrid object
+        exceedance_thresh - list of age thresholds [seconds]
+        agebins - histogram bin edges [seconds] used for the percentiles
+    """
+    def __init__(self,grd,exceedance_thresh=[],agebins=None):
+        self.grd = grd
+        self.thresh = np.atleast_1d(np.asarray(exceedance_thresh,dtype=np.float64))
+        if agebins is None:
+            self.agebins = None
+        else:
+            self.agebins = np.asarray(agebins,dtype=np.float64)
+
+        N = grd.ny*grd.nx
+        self.nruns = 0
+        self.count = np.zeros((N,))
+        self.sum = np.zeros((N,))
+        self.sum2 = np.zeros((N,))
+        self.min = np.inf*np.ones((N,))
+        self.max = -np.inf*np.ones((N,))
+        self.exceed = np.zeros((self.thresh.shape[0],N))
+        if not self.agebins is None:
+            self.hist = np.zeros((self.agebins.shape[0]-1,N))
+
+        self._release = None
+
+    def releaseindex(self,xp,yp):
+        """
+        Grid index of the release locations
+
+        The index of the previous member's release locations is kept so that
+        members sharing their release points are only indexed once.
+        """
+        if not self._release is None:
+            xp0, yp0, ind = self._release
+            if np.array_equal(xp,xp0) and np.array_equal(yp,yp0):
+                return ind
+
+        ind = self.grd.returnindex(xp,yp)
+        self._release = (xp,yp,ind)
+        return ind
+
+    def add(self,xp,yp,agemax):
+        """
+        Add the release locations and maximum age of one ensemble member
+        """
+        ind = self.releaseindex(xp,yp)
+        zsum, zcount = self.grd.binstats(ind,agemax)
+
+        self.nruns += 1
+
+        cells = np.flatnonzero(zcount)
+        age = zsum[cells]/zcount[cells]
+
+        self.count[cells] += 1
+        self.sum[cells] += age
+        self.sum2[cells] += age*age
+        self.min[cells] = np.minimum(self.min[cells],age)
+        self.max[cells] = np.maximum(self.max[cells],age)
+
+        for ii,thresh in enumerate(self.thresh):
+            self.exceed[ii,cells[age>=thresh]] += 1
+
+        if not self.agebins is None:
+            nbins = self.hist.shape[0]
+            b = np.searchsorted(self.agebins,age,side='right')-1
+            b = np.clip(b,0,nbins-1)
+            self.hist += np.bincount(b*self.count.shape[0]+cells,\
+                minlength=self.hist.size).reshape(self.hist.shape)
+
+    def reduce(self,other):
+        """
+        Combine the statistics of another accumulator with this one
+        """
+        self.nruns += other.nruns
+        self.count += other.count
+        self.sum += other.sum
+        self.sum2 += other.sum2
+        self.min = np.minimum(self.min,other.min)
+        self.max = np.maximum(self.max,other.max)
+        self.exceed += other.exceed
+        if not self.agebins is None:
+            self.hist += other.hist
+
+        return self
+
+    def _togrid(self,phi):
+        """
+        Reshape onto the grid and set the cells with no particles to NaN
+        """
+        phi = phi.copy()
+        phi[...,self.count==0] = np.nan
+        return phi.reshape(phi.shape[:-1]+(self.grd.ny,self.grd.nx))
+
+    def prob(self):
+        """
+        Probability (%) of the maximum age exceeding each threshold
+        [Nthresh x ny x nx]
+        """
+        prob = self.exceed/max(self.nruns,1)*100.0
+        return prob.reshape((self.thresh.shape[0],self.grd.ny,self.grd.nx))
+
+    def mean(self):
+        """
+        Ensemble mean of the maximum age i.e. the mean residence time [ny x nx]
+        """
+        return self._togrid(self.sum/np.maximum(self.count,1))
+
+    def std(self):
+        """
+        Ensemble standard deviation of the maximum age [ny x nx]
+        """
+        n = np.maximum(self.count,1)
+        var = np.maximum(self.sum2/n - (self.sum/n)**2,0.)
+        return self._togrid(np.sqrt(var))
+
+    def percentile(self,q):
+        """
+        Percentile q (0-100) of the maximum age estimated from the histogram
+        [ny x nx]
+
+        The value is linearly interpolated within the bin and is limited to
+        the range of the bin edges.
+        """
+        if self.agebins is None:
+            raise Exception, 'agebins must be set to calculate percentiles'
+
+        cumhist = np.cumsum(self.hist,axis=0)
+        target = q/100.*self.count
+
+        # First bin where the cumulative count reaches the target
+        b = np.sum(cumhist < target[np.newaxis,:],axis=0)
+        b = np.clip(b,0,self.hist.shape[0]-1)
+
+        cols = np.arange(self.count.shape[0])
+        below = cumhist[b,cols] - self.hist[b,cols]
+        inbin = np.maximum(self.hist[b,cols],1)
+        frac = np.clip((target-below)/inbin,0.,1.)
+
+        e0 = self.agebins[b]
+        e1 = self.agebins[b+1]
+
+        return self._togrid(e0 + frac*(e1-e0))
+
+def readAgeMax(ncfile,agevar='agemax'):
+    """
+    Reads the release locations and the maximum age from the last time step
+    in a particle netcdf file
+    """
+    nc = Dataset(ncfile,'r')
+    xp = nc.variables['xp'][:,0]
+    yp = nc.variables['yp'][:,0]
+    try:
+        # Load the age from the last time step
+        agemax = nc.variables[agevar][:,-1]
+    except:
+        raise Exception, ' "%s" variable not present in file: %s'%(agevar,ncfile)
+    nc.close()
+    
+    return xp, yp, agemax
+
+def _aggregateAgeMaxWorker(args):
+    """
+    Accumulates the age statistics of a subset of the ensemble files
+    """
+    ncfiles, grd, exceedance_thresh, agebins, agevar = args
+
+    ens = AgeMaxEnsemble(grd,exceedance_thresh=exceedance_thresh,agebins=agebins)
+    for ncfile in ncfiles:
+        print 'Reading file: %s'%ncfile
+        ens.add(*readAgeMax(ncfile,agevar=agevar))
+
+    return ens
+
+def aggregateAgeMax(ncfiles,grd,exceedance_thresh=[],agebins=None,agevar='agemax',nprocs=1):
+    """
+    Aggregate the maximum particle age of an ensemble of particle tracking
+    runs onto a regular grid
+
+    The files are split between nprocs processes that each accumulate a
+    partial AgeMaxEnsemble which are then reduced. Each process indexes
+    the release locations once for the members sharing their release points.
+
+    Inputs:
+        ncfiles - list of particle netcdf files
+        grd - RegGrid object
+        exceedance_thresh - list of age thresholds [seconds]
+        agebins - histogram bin edges [seconds] (needed for percentiles)
+        agevar - name of the maximum age variable e.g. 'agemax_<region>'
+        nprocs - number of processes
+
+    Returns:
+        AgeMaxEnsemble object
+    """
+    nprocs = max(min(nprocs,len(ncfiles)),1)
+    args = [(ncfiles[ii::nprocs],grd,exceedance_thresh,agebins,agevar)\
+        for ii in range(nprocs)]
+
+    if nprocs==1:
+        partials = map(_aggregateAgeMaxWorker,args)
+    else:
+        print 'Aggregating %d files on %d processes...'%(len(ncfiles),nprocs)
+        pool = Pool(nprocs)
+        try:
+            partials = pool.map(_aggregateAgeMaxWorker,args)
+        finally:
+            pool.close()
+            pool.join()
+
+    ens = partials[0]
+    for partial in partials[1:]:
+        ens.reduce(partial)
+
+    return ens
+
 def GridParticles(grdfile,dx,dy,nz,xypoly=None,splitvec=1):
     """
     Returns the locations of particles on a regular grid inside of suntans grid
@@ -158,35 +158,24 @@ class SunTvtk(Spatial):
         This method includes only active vertical grid layers
         
         """
-        nc = self.Nc
         nz = self.Nkmax+1
         nv = len(self.xp)
         
         self.returnMask3D()
-        self.nActive = np.sum(self.mask3D) # Total number of active cells
+
+        # Active cells are stored in the compact layout (see Grid.get_index3d)
+        offset,k3d,j3d = self.get_index3d()
+        self.nActive = k3d.shape[0] # Total number of active cells
         
+        cells = np.array(self.cells[:,0:3])
         nodes = np.zeros((self.nActive,6))
-        pt1=0
-        for k in range(1,nz):
-            masklayer = self.mask3D[k-1,:]
-            nc = np.sum(masklayer)
-            pt2 = pt1+nc            
-            nodes[pt1:pt2,0] = self.cells[masklayer,0]+(k-1)*nv
-            nodes[pt1:pt2,1] = self.cells[masklayer,1]+(k-1)*nv
-            nodes[pt1:pt2,2] = self.cells[masklayer,2]+(k-1)*nv
-            nodes[pt1:pt2,3] = self.cells[masklayer,0]+k*nv
-            nodes[pt1:pt2,4] = self.cells[masklayer,1]+k*nv
-            nodes[pt1:pt2,5] = self.cells[masklayer,2]+k*nv
-            pt1=pt2
-            #print k, nc
+        nodes[:,0:3] = cells[j3d,:] + (k3d*nv)[:,np.newaxis]
+        nodes[:,3:6] = cells[j3d,:] + ((k3d+1)*nv)[:,np.newaxis]
             
         self.verts = np.zeros((nv*nz,3))
-        pv1 = 0
-        for k in range(0,nz):
-            self.verts[pv1:pv1+nv,0] = self.xp
-            self.verts[pv1:pv1+nv,1] = self.yp
-            self.verts[pv1:pv1+nv,2] = -self.z_w[k] * self.zscale
-            pv1 += nv
+        self.verts[:,0] = np.tile(self.xp,nz)
+        self.verts[:,1] = np.tile(self.yp,nz)
+        self.verts[:,2] = np.repeat(-self.z_w[0:nz],nv) * self.zscale
             
         wedge_type = tvtk.Wedge().cell_type
         self.ug = tvtk.UnstructuredGrid(points=self.verts)
@@ -201,14 +190,7 @@ class SunTvtk(Spatial):
         Returns the 3D mask [Nk x Nc] True = Active, False = Ghost
         
         """
-        self.mask3D = np.ones((self.Nkmax,self.Nc),dtype=bool)
-        
-        for i in range(self.Nc):
-            if self.Nk[i] == self.Nkmax:
-                Nk = self.Nk[i]
-            else:
-                Nk = self.Nk[i]+1
-            self.mask3D[Nk:self.Nkmax,i]=False
+        self.mask3D = self.get_mask3d()
             
     def newscene(self,size=(800,700)):
         """
@@ -674,7 +656,7 @@ class SunTvtk(Spatial):
         """
         Spatial.loadData(self)
         if self.is3D:
-            self.data=np.ravel(self.data[self.mask3D])
+            self.data=self.pack3d(self.data)
         else:
             self.data=np.ravel(self.data)
             
@@ -702,7 +684,7 @@ class SunTvtk(Spatial):
             self.ug.point_data.vectors.name = 'suntans_vector' 
 
         else: # 3D
-            velocity = np.array((u,v,w)).T
+            velocity = np.array((self.pack3d(u),self.pack3d(v),self.pack3d(w))).T
             self.ug.cell_data.vectors =  velocity
             self.ug.cell_data.vectors.name = 'suntans_vector' 
         
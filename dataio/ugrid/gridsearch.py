@@ -254,11 +254,7 @@ class GridSearch(HybridGrid):
         node =  self.findnearest(xyin)
         Np = xin.shape[0]
 
-        cell = -1*np.ones((Np,MAXNODES),dtype=np.int32)
-        for nn in range(Np):
-            p2c = self.my_pnt2cells(node[nn])
-            cell[nn,0:len(p2c)]=p2c
-        #cell = [self.pnt2cells(node[nn]) for nn in range(Np)]
+        cell = self.pnt2cellsarray(MAXNODES=MAXNODES)[node,:]
             
         cellind = -1*np.ones((Np,),dtype=np.int32)
         for ii in range(MAXNODES):
@@ -272,6 +268,37 @@ class GridSearch(HybridGrid):
     
         return cellind
         
+    def pnt2cellsarray(self,MAXNODES=8):
+        """
+        Returns an array [Np x MAXNODES] with the indices of the cells
+        connected to each point, padded with -1
+
+        Vectorized version of my_pnt2cells for all points
+        """
+        if not self.__dict__.has_key('_pnt2cellsarray') or \
+            not self._pnt2cellsarray.shape[1]==MAXNODES:
+
+            Np = self.xp.shape[0]
+            cells = np.asarray(self.cells)
+            cellind = np.repeat(np.arange(self.Nc)[:,np.newaxis],cells.shape[1],axis=1)
+            mask = np.arange(cells.shape[1])[np.newaxis,:] < self.nfaces[:,np.newaxis]
+
+            # Sort by point then by cell
+            nodes = cells[mask]
+            cellind = cellind[mask]
+            order = np.lexsort((cellind,nodes))
+            nodes = nodes[order]
+            cellind = cellind[order]
+
+            # Position of each cell in the list of each point
+            rank = np.arange(nodes.shape[0]) - np.searchsorted(nodes,nodes)
+            keep = rank < MAXNODES
+
+            self._pnt2cellsarray = -1*np.ones((Np,MAXNODES),dtype=np.int32)
+            self._pnt2cellsarray[nodes[keep],rank[keep]] = cellind[keep]
+
+        return self._pnt2cellsarray
+
     def my_pnt2cells(self,pnt_i):
         """
         Returns the cell indices for a point, pnt_i
@@ -349,18 +376,28 @@ class GridSearch(HybridGrid):
         """
         Check whether a point is inside a cell
 
-        Basically a wrapper for points_inside_poly function        
+        Vectorized test for convex cells: the point must be on the same side
+        of every cell edge
         """
-        nx = x.shape[0]                          
+        cellinds = np.asarray(cellinds)
+        cells = np.asarray(self.cells)[cellinds,:]
+        nfaces = self.nfaces[cellinds]
+        ii = np.arange(cellinds.shape[0])
 
-        xy = np.zeros((1,2))
-        def _xy(ii):
-            xy[0,0]=x[ii]
-            xy[0,1]=y[ii]
-            return xy
+        pos = np.ones(cellinds.shape,dtype=np.bool)
+        neg = np.ones(cellinds.shape,dtype=np.bool)
+        for jj in range(self.maxfaces):
+            active = jj < nfaces
+            n1 = np.where(active,cells[:,jj],cells[:,0])
+            n2 = cells[ii,np.where(active,(jj+1)%nfaces,0)]
+
+            cross = (self.xp[n2]-self.xp[n1])*(y-self.yp[n1]) -\
+                (self.yp[n2]-self.yp[n1])*(x-self.xp[n1])
+
+            pos = op.and_(pos,(cross>=0) | (active==False))
+            neg = op.and_(neg,(cross<=0) | (active==False))
 
-        inpoly = [self.xypoly[cellinds[ii]].contains_points(_xy(ii))[0] for ii in range(nx) ]
-        return np.array(inpoly)
+        return op.or_(pos,neg)
 
 
     def inCellVecOld(self,cellinds,x,y):
@@ -205,8 +205,8 @@ def suntans2untrim(ncfile,outfile,tstart,tend,grdfile=None):
         # Compute a few terms first
         eta = sun.loadData(variable='eta' )  
         U = sun.loadData(variable='U_F' )  
-        dzz = sun.getdzz(eta)
-        dzf = sun.getdzf(eta)
+        dzz = sun.getdzz(eta).filled(0.)
+        dzf = sun.getdzf(eta).filled(0.)
 
         
         vname='Mesh2_sea_surface_elevation'
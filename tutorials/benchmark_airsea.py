@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark of the air-sea flux calculation in myairsea: the
+original functions on the full [Nt, Npoints] arrays against the chunked
+airseaFluxes engine (with and without numexpr)
+
+Uses synthetic met fields on Npoints model cells
+"""
+
+import numpy as np
+from time import time
+
+import myairsea
+
+####
+# Inputs
+Nt = 24*30 # One month of hourly fields
+Npoints = 20000
+tchunk = 24
+####
+
+def synthetic_inputs(Nt,Np):
+    """ Random met fields with realistic ranges"""
+    return {'Uwind':5*np.random.randn(Nt,Np),\
+        'Vwind':5*np.random.randn(Nt,Np),\
+        'Ta':20+5*np.random.rand(Nt,Np),\
+        'Tw':22+3*np.random.rand(Nt,Np),\
+        'Pa':1000+20*np.random.rand(Nt,Np),\
+        'RH':100*np.random.rand(Nt,Np),\
+        'cloud':np.random.rand(Nt,Np)}
+
+def original(inputs):
+    """ Original functions on the full arrays"""
+    fluxes = dict(zip(['Hl','Hs','Hlwu','Hlwd','dq','dT','S'],\
+        myairsea.heatFluxes(*[inputs[vv] for vv in myairsea.fluxinputs])))
+    fluxes['tau_x'] = myairsea.stressBulk(inputs['Uwind'],fluxes['S'])
+    fluxes['tau_y'] = myairsea.stressBulk(inputs['Vwind'],fluxes['S'])
+    return fluxes
+
+inputs = synthetic_inputs(Nt,Npoints)
+npts = Nt*Npoints*1e-6
+
+tic = time()
+ref = original(inputs)
+t_old = time()-tic
+print 'Original (full arrays):   %8.3f s %8.1f Mpoints/s'%(t_old,npts/t_old)
+
+runs = [('Chunked numpy:           ',False)]
+if not myairsea.ne is None:
+    runs.append(('Chunked numexpr:         ',True))
+
+for label,usenumexpr in runs:
+    tic = time()
+    out = myairsea.airseaFluxes(inputs,tchunk=tchunk,usenumexpr=usenumexpr)
+    t_new = time()-tic
+    err = max([np.abs(out[vv]-ref[vv]).max()/np.abs(ref[vv]).max() for vv in ref.keys()])
+    print '%s%8.3f s %8.1f Mpoints/s (max relative difference %3.1e)'%(label,t_new,npts/t_new,err)
+
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the vectorized layer thickness calculations (Spatial.getdzz and
+Spatial.getdzf) against the original loops over cells and edges
+
+Uses a synthetic triangular grid with ~100k cells held in memory. The
+free-surface is within the top layer so the original loops are exact.
+
+A second, smaller grid with uneven layers, single-layer cells (Nk=0) and
+a free-surface below the top layers (ctop/etop>0) checks the vectorized
+versions against the thickness of the wet part of each layer.
+"""
+
+import numpy as np
+from scipy.spatial import Delaunay
+from time import time
+
+from sunpy import Spatial
+
+####
+# Inputs
+Nc = 100000 # approximate number of cells
+Nkmax = 30
+Nt = 24
+Nccheck = 5000 # cells in the check of the dry/single-layer cases
+####
+
+class SyntheticSpatial(Spatial):
+    """
+    Synthetic grid with a vertical coordinate
+    """
+    def __init__(self,Nc,Nkmax,Nkmin=1,dz=None):
+        n = int(np.sqrt(Nc/2.))+1
+        x,y = np.meshgrid(np.linspace(0,1e5,n),np.linspace(0,1e5,n))
+        xp = x.ravel() + 100*np.random.rand(n*n)
+        yp = y.ravel() + 100*np.random.rand(n*n)
+        tri = Delaunay(np.vstack((xp,yp)).T)
+        self.Nc = tri.simplices.shape[0]
+
+        # Edge to cell pointers from the triangle neighbours
+        cell = np.repeat(np.arange(self.Nc),3)
+        nbr = tri.neighbors.ravel()
+        ind = (nbr==-1) | (cell<nbr)
+        self.grad = np.vstack((cell[ind],nbr[ind])).T
+        self.Ne = self.grad.shape[0]
+
+        self.Nkmax = Nkmax
+        if dz is None:
+            dz = np.ones((Nkmax,))
+        self.dz = dz
+        self.z_w = np.hstack([0.,np.cumsum(dz)])
+        self.z_r = 0.5*(self.z_w[1:]+self.z_w[:-1])
+        self.Nk = np.random.randint(Nkmin,Nkmax,self.Nc) # zero-based
+        self.dv = self.z_w[self.Nk] + 0.5*self.dz[self.Nk]
+        nc1 = self.grad[:,0]
+        nc2 = np.where(self.grad[:,1]==-1,nc1,self.grad[:,1])
+        self.Nke = np.minimum(self.Nk[nc1],self.Nk[nc2])+1
+
+def getdzz_loop(sun,eta):
+    """ Original cell by cell version of getdzz"""
+    z = np.cumsum(sun.dz)
+    dzz = np.repeat(sun.dz[:,np.newaxis],sun.Nc,axis=1)
+    ctop = sun.getctop(eta)
+    dzz[ctop,range(sun.Nc)] = z[ctop]+eta
+    dzz[sun.Nk,range(sun.Nc)] = sun.dv - z[sun.Nk-1]
+    Nk = sun.Nk+1
+    for ii in range(sun.Nc):
+        dzz[0:ctop[ii],ii]=0.0
+        dzz[Nk[ii]::,ii]=0.0
+    return dzz
+
+def getdzf_loop(sun,eta):
+    """ Original edge by edge version of getdzf"""
+    etop,etaedge = sun.getetop(eta)
+    Ne = etop.shape[0]
+    dzf = np.repeat(sun.dz[:,np.newaxis],Ne,axis=1)
+    dzf[etop,range(Ne)] = sun.dz[etop]+etaedge
+    for ii in range(Ne):
+        dzf[0:etop[ii],ii]=0.0
+        dzf[sun.Nke[ii]::,ii]=0.0
+    return dzf
+
+def getdzz_ref(sun,eta):
+    """ Wet thickness of each layer from the free-surface to the bed"""
+    ctop = sun.getctop(eta)
+    dzz = np.zeros((sun.Nkmax,sun.Nc))
+    for ii in range(sun.Nc):
+        for k in range(ctop[ii],sun.Nk[ii]+1):
+            top = -eta[ii] if k==ctop[ii] else sun.z_w[k]
+            bot = sun.dv[ii] if k==sun.Nk[ii] else sun.z_w[k+1]
+            dzz[k,ii] = bot - top
+    return dzz
+
+def getdzf_ref(sun,eta):
+    """ Wet thickness of each edge layer from the edge free-surface"""
+    etop,etaedge = sun.getetop(eta)
+    dzf = np.zeros((sun.Nkmax,sun.Ne))
+    for ii in range(sun.Ne):
+        for k in range(etop[ii],sun.Nke[ii]):
+            top = -etaedge[ii] if k==etop[ii] else sun.z_w[k]
+            dzf[k,ii] = sun.z_w[k+1] - top
+    return dzf
+
+print 'Building a synthetic grid...'
+sun = SyntheticSpatial(Nc,Nkmax)
+print '\t%d cells, %d edges, %d layers, %d time steps'%(sun.Nc,sun.Ne,Nkmax,Nt)
+
+# Free-surface within the top layer
+eta = np.random.uniform(-0.4,0.4,(Nt,sun.Nc))
+
+tic = time()
+dzz_loop = np.array([getdzz_loop(sun,eta[tt,:]) for tt in range(Nt)])
+dzf_loop = np.array([getdzf_loop(sun,eta[tt,:]) for tt in range(Nt)])
+t_loop = time()-tic
+
+tic = time()
+dzz = sun.getdzz(eta)
+dzf = sun.getdzf(eta)
+t_vec = time()-tic
+
+tic = time()
+dzz32 = sun.getdzz(eta,dtype=np.float32)
+dzf32 = sun.getdzf(eta,dtype=np.float32)
+t_vec32 = time()-tic
+
+print 'Loop over cells/edges and time steps: %10.3f s'%t_loop
+print 'Vectorized [Nt,Nc] (float64):         %10.3f s'%t_vec
+print 'Vectorized [Nt,Nc] (float32):         %10.3f s'%t_vec32
+print 'Speedup: %6.1f'%(t_loop/t_vec)
+print 'Maximum difference dzz: %e, dzf: %e'%\
+    (np.abs(dzz.filled()-dzz_loop).max(),np.abs(dzf.filled()-dzf_loop).max())
+
+print 'Checking dry top layers and single-layer cells...'
+check = SyntheticSpatial(Nccheck,10,Nkmin=0,dz=np.random.uniform(0.5,2.,10))
+print '\t%d cells with Nk=0'%np.sum(check.Nk==0)
+# Free-surface anywhere between 90% of the depth below and 10% above zero
+eta = np.random.uniform(-0.9,0.1,(2,check.Nc))*check.dv
+errz, errf = 0., 0.
+for tt in range(2):
+    errz = max(errz,np.abs(check.getdzz(eta[tt,:]).filled()-getdzz_ref(check,eta[tt,:])).max())
+    errf = max(errf,np.abs(check.getdzf(eta[tt,:]).filled()-getdzf_ref(check,eta[tt,:])).max())
+print '\tcells with ctop>0: %d, edges with etop>0: %d'%\
+    (np.sum(check.getctop(eta[0,:])>0),np.sum(check.getetop(eta[0,:])[0]>0))
+print 'Maximum difference dzz: %e, dzf: %e'%(errz,errf)
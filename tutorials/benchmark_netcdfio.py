@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the observation database in netcdfio: bulk-loading and indexed
+queries against the original row-by-row inserts and unindexed table
+
+Uses a synthetic catalog of 50k stations spread across 200 netcdf files
+"""
+
+import numpy as np
+import sqlite3
+import os, tempfile
+from datetime import datetime, timedelta
+from time import time
+
+import netcdfio
+
+####
+# Inputs
+Nstation = 50000
+Nfiles = 200
+Nold = 2000 # Number of rows to insert the original way (one commit per row)
+varnames = ['waterlevel','temperature','salinity','RH','Uwind','Vwind']
+####
+
+def synthetic_rows(N):
+    """ Database rows for N synthetic stations"""
+    t0 = datetime(2000,1,1)
+    rows = []
+    for ii in range(N):
+        lon = -98. + 10*np.random.rand()
+        lat = 24. + 8*np.random.rand()
+        tstart = t0 + timedelta(days=np.random.randint(0,5000))
+        tend = tstart + timedelta(days=np.random.randint(1,1000))
+        rows.append(('obs_%03d.nc'%(ii%Nfiles),'groupID_%04d'%(ii//Nfiles),\
+            varnames[ii%len(varnames)],lon,lat,lon,lon,lat,lat,str(tstart),str(tend),\
+            0.,0.,'Station %d'%ii,'%d'%ii,'Point'))
+    return rows
+
+def insert_original(dbfile,rows):
+    """ Original insert: string formatting and a commit per row"""
+    conn = sqlite3.connect(dbfile)
+    c = conn.cursor()
+    for row in rows:
+        dbstr = '("%s", "%s", "%s", %4.6f, %4.6f, %4.6f, %4.6f, %4.6f, %4.6f, "%s", "%s", %4.6f, %4.6f, "%s", "%s","%s")'%row
+        c.execute('INSERT INTO observations VALUES %s'%dbstr)
+        conn.commit()
+    c.close()
+    conn.close()
+
+def create_original(dbfile):
+    """ Table without any indexes"""
+    conn = sqlite3.connect(dbfile)
+    tablestr = ', '.join(['%s %s'%(ff,tt) for ff,tt in zip(netcdfio.tablefields,netcdfio.fieldtype)])
+    conn.execute('CREATE TABLE observations (%s)'%tablestr)
+    conn.commit()
+    conn.close()
+
+tmpdir = tempfile.mkdtemp()
+dbold = os.path.join(tmpdir,'old.db')
+dbnew = os.path.join(tmpdir,'new.db')
+
+rows = synthetic_rows(Nstation)
+
+# Build the catalog
+create_original(dbold)
+tic = time()
+insert_original(dbold,rows[0:Nold])
+t_old = (time()-tic)*Nstation/Nold
+conn = sqlite3.connect(dbold)
+conn.executemany('INSERT INTO observations VALUES (%s)'%','.join(['?']*16),rows[Nold:])
+conn.commit()
+conn.close()
+
+tic = time()
+netcdfio.createObsDB(dbnew)
+conn = sqlite3.connect(dbnew)
+netcdfio.insertObsDB(conn,rows)
+conn.commit()
+conn.close()
+t_new = time()-tic
+
+print 'Build %d station catalog'%Nstation
+print '    Original (extrapolated from %d rows): %10.3f s'%(Nold,t_old)
+print '    Bulk insert with indexes:              %10.3f s'%t_new
+
+# Query by variable and time range
+condition = 'Variable_Name = "RH" and time_start <= "2005-01-01" and time_end >= "2004-01-01"'
+outvar = ['NetCDF_Filename','NetCDF_GroupID','StationName']
+for dbfile,label in [(dbold,'Unindexed'),(dbnew,'Indexed')]:
+    tic = time()
+    for ii in range(20):
+        query = netcdfio.returnQuery(dbfile,outvar,'observations',condition)
+    print '%s variable/time query: %10.4f s (%d matches)'%(label,(time()-tic)/20,len(query['StationName']))
+
+# Query by bounding box
+bbox = [-95.,-94.,28.,29.]
+condition = 'Variable_Name = "RH"'
+tic = time()
+for ii in range(20):
+    query = netcdfio.returnQuery(dbold,outvar,'observations',condition+\
+        ' and X >= %f and X <= %f and Y >= %f and Y <= %f'%tuple(bbox))
+print 'Unindexed box query: %10.4f s (%d matches)'%((time()-tic)/20,len(query['StationName']))
+tic = time()
+for ii in range(20):
+    query = netcdfio.returnQuery(dbnew,outvar,'observations',condition,bbox=bbox)
+print 'R-tree box query:    %10.4f s (%d matches)'%((time()-tic)/20,len(query['StationName']))
+
+# The R-tree must still match after deleting rows and a VACUUM
+conn = sqlite3.connect(dbnew)
+conn.execute('DELETE FROM observations WHERE id % 7 = 0')
+conn.commit()
+conn.execute('VACUUM')
+conn.close()
+query = netcdfio.returnQuery(dbnew,outvar,'observations',condition,bbox=bbox)
+ref = netcdfio.returnQuery(dbnew,outvar,'observations',condition+\
+    ' and X >= %f and X <= %f and Y >= %f and Y <= %f'%tuple(bbox))
+print 'R-tree box query after DELETE/VACUUM matches the table: %s'%\
+    (sorted(query['StationName'])==sorted(ref['StationName']))
+
+# File opens in queryNC
+query = netcdfio.returnQuery(dbnew,outvar,'observations','Variable_Name = "RH"')
+print 'queryNC file opens for %d matches: %d (originally %d)'%(len(query['StationName']),\
+    len(set(query['NetCDF_Filename'])),len(query['StationName']))
+
+os.remove(dbold)
+os.remove(dbnew)
+os.rmdir(tmpdir)
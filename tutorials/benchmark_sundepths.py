@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the depth data culling in sundepths.DepthDriver: interpolating
+from the data within clipbuffer of the grid against all of the data
+
+Uses synthetic depth data held in memory:
+    - a dense scattered survey over a larger area than the grid
+    - a coarse regular survey (3 km spacing) with grid points in between,
+      where the clipped data would not give the same result for most
+      methods and DepthDriver has to fall back to all of the data
+"""
+
+import numpy as np
+from time import time
+
+from sundepths import DepthDriver
+
+####
+# Inputs
+Ndata = 400000 # number of scattered depth points
+Ngrid = 20000 # number of grid points
+clipbuffer = 1000.0
+methods = ['nn','idw','linear']
+####
+
+class Data(object):
+    """ Depth data in the form of sundepths.Inputs"""
+    def __init__(self,XY,Zin):
+        self.XY = XY
+        self.Zin = Zin
+
+class SyntheticDepths(DepthDriver):
+    """
+    DepthDriver with the depth data held in memory
+    """
+    def __init__(self,XY,Zin,**kwargs):
+        self.__dict__.update(kwargs)
+        self.indata = Data(XY,Zin)
+
+def bathymetry(XY):
+    """ Smooth synthetic depths"""
+    return 20. + 10*np.sin(XY[:,0]/7e3)*np.cos(XY[:,1]/5e3)
+
+def run(label,XY,xy):
+    print label
+    Zin = bathymetry(XY)
+    for method in methods:
+        sun = SyntheticDepths(XY,Zin,interpmethod=method,clipbuffer=clipbuffer)
+        tic = time()
+        dv = sun.interpDepths(xy)
+        t_clip = time()-tic
+
+        sun.clipbuffer = None
+        tic = time()
+        dvref = sun.interpDepths(xy)
+        t_all = time()-tic
+
+        print '    %-8s all data %8.3f s, clipped %8.3f s, maximum difference %e'%\
+            (method,t_all,t_clip,np.nanmax(np.abs(dv-dvref)))
+
+# Dense survey over 100 x 100 km with the grid in the middle 30 x 30 km
+XY = 1e5*np.random.rand(Ndata,2)
+xy = 3.5e4 + 3e4*np.random.rand(Ngrid,2)
+run('Dense scattered survey (%d points, %d grid points):'%(Ndata,Ngrid),XY,xy)
+
+# Coarse 3 km survey with the grid points in between the survey lines
+x,y = np.meshgrid(np.arange(0,33e3,3e3),np.arange(0,33e3,3e3))
+XY = np.column_stack((x.ravel(),y.ravel()))
+xy = 1.5e3 + 27e3*np.random.rand(200,2)
+run('Coarse 3 km survey (%d points, 200 grid points):'%XY.shape[0],XY,xy)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the sparse slice operator in sunslice.Slice against the layer
+by layer interpolation loop (Slice.interpSliceLoop)
+
+Uses a synthetic triangular grid with ~100k cells held in memory
+"""
+
+import numpy as np
+from scipy.spatial import Delaunay
+from time import time
+
+from sunslice import Slice
+
+####
+# Inputs
+Nc = 100000 # approximate number of cells
+Nkmax = 20
+Nt = 24
+Npt = 500
+method = 'linear'
+####
+
+class SyntheticSlice(Slice):
+    """
+    Slice of a synthetic grid with the data held in memory
+    """
+    def __init__(self,Nc,Nkmax,Nt,Npt):
+        # Build the grid
+        n = int(np.sqrt(Nc/2.))+1
+        x,y = np.meshgrid(np.linspace(0,1e5,n),np.linspace(0,1e5,n))
+        self.xp = x.ravel() + 100*np.random.rand(n*n)
+        self.yp = y.ravel() + 100*np.random.rand(n*n)
+        self.tri = Delaunay(np.vstack((self.xp,self.yp)).T)
+
+        self.cells = self.tri.simplices
+        self.Np = self.xp.shape[0]
+        self.Nc = self.cells.shape[0]
+        self.maxfaces = 3
+        self.xv = self.xp[self.cells].mean(axis=1)
+        self.yv = self.yp[self.cells].mean(axis=1)
+        xc = self.xp[self.cells]
+        yc = self.yp[self.cells]
+        self.Ac = 0.5*np.abs( (xc[:,1]-xc[:,0])*(yc[:,2]-yc[:,0]) -\
+            (xc[:,2]-xc[:,0])*(yc[:,1]-yc[:,0]) )
+
+        self.Nkmax = Nkmax
+        self.z_w = np.arange(Nkmax+1,dtype=np.double)
+        self.z_r = 0.5*(self.z_w[1:]+self.z_w[:-1])
+        self.Nk = np.random.randint(0,Nkmax,self.Nc)
+        self.dv = self.z_w[self.Nk+1]
+        self.infile = 'synthetic'
+
+        # Synthetic data
+        self._data = np.random.rand(Nt,Nkmax,self.Nc)
+
+        # Slice
+        self.Npt = Npt
+        self.xpt = np.array([1e3,5e4,9.9e4])
+        self.ypt = np.array([2e3,7e4,9e4])
+        self._getSliceCoords()
+        self._initInterp()
+
+    def _initInterp(self):
+        self.cellind = self.tri.find_simplex(np.vstack((self.xslice,self.yslice)).T)
+        self.xslice = np.repeat(self.xslice.reshape((1,self.Npt)),self.Nkmax,axis=0)
+        self.yslice = np.repeat(self.yslice.reshape((1,self.Npt)),self.Nkmax,axis=0)
+        self.calc_mask()
+
+    def loadData(self,variable=None):
+        return self._data[self.tstep,...].squeeze()
+
+print 'Building a synthetic grid...'
+sun = SyntheticSlice(Nc,Nkmax,Nt,Npt)
+print '\t%d cells, %d layers, %d time steps, %d slice points'%(sun.Nc,Nkmax,Nt,Npt)
+
+sun.tstep = range(Nt)
+sun.Ntslice = Nt
+
+tic = time()
+data_loop = sun.interpSliceLoop(None,method=method)
+t_loop = time()-tic
+
+tic = time()
+sun.sliceOperator(method=method)
+t_build = time()-tic
+
+tic = time()
+data_op = sun.interpSlice(None,method=method)
+t_op = time()-tic
+
+mask = np.isfinite(data_loop)
+print 'Layer by layer loop:   %10.3f s'%t_loop
+print 'Operator construction: %10.3f s'%t_build
+print 'Sparse operator:       %10.3f s'%t_op
+print 'Speedup (excluding/including construction): %6.1f / %6.1f'%\
+    (t_loop/t_op,t_loop/(t_op+t_build))
+print 'Maximum difference: %e'%np.abs(data_loop[mask]-data_op[mask]).max()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the Lomb-Scargle periodogram in uspectra: the original
+frequency loop (lspr) against the FFT/extirpolation version (lsprfast)
+
+Uses synthetic irregularly sampled records with two tidal constituents plus
+noise. The original method is extrapolated (O(N^2)) beyond Nmaxold points.
+"""
+
+import numpy as np
+from time import time
+
+from uspectra import lspr, lsprfast
+
+####
+# Inputs
+Nrecord = [1000,4000,16000,64000,256000]
+Nmaxold = 16000 # Largest record to run the original method on
+dt = 1800. # Mean sampling interval [s]
+ofac = 4.0
+####
+
+def synthetic_record(N):
+    """ Irregularly sampled M2 + K1 signal with noise"""
+    t = np.sort(np.random.rand(N))*N*dt
+    y = np.cos(2*np.pi/(12.42*3600)*t) + 0.5*np.sin(2*np.pi/(23.93*3600)*t+1.) \
+        + 0.3*np.random.randn(N)
+    return t, y
+
+print '%8s %14s %14s %10s %12s'%('N','lspr [s]','lsprfast [s]','speedup','max error')
+for N in Nrecord:
+    t, y = synthetic_record(N)
+
+    tic = time()
+    F2, px2, py2, ph2 = lsprfast(t,y,ofac=ofac)
+    t_new = time()-tic
+
+    if N <= Nmaxold:
+        tic = time()
+        F, px, py, ph = lspr(t,y,ofac=ofac,verbose=False)
+        t_old = time()-tic
+        t_ref = t_old/N**2
+        err = '%12.2e'%(np.abs(py-py2).max()/py.max())
+    else:
+        t_old = t_ref*N**2
+        err = '%12s'%'-'
+
+    print '%8d %14.3f %14.3f %10.1f %s'%(N,t_old,t_new,t_old/t_new,err)
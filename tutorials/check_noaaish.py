@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Check of the NOAA ISH parser (getNOAAWeatherStation.ishData2struct) against
+the output of the original line-by-line parser stored in
+data/ish/ish_reference.npz
+
+The sample files in data/ish are small synthetic ISH files covering:
+    - missing value sentinels in the mandatory data section
+    - AA1 (rain), GA1/GD1/GF1 (cloud), CH1/RH1 (humidity), MW1 and REM
+      additional data sections
+    - a single line file (on a leap day) and an empty file
+"""
+
+import os
+import numpy as np
+
+from getNOAAWeatherStation import ishData2struct, readISH
+
+####
+# Inputs
+datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'data','ish')
+station_id = '722420-12923'
+station_name = 'GALVESTON'
+years = [1995,1996,1997]
+varnames = ['Tair','Pair','Uwind','Vwind','RH','rain','cloud']
+####
+
+def same(a,b):
+    """ True if the arrays are equal, including the location of the NaNs"""
+    a = np.asarray(a,dtype=np.float64)
+    b = np.asarray(b,dtype=np.float64)
+    if not a.shape==b.shape:
+        return False
+    nan = np.isnan(a)
+    return np.array_equal(nan,np.isnan(b)) and np.array_equal(a[~nan],b[~nan])
+
+ref = np.load(os.path.join(datadir,'ish_reference.npz'))
+
+failed = []
+for year in years:
+    name = '%s-%d'%(station_id,year)
+    gzfile = os.path.join(datadir,name+'.gz')
+
+    ishdata, addldata = readISH(gzfile)
+    station = ishData2struct(gzfile,station_id,station_name)
+
+    diffs = []
+    if not ishdata.shape[0]==len(addldata)==ref[name+'/Tair/Data'].shape[0]:
+        diffs.append('number of records')
+    for kk in ['Latitude','Longitude']:
+        if not same(station[kk],ref[name+'/'+kk]):
+            diffs.append(kk)
+    for vv in varnames:
+        for kk in ['Data','Time','Height']:
+            key = '%s/%s/%s'%(name,vv,kk)
+            if key in ref.files and not same(station[vv][kk],ref[key]):
+                diffs.append('%s %s'%(vv,kk))
+
+    if len(diffs)>0:
+        failed.append(name)
+        print '%s: differs from the reference in: %s'%(name,', '.join(diffs))
+    else:
+        print '%s: %d records match the reference'%(name,ishdata.shape[0])
+
+if len(failed)>0:
+    raise Exception, 'ISH parser output differs from the reference for: %s'%', '.join(failed)